@@ -3,34 +3,66 @@
 """
 Information retrieval from ASP raw folder (based on DIM)
 
+Several folders (or an archive order containing many deliveries) are scanned in a
+pool of processes, and the information can be exported as JSON or CSV, with the
+footprints of all the deliveries in one KML or GeoJSON file.
 
 Usage:
-    pleiadesinfo.py <folder> [--kml]
+    pleiadesinfo.py <folder>... [--kml] [--geojson] [--json <file>] [--csv <file>] [--stats | --approx-stats] [--workers <n>]
     pleiadesinfo.py -h | --help
 
 Options:
-    -h --help       Show this screen
-    <folder>        Pleides data folder (or DIM)
-    --kml           Export the track countouring kml
+    -h --help           Show this screen
+    <folder>            Pleides data folder (or DIM), or folder of deliveries
+    --kml               Export the track countouring kml (footprints.kml)
+    --geojson           Export the track countouring geojson (footprints.geojson)
+    --json <file>       Export the information of all the deliveries as JSON
+    --csv <file>        Export the information of all the deliveries as CSV
+    --stats             Compute the pixel statistics (reading all the pixels)
+    --approx-stats      Compute approximate pixel statistics (from the overviews)
+    --workers <n>       Number of deliveries scanned simultaneously [default: 8]
 """
 
-import os
+import csv
 import glob
-import docopt
+import json
+import math
+import os
+import subprocess
+import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from plistlib import InvalidFileException
 
+import docopt
 
-def parse_xml(file: str):
-    """
-    Parse an XML file into a root element
+# Shared with the workflows
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
+from dim import read_dim  # noqa: E402
 
-    :param file: path to the xml to parse
-    :returns root: the root xml object
-    """
-    tree = ET.parse(file)
-    root = tree.getroot()
-    return root
+# Scalar fields exported in the CSV
+FIELDS = [
+    "dataset_name",
+    "dim_path",
+    "imaging_date",
+    "imaging_time",
+    "job_id",
+    "nrow",
+    "ncol",
+    "data_type",
+    "nbits",
+    "sign",
+    "value_min",
+    "value_max",
+    "value_mean",
+    "value_std",
+    "area",
+    "cloud",
+    "snow",
+]
 
 
 def resolve_dim(folder: str):
@@ -47,68 +79,123 @@ def resolve_dim(folder: str):
     return dim
 
 
+def find_dims(folders: list[str]) -> list[str]:
+    """DIM of each delivery, searching the folders recursively if needed"""
+    dims = []
+    for folder in folders:
+        try:
+            dims.append(resolve_dim(folder))
+        except FileNotFoundError:
+            found = glob.glob(os.path.join(folder, "**", "DIM*.XML"), recursive=True)
+            if len(found) == 0:
+                raise FileNotFoundError("No DIM found in {}".format(folder))
+            dims += sorted(found)
+    return dims
+
+
+def pixel_stats(dim: str, approx=False) -> list[dict] | None:
+    """Statistics of each band, read by GDAL (DIMAP driver) without writing any
+    .aux.xml in the delivery"""
+    cmd = ["gdalinfo", "-json", "-approx_stats" if approx else "-stats", dim]
+    env = dict(os.environ, GDAL_PAM_ENABLED="NO")
+    try:
+        info = subprocess.run(cmd, capture_output=True, text=True, env=env)
+        bands = json.loads(info.stdout)["bands"]
+    except (OSError, ValueError, KeyError):
+        return None
+    return [
+        {
+            "min": b.get("minimum", None),
+            "max": b.get("maximum", None),
+            "mean": b.get("mean", None),
+            "std": b.get("stdDev", None),
+        }
+        for b in bands
+    ]
+
+
+def inspect(dim: str, stats: str | None = None) -> dict | None:
+    """Information of a delivery as a plain dict (runs in a worker process), None if
+    its DIM cannot be read"""
+    try:
+        displayer = PleiadesDisplay(dim)
+    except (ET.ParseError, OSError) as e:
+        print("Unreadable DIM {}: {}".format(dim, e), file=sys.stderr)
+        return None
+    if stats is not None:
+        displayer.compute_stats(approx=stats == "approx")
+    return displayer.to_dict()
+
+
+def inspect_all(dims: list[str], stats: str | None = None, workers: int = 8):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        records = list(pool.map(partial(inspect, stats=stats), dims))
+    return [r for r in records if r is not None]
+
+
 class PleiadesDisplay:
     def __init__(self, folder):
         dim = resolve_dim(folder)
-        self.dim = parse_xml(dim)
+        self.dim = read_dim(dim)
 
         self.is_folder_complete = False
         self.vrt_file = None
 
-        self.dataset_name = self.get("./Dataset_Identification/DATASET_NAME")
-        self.copyright = self.get(
-            "./Dataset_Identification/Legal_Constraints/COPYRIGHT"
-        )
-        self.imaging_date = self.get(
-            "./Dataset_Sources/Source_Identification/Strip_Source/IMAGING_DATE"
-        )
-        self.imaging_time = self.get(
-            "./Dataset_Sources/Source_Identification/Strip_Source/IMAGING_TIME"
-        )
-        self.job_id = self.get("./Product_Information/Delivery_Identification/JOB_ID")
+        self.dataset_name = self.dim.dataset_name
+        self.copyright = self.dim.copyright
+        self.imaging_date = self.dim.imaging_date
+        self.imaging_time = self.dim.imaging_time
+        self.job_id = self.dim.job_id
         self.dim_path = dim
-        self.dim_version = self.get(
-            "./Metadata_Identification/METADATA_FORMAT", "version"
-        )
-        self.rpc_path = self.get(
-            "./Geoposition/Geoposition_Models/Rational_Function_Model/Component/COMPONENT_PATH",
-            "href",
-        )
-        self.nrow = self.get("./Raster_Data/Raster_Dimensions/NROWS")
-        self.ncol = self.get("./Raster_Data/Raster_Dimensions/NCOLS")
-        self.data_type = self.get("./Raster_Data/Raster_Encoding/DATA_TYPE")
-        self.nbits = self.get("./Raster_Data/Raster_Encoding/NBITS")
-        self.sign = self.get("./Raster_Data/Raster_Encoding/SIGN")
+        self.dim_version = self.dim.dim_version
+        self.rpc_path = self.dim.rpc_path
+        self.nrow = self.dim.nrows
+        self.ncol = self.dim.ncols
+        self.data_type = self.dim.data_type
+        self.nbits = self.dim.nbits
+        self.sign = self.dim.sign
         self.special_values = None
         self.value_min = None
         self.value_max = None
         self.value_mean = None
         self.value_std = None
-        self.area = self.get("./Dataset_Content/SURFACE_AREA")
-        self.cloud = self.get("./Dataset_Content/CLOUD_COVERAGE")
-        self.snow = self.get("./Dataset_Content/SNOW_COVERAGE")
+        self.area = self.dim.area
+        self.cloud = self.dim.cloud
+        self.snow = self.dim.snow
         self.crs = None
         self.acqu_angles = None
         self.solar_inc = None
         self.gsd = None
         self.bound_geom, self.bound_coord = self.get_geom()
 
-    def get(self, value: str, attrib: None | str = None):
-        fetch = self.dim.find(value)
-        if fetch is None:
-            return None
+    def compute_stats(self, approx=False):
+        """Fill the pixel statistics (over all the bands)"""
+        bands = pixel_stats(self.dim_path, approx=approx)
+        if bands is None or len(bands) == 0:
+            return
+        minima = [b["min"] for b in bands if b["min"] is not None]
+        maxima = [b["max"] for b in bands if b["max"] is not None]
+        self.value_min = min(minima) if len(minima) > 0 else None
+        self.value_max = max(maxima) if len(maxima) > 0 else None
+        moments = [b for b in bands if b["mean"] is not None and b["std"] is not None]
+        if len(moments) == 0:
+            return
+        # Bands of the same size: pooled variance from the band means and variances
+        mean = sum([b["mean"] for b in moments]) / len(moments)
+        square = sum([b["std"] ** 2 + b["mean"] ** 2 for b in moments]) / len(moments)
+        self.value_mean = mean
+        self.value_std = math.sqrt(max(square - mean**2, 0))
 
-        if attrib is None:
-            return fetch.text
-        else:
-            return fetch.attrib[attrib]
+    def to_dict(self) -> dict:
+        record = {f: getattr(self, f) for f in FIELDS}
+        record["bound_geom"] = self.bound_geom
+        return record
 
     def get_geom(self):
-        vertex = self.dim.findall("./Dataset_Content/Dataset_Extent/Vertex")
-        if vertex is None:
+        if len(self.dim.extent) == 0:
             return None, None
-        latlon = [[v.find(".LAT").text, v.find(".LON").text] for v in vertex]
-        coordxy = [[v.find(".COL").text, v.find(".ROW").text] for v in vertex]
+        latlon = [[str(v[1]), str(v[0])] for v in self.dim.extent]
+        coordxy = [[str(v[2]), str(v[3])] for v in self.dim.extent]
         return latlon, coordxy
 
     def display(self):
@@ -117,13 +204,20 @@ class PleiadesDisplay:
         message += "DIM (v{}): {}\n".format(self.dim_version, self.dim_path)
         message += "nrow, ncol: {}, {}\n".format(self.nrow, self.ncol)
         message += "datatype: {} {} {}\n".format(self.data_type, self.nbits, self.sign)
+        if self.value_mean is not None:
+            message += "values: min {} max {} mean {:.2f} std {:.2f}\n".format(
+                self.value_min, self.value_max, self.value_mean, self.value_std
+            )
         message += "Bounding polygon: {}".format(display_geom(self.bound_geom))
         message += "                  {}".format(display_geom(self.bound_coord))
 
         print(message)
 
     def export_kml(self, path):
-        pass
+        """Write the footprint in a KML file (path: file or folder)"""
+        if os.path.isdir(path):
+            path = os.path.join(path, "{}.kml".format(self.dataset_name))
+        write_kml([self.to_dict()], path)
 
 
 def display_geom(geom):
@@ -133,14 +227,102 @@ def display_geom(geom):
     return disp
 
 
+def display_record(record: dict):
+    print(
+        "{}  {} {}  {}x{}  cloud {}  {}".format(
+            record["dataset_name"],
+            record["imaging_date"],
+            record["imaging_time"],
+            record["ncol"],
+            record["nrow"],
+            record["cloud"],
+            record["dim_path"],
+        )
+    )
+
+
+def ring(geom: list) -> list[list[float]]:
+    """Closed lon, lat ring of a footprint"""
+    coords = [[float(g[1]), float(g[0])] for g in geom]
+    if len(coords) > 0 and coords[0] != coords[-1]:
+        coords.append(coords[0])
+    return coords
+
+
+def write_kml(records: list[dict], path: str):
+    """Write the footprints of the deliveries as KML polygons"""
+    placemarks = ""
+    for r in records:
+        if not r["bound_geom"]:
+            continue
+        coords = " ".join(["{},{}".format(c[0], c[1]) for c in ring(r["bound_geom"])])
+        placemarks += (
+            "<Placemark><name>{}</name>"
+            "<description>{} {}</description>"
+            "<Polygon><outerBoundaryIs><LinearRing><coordinates>{}</coordinates>"
+            "</LinearRing></outerBoundaryIs></Polygon></Placemark>\n"
+        ).format(r["dataset_name"], r["imaging_date"], r["imaging_time"], coords)
+    with open(path, "w") as outfile:
+        outfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n'
+        )
+        outfile.write(placemarks)
+        outfile.write("</Document></kml>\n")
+
+
+def write_geojson(records: list[dict], path: str):
+    """Write the footprints of the deliveries as a GeoJSON feature collection"""
+    features = []
+    for r in records:
+        if not r["bound_geom"]:
+            continue
+        features.append(
+            {
+                "type": "Feature",
+                "properties": {f: r[f] for f in FIELDS},
+                "geometry": {"type": "Polygon", "coordinates": [ring(r["bound_geom"])]},
+            }
+        )
+    with open(path, "w") as outfile:
+        json.dump({"type": "FeatureCollection", "features": features}, outfile)
+
+
+def write_csv(records: list[dict], path: str):
+    with open(path, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+
+
 if __name__ == "__main__":
     arguments = docopt.docopt(__doc__)
 
-    folder = arguments["<folder>"]
-    kml = arguments["--kml"]
+    folders = arguments["<folder>"]
+    stats = None
+    if arguments["--stats"]:
+        stats = "exact"
+    elif arguments["--approx-stats"]:
+        stats = "approx"
 
-    displayer = PleiadesDisplay(folder)
-    displayer.display()
+    dims = find_dims(folders)
+    if len(dims) == 1:
+        displayer = PleiadesDisplay(dims[0])
+        if stats is not None:
+            displayer.compute_stats(approx=stats == "approx")
+        displayer.display()
+        records = [displayer.to_dict()]
+    else:
+        records = inspect_all(dims, stats, workers=int(arguments["--workers"]))
+        for r in records:
+            display_record(r)
 
-    if kml:
-        displayer.export_kml(".")
+    if arguments["--kml"]:
+        write_kml(records, "footprints.kml")
+    if arguments["--geojson"]:
+        write_geojson(records, "footprints.geojson")
+    if arguments["--json"] is not None:
+        with open(arguments["--json"], "w") as outfile:
+            json.dump(records, outfile, indent=2)
+    if arguments["--csv"] is not None:
+        write_csv(records, arguments["--csv"])
@@ -0,0 +1,164 @@
+"""
+Alignment of the DSM fragments on the reference DEM (pc_align)
+
+Each fragment is aligned on the reference DEM cropped to its own footprint (enlarged
+by the max-displacement), several fragments at a time. The solved transform is saved
+with a signature of the inputs it was solved from: as long as they do not change, the
+aligned point cloud is regenerated from the saved transform (`--num-iterations 0`)
+instead of solving the ICP again. The residuals of all the fragments are summarised
+in the output folder.
+
+Global parameters of the parameter file:
+* pc-align-workers: number of fragments aligned simultaneously (default 4)
+"""
+
+import csv
+import json
+import logging
+import math
+import os
+import statistics
+from copy import deepcopy
+
+from asp import pc_align, sh
+
+logger = logging.getLogger(__name__)
+
+ALIGN_SUFFIX = "-align"
+ALIGNED_SUFFIX = "-PC_aligned.tif"
+SUMMARY_FILE = "pc-align-summary.csv"
+RASTER_EXT = (".tif", ".tiff", ".vrt")
+
+
+def align_prefix(fragment: str) -> str:
+    return fragment + ALIGN_SUFFIX
+
+
+def signature(reference: str, source: str, params: dict) -> dict:
+    """Inputs a transform is solved from (the thread count does not matter)"""
+    options = {k: v for k, v in params["pc-align"].items() if k != "threads"}
+    ref, src = os.stat(reference), os.stat(source)
+    return {
+        "reference": [os.path.abspath(reference), ref.st_mtime_ns, ref.st_size],
+        "source": [src.st_mtime_ns, src.st_size],
+        "params": json.dumps(options, sort_keys=True),
+    }
+
+
+def read_signature(prefix: str) -> dict | None:
+    try:
+        with open(prefix + "-signature.json", "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def crop_reference(
+    reference: str, area: list[float], epsg: int, output: str, debug=False
+):
+    """Virtual crop of the reference DEM on an area given in another CRS"""
+    cmd = ["gdal_translate", "-of", "VRT", "-projwin"]
+    cmd += [area[0], area[3], area[2], area[1]]
+    cmd += ["-projwin_srs", "EPSG:{}".format(epsg), reference, output]
+    sh(cmd, debug=debug)
+
+
+def align_fragment(
+    reference: str,
+    fragment: str,
+    source: str,
+    params: dict,
+    area: list[float] | None = None,
+    epsg: int | None = None,
+    debug=False,
+):
+    """Align the point cloud of a fragment, reusing its saved transform if valid"""
+    prefix = align_prefix(fragment)
+    transform = prefix + "-transform.txt"
+    aligned = fragment + ALIGNED_SUFFIX
+    force = params.get("force", False)
+    current = None if debug else signature(reference, source, params)
+    reuse = (
+        not force and os.path.isfile(transform) and read_signature(prefix) == current
+    )
+    if reuse and os.path.isfile(aligned):
+        logger.info("Alignment up to date: {}".format(fragment))
+        return
+
+    ref = reference
+    if area is not None and epsg is not None and reference.lower().endswith(RASTER_EXT):
+        margin = params["pc-align"].get("max-displacement", 0)
+        area = [area[0] - margin, area[1] - margin, area[2] + margin, area[3] + margin]
+        ref = prefix + "-reference.vrt"
+        crop_reference(reference, area, epsg, ref, debug=debug)
+
+    use_params = deepcopy(params)
+    use_params["pc-align"]["save-transformed-source-points"] = True
+    output = prefix
+    if reuse:
+        logger.info("Reusing the saved alignment: {}".format(fragment))
+        use_params["pc-align"]["num-iterations"] = 0
+        use_params["pc-align"]["initial-transform"] = transform
+        # Keep the solved transform and residuals untouched
+        output = prefix + "-apply"
+    pc_align(ref, source, output, use_params, debug=debug)
+    if debug:
+        return
+    os.replace(output + "-trans_source.tif", aligned)
+    if not reuse:
+        with open(prefix + "-signature.json", "w") as outfile:
+            json.dump(current, outfile)
+
+
+def read_errors(errors_file: str) -> list[float]:
+    """Errors (last column) of a pc_align beg/end_errors.csv"""
+    errors = []
+    try:
+        with open(errors_file, "r") as infile:
+            for row in csv.reader(infile):
+                if len(row) == 0 or row[0].startswith("#"):
+                    continue
+                errors.append(float(row[-1]))
+    except (OSError, ValueError):
+        pass
+    return errors
+
+
+def read_translation(transform_file: str) -> float | None:
+    """Magnitude of the translation of a pc_align transform (4x4 matrix)"""
+    try:
+        with open(transform_file, "r") as infile:
+            matrix = [
+                [float(v) for v in line.split()] for line in infile if line.strip()
+            ]
+        return math.sqrt(sum([matrix[i][3] ** 2 for i in range(3)]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def write_summary(fragments: list[str], output_dir: str, debug=False):
+    """Residuals before and after the alignment of every fragment"""
+    if debug:
+        return
+    rows = []
+    for f in fragments:
+        prefix = align_prefix(f)
+        row = {"fragment": os.path.dirname(f)}
+        for step in ["beg", "end"]:
+            errors = read_errors("{}-{}_errors.csv".format(prefix, step))
+            row[step + "_median"] = statistics.median(errors) if errors else None
+            row[step + "_mean"] = statistics.mean(errors) if errors else None
+        row["translation"] = read_translation(prefix + "-transform.txt")
+        rows.append(row)
+    summary = os.path.join(output_dir, SUMMARY_FILE)
+    with open(summary, "w", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    medians = [r["end_median"] for r in rows if r["end_median"] is not None]
+    if len(medians) > 0:
+        logger.info(
+            "Alignment residuals (median over fragments): {:.3f} m, see {}".format(
+                statistics.median(medians), summary
+            )
+        )
@@ -0,0 +1,74 @@
+"""
+Python API of ASPeo
+
+Drive the workflows from Python instead of the command line:
+
+    from api import Project
+
+    project = Project.from_toml("aspeo.toml")
+    pt = project.pixel_tracking()
+    pt.select(lambda job: job.name != "20200101_20200201")
+    pt.after(lambda job: print(job.stage, job.name, job.state))
+    pt.run()
+
+Each workflow object plans its jobs from its own copy of the parameters, so the same
+project can give several workflows. `run` takes an optional concurrent.futures like
+executor (e.g a ThreadPoolExecutor shared with other work) to submit the jobs to.
+"""
+
+from copy import deepcopy
+
+from asp_dsm import DsmGeneration
+from asp_mp import MapProjection
+from asp_pt import PixelTracking
+from params import parse_params
+from runner import Tracker
+from sweep import Sweep
+from workflow import Workflow
+
+WORKFLOWS = {
+    "mp": MapProjection,
+    "pt": PixelTracking,
+    "dsm": DsmGeneration,
+    "sweep": Sweep,
+}
+
+__all__ = [
+    "Project",
+    "Workflow",
+    "MapProjection",
+    "PixelTracking",
+    "DsmGeneration",
+    "Sweep",
+]
+
+
+class Project:
+    """Parameters of an ASPeo project, from which the workflows are planned
+
+    :param params: parameters as read by `parse_params` (copied)
+    """
+
+    def __init__(self, params: dict, debug=False):
+        self.params = deepcopy(params)
+        self.debug = debug
+
+    @classmethod
+    def from_toml(cls, path: str, debug=False) -> "Project":
+        return cls(parse_params(path), debug=debug)
+
+    def workflow(self, name: str, tracker: Tracker | None = None) -> Workflow:
+        """Workflow by its command line name (mp, pt, dsm or sweep)"""
+        return WORKFLOWS[name](self.params, debug=self.debug, tracker=tracker)
+
+    def map_projection(self, tracker: Tracker | None = None) -> MapProjection:
+        return self.workflow("mp", tracker=tracker)
+
+    def pixel_tracking(self, tracker: Tracker | None = None) -> PixelTracking:
+        return self.workflow("pt", tracker=tracker)
+
+    def dsm_generation(self, tracker: Tracker | None = None) -> DsmGeneration:
+        return self.workflow("dsm", tracker=tracker)
+
+    def sweep(self, tracker: Tracker | None = None) -> Sweep:
+        return self.workflow("sweep", tracker=tracker)
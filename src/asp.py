@@ -1,74 +1,86 @@
+import json
+import logging
 import os
-import sys
+import shlex
 import subprocess
-import logging
+
+from runner import CommandError, run
 
 logger = logging.getLogger(__name__)
 
+# Number of inputs from which they are passed through a list file instead of the
+# command line (ARG_MAX)
+LIST_FILE_MIN = 100
 
-def sh(cmd: str, shell: bool = True, debug: bool = False):
+
+def sh(cmd: list[str], debug: bool = False, check: bool = True):
     """
-    Launch a shell command
+    Launch a command
 
-    As shell=True, all single call is made in a separate shell
+    The command is an argument list executed directly, without a shell, so that
+    paths with spaces or shell characters are passed as is. The output is parsed by
+    the runner to follow the progress of the current job. A non-zero exit code
+    raises a CommandError, unless check is False.
 
     # Example
 
     ````
-    sh("ls -l | wc -l")
+    sh(["gdalinfo", "-json", "image.tif"])
     ````
 
     """
-    logger.info(">> " + cmd)
+    cmd = [str(c) for c in cmd]
+    logger.info(">> " + shlex.join(cmd))
 
     if not debug:
-        return subprocess.run(
-            cmd,
-            shell=shell,
-            stdout=sys.stdout,
-            stderr=subprocess.STDOUT,
-            env=os.environ,
-        )
-
-
-def arg_to_str(arg) -> str:
-    """Resolve an argument into a string representation
-    [10, 10] > "10 10"
-    [var1, var2] > "str(var1) str(var2)"
-    var > str(var)
-    None > ""
+        result = run(cmd)
+        if check and result.returncode != 0:
+            raise CommandError(shlex.join(cmd), result.returncode)
+        return result
+
+
+def arg_to_list(arg) -> list[str]:
+    """Resolve an argument into command arguments
+    [10, 10] > ["10", "10"]
+    [var1, var2] > [str(var1), str(var2)]
+    var > [str(var)]
+    None > []
     """
     if arg is not None:
         if type(arg) is list:
-            # Concatenate multiples elements with space
-            return " ".join([str(a) for a in arg])
-        # Return element as string
-        return str(arg)
-    # return empty string
-    return ""
+            return [str(a) for a in arg]
+        return [str(arg)]
+    return []
 
 
-def format_arg(key: str, value) -> str:
+def format_arg(key: str, value) -> list[str]:
     """Format a key/value couple into a command option"""
     prefix = "--" if len(key) > 1 else "-"
-    # sep = " " if len(key) > 1 else " "
     if type(value) is bool:
         if value:
-            return prefix + "{}".format(key)
+            return [prefix + key]
         else:
-            return ""
-    value = arg_to_str(value)
-    return prefix + "{} {}".format(key, value)
+            return []
+    return [prefix + key] + arg_to_list(value)
 
 
-def format_dict(dic: dict) -> str:
+def format_dict(dic: dict) -> list[str]:
     """Format all dict into command options"""
-    params = ""
+    params = []
     for key, value in dic.items():
-        params += format_arg(key, value) + " "
+        params += format_arg(key, value)
     return params
 
 
+def list_file(files: list[str], path: str, debug=False) -> str:
+    """Write a list of files (one per line) for the list options of the ASP tools"""
+    if not debug:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as outfile:
+            outfile.write("".join([f + "\n" for f in files]))
+    return path
+
+
 def stereo(
     images: list[str],
     cameras: list[str] | None,
@@ -82,19 +94,15 @@ def stereo(
     If no cameras are provided, it launches in correlator mode (no triangulation)
     """
     params = format_dict(parameters["stereo"])
-    dem = "" if dem is None else dem
+    dem = arg_to_list(dem)
 
     if cameras is None:
         # Cannot do triangulation with no camera, so only disparity
-        cmd = "parallel_stereo --correlator-mode {} {} {} {}".format(
-            params, arg_to_str(images), output, dem
-        )
+        cmd = ["parallel_stereo", "--correlator-mode"] + params + images + [output]
     else:
-        cmd = "parallel_stereo {} {} {} {} {}".format(
-            params, arg_to_str(images), arg_to_str(cameras), output, dem
-        )
+        cmd = ["parallel_stereo"] + params + images + cameras + [output]
 
-    sh(cmd, debug=debug)
+    sh(cmd + dem, debug=debug)
 
 
 def corr_eval(
@@ -103,7 +111,7 @@ def corr_eval(
     """Launch a corr_eval (ASP) to evaluate the ncc of a stereo result"""
     params = format_dict(parameters["corr-eval"])
 
-    cmd = "corr_eval {} {} {} {} {}".format(params, left, right, disp, output)
+    cmd = ["corr_eval"] + params + [left, right, disp, output]
 
     sh(cmd, debug=debug)
 
@@ -114,7 +122,7 @@ def map_project(
     """Launch mapproject (ASP) to create an orthorectified image"""
     params = format_dict(parameters["map-project"])
 
-    cmd = "mapproject {} {} {} {} {}".format(params, dem, image, camera, output)
+    cmd = ["mapproject"] + params + [dem, image, camera, output]
 
     sh(cmd, debug=debug)
 
@@ -128,19 +136,28 @@ def bundle_adjust(
     parallel=False,
     debug=False,
 ):
-    """Launch bundle_adjust to reduce errors between cameras based on their given images"""
+    """Launch bundle_adjust to reduce errors between cameras based on their given images
+
+    Many images and cameras are passed through list files written next to the
+    output prefix.
+    """
     params = format_dict(parameters["bundle-adjust"])
 
-    gcp = ""
-    if ground_control_points is not None:
-        gcp += " " + arg_to_str(ground_control_points)
+    if len(images) >= LIST_FILE_MIN:
+        inputs = [
+            "--image-list",
+            list_file(images, output + "-image-list.txt", debug=debug),
+            "--camera-list",
+            list_file(cameras, output + "-camera-list.txt", debug=debug),
+        ]
+    else:
+        inputs = images + cameras
+    gcp = arg_to_list(ground_control_points)
 
-    cmd = "bundle_adjust {} {}{} -o {} {}".format(
-        arg_to_str(images), arg_to_str(cameras), gcp, output, params
-    )
+    cmd = ["bundle_adjust"] + inputs + gcp + ["-o", output] + params
 
     if parallel:
-        cmd = "parallel_" + cmd
+        cmd[0] = "parallel_" + cmd[0]
     sh(cmd, debug=debug)
 
 
@@ -154,7 +171,7 @@ def pc_align(
     """Launch pc_align to align a source point cloud to another reference (or DEM)"""
     params = format_dict(parameters["pc-align"])
 
-    cmd = "pc_align {} {} {} -o {}".format(params, reference, source, output)
+    cmd = ["pc_align"] + params + [reference, source, "-o", output]
 
     sh(cmd, debug=debug)
 
@@ -168,7 +185,7 @@ def point2dem(
     """Launch point2dem to convert a point cloud into a DEM"""
     params = format_dict(parameters["point2dem"])
 
-    cmd = "point2dem {} {} -o {}".format(params, point_cloud, output)
+    cmd = ["point2dem"] + params + [point_cloud, "-o", output]
 
     sh(cmd, debug=debug)
 
@@ -179,10 +196,15 @@ def dem_mosaic(
     parameters: dict,
     debug=False,
 ):
-    """Launch dem_mosaic to merge rasters with overlap blending"""
+    """Launch dem_mosaic to merge rasters with overlap blending
+
+    Many DEMs are passed through a list file written next to the output.
+    """
     params = format_dict(parameters["dem-mosaic"])
 
-    cmd = "dem_mosaic {} {} -o {}".format(params, arg_to_str(dems), output)
+    if len(dems) >= LIST_FILE_MIN:
+        dems = ["-l", list_file(dems, output + "-list.txt", debug=debug)]
+    cmd = ["dem_mosaic"] + params + dems + ["-o", output]
 
     sh(cmd, debug=debug)
 
@@ -193,7 +215,7 @@ def image_align(
     """Launch image_align to align images feature based"""
     params = format_dict(parameters["align"])
 
-    cmd = "image_align {} {} {} -o {}".format(params, reference, source, output)
+    cmd = ["image_align"] + params + [reference, source, "-o", output]
 
     sh(cmd, debug=debug)
 
@@ -204,9 +226,7 @@ def orbit_viz(
     """Launch orbitviz to create a kml featuring the acquisition orbits"""
     params = format_dict(parameters["orbitviz"])
 
-    cmd = "orbitviz {} {} {} -o {}".format(
-        params, arg_to_str(imgs), arg_to_str(cams), output
-    )
+    cmd = ["orbitviz"] + params + imgs + cams + ["-o", output]
 
     sh(cmd, debug=debug)
 
@@ -215,7 +235,7 @@ def gdal_crop(input: str, output: str, parameters: dict, debug=False):
     """Use gdal_translate with the crop parameters"""
     params = format_dict(parameters["crop"])
 
-    cmd = "gdal_translate {} {} {}".format(params, input, output)
+    cmd = ["gdal_translate"] + params + [input, output]
 
     sh(cmd, debug=debug)
 
@@ -227,6 +247,18 @@ def gdal_pansharp(
     panchromatic image"""
     params = format_dict(parameters["pansharpening"])
 
-    cmd = "gdal_pansharpen {} {} {} {}".format(panchro, arg_to_str(ms), output, params)
+    cmd = ["gdal_pansharpen", panchro] + arg_to_list(ms) + [output] + params
 
     sh(cmd, debug=debug)
+
+
+def gdal_info(raster: str, options: list[str] | None = None) -> dict | None:
+    """Read the gdalinfo json description of a raster (None if it cannot be read)"""
+    options = [] if options is None else options
+    try:
+        info = subprocess.run(
+            ["gdalinfo", "-json"] + options + [raster], capture_output=True, text=True
+        )
+        return json.loads(info.stdout)
+    except (OSError, ValueError):
+        return None
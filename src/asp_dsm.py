@@ -15,7 +15,8 @@ Options:
     <toml>          ASPeo parameter file
 """
 
-from asp import stereo, pc_align, point2dem, dem_mosaic, sh
+from asp import stereo, point2dem, dem_mosaic
+from align import ALIGNED_SUFFIX, align_fragment, write_summary
 from params import (
     parse_params,
     get_sources,
@@ -25,10 +26,22 @@ from params import (
     check_for_mp,
     retrieve_max2p_bbox,
     retrieve_dem,
+    read_mp_headers,
     DIR_STEREO,
     PREF_STEREO,
 )
+from matches import stereo_params
+from mosaic import join_tiles, tile_jobs
+from retention import Retention
+from scratch import Scratch
+from runner import TRACKER, Job, megapixels, split_budget
+from geotiff import bounds, intersection
+from workflow import Workflow
+import math
 import os
+import shutil
+from copy import deepcopy
+from functools import partial
 import docopt
 import logging
 
@@ -36,71 +49,315 @@ logger = logging.getLogger(__name__)
 
 
 def dsm_generation(params: dict, debug=False):
-    logger.info("Beginning DSM Generation sequence")
-    output_dir = params.get("output", ".")
-    sources = get_sources(params)
-    pairs = get_pairs(params, ids_from_source(sources))
-    sources = check_for_mp(sources, output_dir)
-    if sources is None:
-        raise ValueError("No map projected images defined or no previous mp run found")
-    fragment = []
-
-    if params.get("dem", None) is None:
-        logger.info("dem is not provided in parameters")
-        if sh("my_getDemFile.py -h").returncode == 1:
-            logger.error("my_getDemFile is not available for dem retrieval")
-            raise ValueError("my_getDemFile is not available for dem retrieval")
-        else:
-            logger.info("automatically retrieve dem using my_getDemFile")
-            params["dem"] = retrieve_dem(params, debug=debug)
-
-    for p in pairs:
-        frag = os.path.join(output_dir, DIR_STEREO, p[0] + "_" + p[1])
-        if len(p) > 2:
-            frag += "_" + p[2]
-        frag += PREF_STEREO
-        fragment.append(frag)
+    DsmGeneration(params, debug=debug, tracker=TRACKER.current()).run()
+
+
+class DsmGeneration(Workflow):
+    """DSM generation workflow: stereo, alignment and rasterization of each fragment,
+    then mosaic"""
+
+    def setup(self) -> list[tuple]:
+        logger.info("Beginning DSM Generation sequence")
+        params, debug = self.params, self.debug
+        output_dir = params.get("output", ".")
+        sources = get_sources(params, debug=debug)
+        pairs = get_pairs(params, ids_from_source(sources))
+        sources = check_for_mp(sources, output_dir)
+        if sources is None:
+            raise ValueError(
+                "No map projected images defined or no previous mp run found"
+            )
+        sources = read_mp_headers(sources)
+        fragment = []
+
+        if params.get("dem", None) is None:
+            logger.info("dem is not provided in parameters")
+            if shutil.which("my_getDemFile.py") is None:
+                logger.error("my_getDemFile is not available for dem retrieval")
+                raise ValueError("my_getDemFile is not available for dem retrieval")
+            else:
+                logger.info("automatically retrieve dem using my_getDemFile")
+                params["dem"] = retrieve_dem(params, debug=debug)
+
+        for p in pairs:
+            frag = os.path.join(output_dir, DIR_STEREO, p[0] + "_" + p[1])
+            if len(p) > 2:
+                frag += "_" + p[2]
+            frag += "/" + PREF_STEREO
+            fragment.append(frag)
 
-    logger.info("working with {} fragments".format(len(fragment)))
+        logger.info("working with {} fragments".format(len(fragment)))
 
-    pc_suffix = "-PC.tif"
-    if "stereo" in params.keys():
-        run_stereo(pairs, sources, fragment, params, debug=debug)
+        pc_suffix = "-PC.tif"
+        if "retention" in params:
+            self.retention = Retention(params, debug=debug)
+        if "scratch" in params:
+            self.scratch = Scratch(params, debug=debug)
+            # Read by every fragment: staged once, not once per job
+            self.scratch.keep(params["dem"])
+        retention, scratch = self.retention, self.scratch
+        # (message, jobs or callable planning the jobs when reached, workers)
+        stages = []
+        if "stereo" in params.keys():
+            stages.append(
+                (
+                    "Do stereo",
+                    stereo_jobs(pairs, sources, fragment, params, scratch, debug),
+                    1,
+                )
+            )
+
+        if "pc-align" in params.keys():
+            workers, threads = split_budget(
+                params, params.get("pc-align-workers", 4), len(pairs)
+            )
+            align_params = deepcopy(params)
+            align_params["pc-align"].setdefault("threads", threads)
+            jobs = []
+            for p, f in zip(pairs, fragment):
+                headers = [source_from_id(i, sources).get("mp-header", None) for i in p]
+                area, epsg = None, None
+                if None not in headers:
+                    area, epsg = intersection(headers), headers[0]["epsg"]
+                jobs.append(
+                    Job(
+                        "_".join(p),
+                        "pc-align",
+                        partial(
+                            align_fragment,
+                            params["dem"],
+                            f,
+                            f + pc_suffix,
+                            align_params,
+                            area=area,
+                            epsg=epsg,
+                            debug=debug,
+                        ),
+                    )
+                )
+            chain(stages, jobs)
+            stages.append(("align fragments", jobs, workers))
+            pc_suffix = ALIGNED_SUFFIX
 
-    if "pc-align" in params.keys():
-        logger.info("align fragments")
-        for f in fragment:
-            pc_align(
-                params["dem"], f + pc_suffix, f + "-PC_aligned.tif", params, debug=debug
+        grid = None
+        if "point2dem" in params.keys():
+            grid = dem_grid(sources, params)
+            workers, threads = split_budget(
+                params, params.get("point2dem-workers", 4), len(pairs)
             )
-        pc_suffix = "-PC_aligned.tif"
+            jobs = []
+            for p, f in zip(pairs, fragment):
+                frag_params = fragment_params(p, sources, grid, params, threads)
+                jobs.append(
+                    Job(
+                        "_".join(p),
+                        "point2dem",
+                        partial(point2dem, f + pc_suffix, f, frag_params, debug=debug),
+                    )
+                )
+            chain(stages, jobs)
+            stages.append(("rasterize fragments", jobs, workers))
+
+        # Last job of each fragment, to only release the fragments that succeeded
+        last = stages[-1][1] if len(stages) > 0 else None
+        if "dem-mosaic" in params.keys():
+            dems = [f + "-DEM.tif" for f in fragment]
+            output = output_dir + "/dem.tif"
+            if grid is not None:
+                # Fragments already on the mosaic grid: no resampling
+                params["dem-mosaic"].setdefault("t_srs", grid["t_srs"])
+                params["dem-mosaic"].setdefault("tr", grid["tr"])
+            if params.get("mosaic-tile-size", None) is not None:
+                stages.append(
+                    (
+                        "merge fragments on tiles",
+                        partial(tile_jobs, dems, output, params, debug=debug),
+                        params.get("mosaic-workers", 4),
+                    )
+                )
+                merge = Job(
+                    "dem", "dem-mosaic-join", partial(join_tiles, output, debug=debug)
+                )
+            else:
+                merge = Job(
+                    "dem",
+                    "dem-mosaic",
+                    partial(merge_fragments, dems, output, params, debug=debug),
+                )
+            if retention is not None:
+                # Fragments are released once merged
+                merge.then = partial(release, retention, fragment, output, last)
+            stages.append(("merge fragments", [merge], 1))
+        elif retention is not None and len(stages) > 0:
+            # Fragments are released after their last step
+            for j, f in zip(stages[-1][1], fragment):
+                j.then = partial(retention.submit, f)
+                if scratch is not None:
+                    j.then = partial(scratch.after, f, j.then)
+        self.fragment = fragment
+        return stages
+
+    def finish(self):
+        if "pc-align" in self.params.keys():
+            output_dir = self.params.get("output", ".")
+            write_summary(self.fragment, output_dir, debug=self.debug)
+        super().finish()
+
+
+def release(
+    retention: Retention,
+    fragment: list[str],
+    mosaic: str,
+    last: list[Job] | None = None,
+):
+    for i, f in enumerate(fragment):
+        # Failed fragments are kept as they are, to be inspected
+        if last is None or last[i].state == "done":
+            retention.submit(f)
+    retention.submit_product(mosaic)
 
-    if "point2dem" in params.keys():
-        logger.info("rasterize fragments")
-        for f in fragment:
-            point2dem(f + pc_suffix, f, params, debug=debug)
 
-    if "dem-mosaic" in params.keys():
-        logger.info("merge fragments")
-        dems = [f + "-DEM.tif" for f in fragment]
-        output = output_dir + "/dem.tif"
-        dem_mosaic(dems, output, params, debug=debug)
+def chain(stages: list, jobs: list[Job]):
+    """Make each fragment job depend on the job of the same fragment in the
+    previous stage"""
+    if len(stages) > 0:
+        for j, previous in zip(jobs, stages[-1][1]):
+            j.after.append(previous)
 
 
-def run_stereo(pairs, sources, fragment, params, debug):
-    logger.info("Do stereo")
+def merge_fragments(dems: list[str], output: str, params: dict, debug=False):
+    """Merge the fragments that were produced (failed pairs are left out)"""
+    if not debug:
+        missing = [d for d in dems if not os.path.isfile(d)]
+        for d in missing:
+            logger.warning("Fragment missing from the mosaic: {}".format(d))
+        dems = [d for d in dems if d not in missing]
+    dem_mosaic(dems, output, params, debug=debug)
+
+
+def dem_grid(sources: list[dict], params: dict) -> dict | None:
+    """Output grid shared by all the fragments: CRS, resolution and origin snapped
+    on the combined footprint of the mp images (None if they are not georeferenced)"""
+    headers = [s["mp-header"] for s in sources if "mp-header" in s]
+    if len(headers) == 0 or len(headers) < len(sources):
+        logger.warning("mp images without georeferencing, no shared DEM grid")
+        return None
+    options = params["point2dem"]
+    epsg = set([h["epsg"] for h in headers])
+    if len(epsg) != 1 or None in epsg:
+        logger.warning("mp images without a common EPSG, no shared DEM grid")
+        return None
+    t_srs = "EPSG:{}".format(epsg.pop())
+    if str(options.get("t_srs", t_srs)).replace(" ", "").upper() != t_srs:
+        # The footprints of the mp images are not in the coordinates of the DEM
+        logger.warning("point2dem t_srs differs from the mp images, no shared DEM grid")
+        return None
+    tr = options.get("tr", None)
+    if tr is None:
+        # Native resolution of the mp images
+        tr = min([abs(h["geotransform"][1]) for h in headers])
+    footprints = [bounds(h) for h in headers]
+    origin = [
+        math.floor(min([b[0] for b in footprints]) / tr) * tr,
+        math.ceil(max([b[3] for b in footprints]) / tr) * tr,
+    ]
+    logger.info("Shared DEM grid: {}, {} m, origin {}".format(t_srs, tr, origin))
+    return {"t_srs": t_srs, "tr": tr, "origin": origin}
+
+
+def snap(area: list[float], grid: dict) -> list[float]:
+    """Enlarge an area [xmin, ymin, xmax, ymax] to the closest grid lines"""
+    tr, (x0, y0) = grid["tr"], grid["origin"]
+    return [
+        x0 + math.floor((area[0] - x0) / tr) * tr,
+        y0 + math.floor((area[1] - y0) / tr) * tr,
+        x0 + math.ceil((area[2] - x0) / tr) * tr,
+        y0 + math.ceil((area[3] - y0) / tr) * tr,
+    ]
+
+
+def fragment_params(
+    pair: list[str], sources: list[dict], grid: dict | None, params: dict, threads: int
+) -> dict:
+    """point2dem parameters of a fragment: shared grid on the pair footprint"""
+    frag_params = deepcopy(params)
+    options = frag_params["point2dem"]
+    options.setdefault("threads", threads)
+    if grid is None:
+        return frag_params
+    options["t_srs"], options["tr"] = grid["t_srs"], grid["tr"]
+    if "t_projwin" not in options:
+        headers = [source_from_id(i, sources)["mp-header"] for i in pair]
+        area = intersection(headers)
+        if area is not None:
+            options["t_projwin"] = snap(area, grid)
+    return frag_params
+
+
+def stereo_jobs(pairs, sources, fragment, params, scratch, debug) -> list[Job]:
+    jobs = []
     for i, p in enumerate(pairs):
         id1, id2 = p[0], p[1]
         src1, src2 = source_from_id(id1, sources), source_from_id(id2, sources)
         mps = [src1["mp"], src2["mp"]]
         cams = [src1["cam"], src2["cam"]]
+        raws = [src1.get("pan", None), src2.get("pan", None)]
 
         if len(p) > 2:
             id3 = p[2]
             src3 = source_from_id(id3, sources)
             mps.append(src3["mp"])
             cams.append(src3["cam"])
-        stereo(mps, cams, fragment[i], params, debug=debug, dem=params["dem"])
+            raws.append(src3.get("pan", None))
+        jobs.append(
+            Job(
+                "_".join(p),
+                "stereo",
+                partial(
+                    stereo_fragment,
+                    mps,
+                    cams,
+                    fragment[i],
+                    params,
+                    raws=raws,
+                    scratch=scratch,
+                    debug=debug,
+                ),
+                megapixels=megapixels(mps[0], debug=debug),
+            )
+        )
+    return jobs
+
+
+def stereo_fragment(
+    mps: list[str],
+    cams: list[str],
+    output: str,
+    params: dict,
+    raws: list[str | None] | None = None,
+    scratch: Scratch | None = None,
+    debug=False,
+):
+    """Triangulate a fragment, on local copies of its inputs if a scratch is set,
+    with the interest point matches of its raw images if they are known"""
+    n = len(mps)
+
+    def run(inputs, local_output):
+        run_params = stereo_params(params, raws or [], output)
+        stereo(
+            inputs[:n],
+            inputs[n : 2 * n],
+            local_output,
+            run_params,
+            dem=inputs[-1],
+            debug=debug,
+        )
+
+    if scratch is None:
+        run(mps + cams + [params["dem"]], output)
+        return
+
+    scratch.run(mps + cams + [params["dem"]], output, run)
 
 
 if __name__ == "__main__":
@@ -18,11 +18,14 @@ Options:
 
 import logging
 import os
+import shutil
 from copy import deepcopy
+from functools import partial
 
 import docopt
 
-from asp import bundle_adjust, gdal_pansharp, map_project, orbit_viz, sh
+from asp import bundle_adjust, gdal_pansharp, map_project, orbit_viz
+from matches import database, seed, store
 from params import (
     DIR_BA,
     DIR_MP_MS,
@@ -36,87 +39,185 @@ from params import (
     retrieve_max2p_bbox,
     source_from_id,
 )
+from runner import TRACKER, Job, megapixels
+from scratch import Scratch
+from workflow import Workflow
 
 logger = logging.getLogger(__name__)
 
 
 def map_projection(params: dict, debug=False):
     """Core function for the Map projection Workflow"""
-    logger.info("Beginning Map Projection sequence")
-    output_dir = params.get("output", ".")
-    sources = get_sources(params)
-    if "pairs" in params:
-        pairs = get_pairs(params, ids_from_source(sources))
-    else:
-        pairs = None
-    output_ba = os.path.join(output_dir, DIR_BA)
-    output_mp_pan = os.path.join(output_dir, DIR_MP_PAN)
-    output_mp_ms = os.path.join(output_dir, DIR_MP_MS)
-    output_pansharp = os.path.join(output_dir, DIR_PANSHARP)
-    mp_pan = params.get("mp-pan", None)
-    mp_ms = params.get("mp-ms", None)
-
-    if params.get("dem", None) is None:
-        logger.info("dem is not provided in parameters")
-        if sh("my_getDemFile.py -h").returncode == 1:
-            logger.error("my_getDemFile is not available for dem retrieval")
-            raise ValueError("my_getDemFile is not available for dem retrieval")
+    MapProjection(params, debug=debug, tracker=TRACKER.current()).run()
+
+
+class MapProjection(Workflow):
+    """Map projection workflow: bundle adjustment, map projection of the P and MS
+    images, pansharpening and orbit view"""
+
+    def setup(self) -> list[tuple]:
+        logger.info("Beginning Map Projection sequence")
+        params, debug = self.params, self.debug
+        output_dir = params.get("output", ".")
+        sources = get_sources(params, debug=debug)
+        if "pairs" in params:
+            pairs = get_pairs(params, ids_from_source(sources))
         else:
-            logger.info("automatically retrieve dem using my_getDemFile")
-            params["dem"] = retrieve_dem(params, debug=debug)
-
-    dem = params["dem"]
-    got_ms = all([s.get("ms", None) is not None for s in sources])
-
-    if "bundle-adjust" in params.keys():
-        logger.info("Bundle adjust")
-        if not os.path.isdir(output_ba) or params.get("force", False):
-            run_ba(sources, pairs, params, output_ba, debug=debug)
-
-        params["map-project"]["bundle-adjust-prefix"] = output_ba
-    elif os.path.isdir(output_dir + "/BA/"):
-        params["map-project"]["bundle-adjust-prefix"] = output_ba
-
-    if mp_pan is not None:
-        logger.info("Map project Panchromatic (P) images")
-        mp_params = deepcopy(params)
-        mp_params["map-project"]["tr"] = mp_pan
-        for s in sources:
-            output = output_mp_pan + s["id"] + ".tif"
-            if not os.path.isfile(output) or params.get("force", False):
-                map_project(dem, s["pan"], s["cam"], output, mp_params, debug=debug)
-            else:
-                logger.info(f"Skipping (already exists): {s['id']}")
-        del mp_params
-
-    if mp_ms is not None and got_ms:
-        logger.info("Map project Multi Spectral (MS) images")
-        ms_params = deepcopy(params)
-        ms_params["map-project"]["tr"] = mp_ms
-        for s in sources:
-            output = output_mp_ms + s["id"] + ".tif"
-            if not os.path.isfile(output) or params.get("force", False):
-                map_project(dem, s["ms"], s["cam-ms"], output, ms_params, debug=debug)
+            pairs = None
+        output_ba = os.path.join(output_dir, DIR_BA)
+        output_mp_pan = os.path.join(output_dir, DIR_MP_PAN)
+        output_mp_ms = os.path.join(output_dir, DIR_MP_MS)
+        output_pansharp = os.path.join(output_dir, DIR_PANSHARP)
+        mp_pan = params.get("mp-pan", None)
+        mp_ms = params.get("mp-ms", None)
+
+        if params.get("dem", None) is None:
+            logger.info("dem is not provided in parameters")
+            if shutil.which("my_getDemFile.py") is None:
+                logger.error("my_getDemFile is not available for dem retrieval")
+                raise ValueError("my_getDemFile is not available for dem retrieval")
             else:
-                logger.info(f"Skipping (already exists): {s['id']}")
-        del ms_params
-
-    if "pansharpening" in params.keys():
-        logger.info("Creating pansharpened images")
-        for s in sources:
-            gdal_pansharp(
-                s["pan"],
-                s["cam"],
-                output_pansharp + s["id"] + ".tif",
-                params,
-                debug=debug,
+                logger.info("automatically retrieve dem using my_getDemFile")
+                params["dem"] = retrieve_dem(params, debug=debug)
+
+        dem = params["dem"]
+        got_ms = all([s.get("ms", None) is not None for s in sources])
+        stages = []
+
+        # Map projections are skipped if the bundle adjustment failed
+        after = []
+        if "bundle-adjust" in params.keys():
+            if not os.path.isdir(output_ba) or params.get("force", False):
+                after = [
+                    Job(
+                        "ba",
+                        "bundle-adjust",
+                        partial(run_ba, sources, pairs, params, output_ba, debug=debug),
+                    )
+                ]
+                stages.append(("Bundle adjust", after, 1))
+
+            params["map-project"]["bundle-adjust-prefix"] = output_ba
+        elif os.path.isdir(output_dir + "/BA/"):
+            params["map-project"]["bundle-adjust-prefix"] = output_ba
+
+        self.scratch = Scratch(params, debug=debug) if "scratch" in params else None
+        if self.scratch is not None:
+            # Read by every map projection: staged once, not once per job
+            self.scratch.keep(dem)
+        mp_jobs = []
+        if mp_pan is not None:
+            mp_params = deepcopy(params)
+            mp_params["map-project"]["tr"] = mp_pan
+            for s in sources:
+                output = output_mp_pan + s["id"] + ".tif"
+                if not os.path.isfile(output) or params.get("force", False):
+                    mp_jobs.append(
+                        Job(
+                            s["id"],
+                            "map-project",
+                            partial(
+                                map_project_image,
+                                dem,
+                                s["pan"],
+                                s["cam"],
+                                output,
+                                mp_params,
+                                scratch=self.scratch,
+                                debug=debug,
+                            ),
+                            megapixels=megapixels(s["pan"], debug=debug),
+                            after=after,
+                        )
+                    )
+                else:
+                    logger.info(f"Skipping (already exists): {s['id']}")
+        stages.append(("Map project Panchromatic (P) images", mp_jobs, 1))
+
+        ms_jobs = []
+        if mp_ms is not None and got_ms:
+            ms_params = deepcopy(params)
+            ms_params["map-project"]["tr"] = mp_ms
+            for s in sources:
+                output = output_mp_ms + s["id"] + ".tif"
+                if not os.path.isfile(output) or params.get("force", False):
+                    ms_jobs.append(
+                        Job(
+                            s["id"],
+                            "map-project-ms",
+                            partial(
+                                map_project_image,
+                                dem,
+                                s["ms"],
+                                s["cam-ms"],
+                                output,
+                                ms_params,
+                                scratch=self.scratch,
+                                debug=debug,
+                            ),
+                            megapixels=megapixels(s["ms"], debug=debug),
+                            after=after,
+                        )
+                    )
+                else:
+                    logger.info(f"Skipping (already exists): {s['id']}")
+        stages.append(("Map project Multi Spectral (MS) images", ms_jobs, 1))
+
+        if "pansharpening" in params.keys():
+            jobs = [
+                Job(
+                    s["id"],
+                    "pansharpening",
+                    partial(
+                        gdal_pansharp,
+                        s["pan"],
+                        s["cam"],
+                        output_pansharp + s["id"] + ".tif",
+                        params,
+                        debug=debug,
+                    ),
+                )
+                for s in sources
+            ]
+            stages.append(("Creating pansharpened images", jobs, 1))
+
+        if "orbitviz" in params.keys():
+            imgs = [s["pan"] for s in sources]
+            cams = [s["cam"] for s in sources]
+            job = Job(
+                "orbits",
+                "orbitviz",
+                partial(
+                    orbit_viz,
+                    imgs,
+                    cams,
+                    output_dir + "/orbits.kml",
+                    params,
+                    debug=debug,
+                ),
             )
+            stages.append(("Generating orbit view (KML)", [job], 1))
+        return stages
 
-    if "orbitviz" in params.keys():
-        logger.info("Generating orbit view (KML)")
-        imgs = [s["pan"] for s in sources]
-        cams = [s["cam"] for s in sources]
-        orbit_viz(imgs, cams, output_dir + "/orbits.kml", params, debug=debug)
+
+def map_project_image(
+    dem: str,
+    image: str,
+    cam: str,
+    output: str,
+    params: dict,
+    scratch: Scratch | None = None,
+    debug=False,
+):
+    """Map project an image, on local copies of its inputs if a scratch is set"""
+    if scratch is None:
+        map_project(dem, image, cam, output, params, debug=debug)
+    else:
+        scratch.run(
+            [dem, image, cam],
+            output,
+            lambda i, o: map_project(i[0], i[1], i[2], o, params, debug=debug),
+        )
 
 
 def run_ba(sources, pairs, params, output_ba, debug=False):
@@ -126,7 +227,7 @@ def run_ba(sources, pairs, params, output_ba, debug=False):
         imgs = [s["pan"] for s in sources]
         cams = [s["cam"] for s in sources]
         parallel = len(imgs) > 3
-        bundle_adjust(imgs, cams, output_ba, params, parallel=parallel, debug=debug)
+        adjust(imgs, cams, output_ba, params, parallel=parallel, debug=debug)
     else:
         # pairs are given, do bundle adjust per pair
         for p in pairs:
@@ -140,7 +241,20 @@ def run_ba(sources, pairs, params, output_ba, debug=False):
                 src3 = source_from_id(id3, sources)
                 imgs.append(src3["pan"])
                 cams.append(src3["cam"])
-                bundle_adjust(imgs, cams, output_ba, params, debug=debug)
+                adjust(imgs, cams, output_ba, params, debug=debug)
+
+
+def adjust(imgs, cams, output_ba, params, parallel=False, debug=False):
+    """Bundle adjust images, computing only the matches missing from the database"""
+    prefix = database(params)
+    if prefix is not None:
+        seed(prefix, output_ba, imgs, params, debug=debug)
+        # Linked matches keep the date of the database
+        params = deepcopy(params)
+        params["bundle-adjust"]["force-reuse-match-files"] = True
+    bundle_adjust(imgs, cams, output_ba, params, parallel=parallel, debug=debug)
+    if prefix is not None:
+        store(output_ba, prefix, imgs, params, debug=debug)
 
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ Need from the parameter file:
 * stereo > pairs: text list of pairs to process (one pair per line, space separated id)
 * stereo > cmd: parameters needed by the stereo command
 * corr-eval: add to compute the normalized cross-correlation (ncc metric)
+* sar: add to correlate the log-amplitude of SAR amplitude images (see `sar`)
+* image-cache: add to normalize each image once for all its pairs (see `imagecache`)
 
 Usage:
     asp_pt.py <toml> [--debug | -d]
@@ -19,12 +21,19 @@ Options:
 """
 
 import logging
+import math
 import os
+from copy import deepcopy
+from functools import partial
 from shutil import copyfile
 
 import docopt
 
 from asp import corr_eval, image_align, stereo
+from dispfilter import FILTERED_SUFFIX, filter_disparity
+from displacement import DISPLACEMENT_SUFFIX, displacement, pair_delays
+from geotiff import aligned_windows, pixel_offset
+from imagecache import cache_sources
 from params import (
     DIR_ALIGNED,
     DIR_STEREO,
@@ -35,8 +44,16 @@ from params import (
     ids_from_source,
     make_full_pairs,
     parse_params,
+    read_mp_headers,
     source_from_id,
 )
+from prepass import prepass, read_corr_search
+from retention import Retention
+from sar import sar_sources
+from scratch import Scratch
+from vrt import crop_vrt
+from runner import TRACKER, Job, megapixels
+from workflow import Workflow
 
 logger = logging.getLogger(__name__)
 
@@ -51,45 +68,81 @@ def corr_eval_ncc(stereo_output: str, params: dict, debug=False):
 
 def pixel_tracking(params: dict, debug=False):
     """Beginning Pixel Tracking sequence"""
-    logger.info("Initializing pixel tracking")
-    output_dir = params.get("output", ".")
-    sources = get_sources(params, first=2)
-    ids = ids_from_source(sources)
-    if params.get("pairs", None) is not None:
-        pairs = get_pairs(params, ids, first=2)
-    else:
-        pairs = make_full_pairs(ids)
-    sources = check_for_mp(sources, output_dir)
-    if sources is None:
-        raise ValueError("No map projected images defined or no previous mp run found")
-    aligned = None
-    if params.get("force", False):
-        logger.info("Force mode: every pair will be recomputed even if already exists")
-
-    if "align" in params.keys():
-        raise NotImplementedError("feature might not be kept")
-        logger.info("Launching image alignment")
-        aligned = {sources[0]["id"]: DIR_ALIGNED + os.path.basename(sources[0]["mp"])}
-        if not debug:
-            copyfile(sources[0]["mp"], DIR_ALIGNED + os.path.basename(sources[0]["mp"]))
-
-        for s in sources[1:]:
-            output = os.path.join(output_dir, DIR_ALIGNED + os.path.basename(s["mp"]))
-            image_align(
-                sources[0]["mp"],
-                s["mp"],
-                DIR_ALIGNED + os.path.basename(s["mp"]),
-                params,
-                debug=debug,
+    PixelTracking(params, debug=debug, tracker=TRACKER.current()).run()
+
+
+class PixelTracking(Workflow):
+    """Pixel tracking workflow: pre-pass, stereo (correlation) and NCC of each pair"""
+
+    def setup(self) -> list[tuple]:
+        logger.info("Initializing pixel tracking")
+        params, debug = self.params, self.debug
+        output_dir = params.get("output", ".")
+        sources = get_sources(params, first=2, debug=debug)
+        ids = ids_from_source(sources)
+        if params.get("pairs", None) is not None:
+            pairs = get_pairs(params, ids, first=2)
+        else:
+            pairs = make_full_pairs(ids)
+        sources = check_for_mp(sources, output_dir)
+        if sources is None:
+            raise ValueError(
+                "No map projected images defined or no previous mp run found"
             )
-            aligned[s["id"]] = DIR_ALIGNED + os.path.basename(s["mp"])
+        sar_jobs = []
+        if "sar" in params.keys():
+            sar_jobs = sar_sources(sources, params, output_dir, debug=debug)
+        sources = read_mp_headers(sources)
+        cache_jobs = []
+        if "image-cache" in params.keys():
+            cache_jobs = cache_sources(
+                sources, params, output_dir, sar_jobs, debug=debug
+            )
+            # Pairs are correlated on the normalized images of the cache
+            params.setdefault("stereo", {})["skip-image-normalization"] = True
+        aligned = None
+        if params.get("force", False):
+            logger.info(
+                "Force mode: every pair will be recomputed even if already exists"
+            )
+
+        if "align" in params.keys():
+            raise NotImplementedError("feature might not be kept")
+            logger.info("Launching image alignment")
+            aligned = {
+                sources[0]["id"]: DIR_ALIGNED + os.path.basename(sources[0]["mp"])
+            }
+            if not debug:
+                copyfile(
+                    sources[0]["mp"], DIR_ALIGNED + os.path.basename(sources[0]["mp"])
+                )
 
-    if "stereo" in params.keys():
-        logger.info("Launching stereo")
+            for s in sources[1:]:
+                output = os.path.join(
+                    output_dir, DIR_ALIGNED + os.path.basename(s["mp"])
+                )
+                image_align(
+                    sources[0]["mp"],
+                    s["mp"],
+                    DIR_ALIGNED + os.path.basename(s["mp"]),
+                    params,
+                    debug=debug,
+                )
+                aligned[s["id"]] = DIR_ALIGNED + os.path.basename(s["mp"])
+
+        if "retention" in params:
+            self.retention = Retention(params, debug=debug)
+        if "scratch" in params:
+            self.scratch = Scratch(params, debug=debug)
+        retention, scratch = self.retention, self.scratch
+        prepass_jobs, stereo_jobs, ncc_jobs, filter_jobs, disp_jobs = [], [], [], [], []
+        if "displacement" in params.keys():
+            delays = pair_delays(params, pairs)
         for p in pairs:
             id1, id2 = p[0], p[1]
-            logger.debug("Stereo pair: {} - {}".format(id1, id2))
             src1, src2 = source_from_id(id1, sources), source_from_id(id2, sources)
+            # The pair waits for the preprocessing of its images
+            needs = [j for j in sar_jobs + cache_jobs if j.name in [id1, id2]]
             if aligned is not None:
                 imgs = [aligned[id1], aligned[id2]]
             else:
@@ -97,42 +150,242 @@ def pixel_tracking(params: dict, debug=False):
             output = os.path.join(
                 output_dir, DIR_STEREO, id1 + "_" + id2 + "/" + PREF_STEREO
             )
-            outfile = os.path.join(
-                output_dir, DIR_STEREO, id1 + "_" + id2 + "/" + PREF_STEREO + "-F.tif"
+            size = megapixels(imgs[0], debug=debug) or src1.get("megapixels", None)
+            last = None
+            # Crops of a previous run (or aligned images) share their ground grid
+            crop = os.path.join(os.path.dirname(output), "crop-{}.vrt".format(id1))
+            offset = grid_offset(
+                src1, src2, aligned=aligned is not None, cropped=os.path.isfile(crop)
             )
-            # if not os.path.isdir(output) or params.get("force", False):
-            if not os.path.isfile(outfile) or params.get("force", False):
-                use_params = params
-                if params.get("correct-corr-search", False):
-                    use_params = correct_corr_search(params.copy(), src1, src2)
-                stereo(imgs, None, output, use_params, debug=debug)
-            else:
-                logger.info(f"Skipping (already exists): {id1}-{id2}")
 
-    if "corr-eval" in params.keys():
-        logger.info("Launching correlation evaluation (ncc)")
-        for p in pairs:
-            id1, id2 = p[0], p[1]
-            output = os.path.join(
-                output_dir, DIR_STEREO, id1 + "_" + id2 + "/" + PREF_STEREO
-            )
-            if not os.path.isfile(output + "-ncc.tif") or params.get("force", False):
-                corr_eval_ncc(output, params, debug=debug)
-            else:
-                logger.info(f"Skipping NCC (already exists): {id1}-{id2}")
+            if "stereo" in params.keys():
+                logger.debug("Stereo pair: {} - {}".format(id1, id2))
+                # if not os.path.isdir(output) or params.get("force", False):
+                if not os.path.isfile(output + "-F.tif") or params.get("force", False):
+                    cropped = False
+                    if params.get("crop-intersection", False) and aligned is None:
+                        crops = crop_intersection(src1, src2, output, debug=debug)
+                        if crops is not None:
+                            imgs, cropped = crops, True
+                    offset = grid_offset(
+                        src1, src2, aligned=aligned is not None, cropped=cropped
+                    )
+                    # Same search for the pre-pass and the default of the stereo
+                    pair_params = params
+                    if params.get("correct-corr-search", False):
+                        pair_params = correct_corr_search(
+                            deepcopy(params), offset, output
+                        )
+                    if "prepass" in params and (
+                        read_corr_search(output) is None or params.get("force", False)
+                    ):
+                        factor = params["prepass"].get("factor", 8)
+                        prepass_jobs.append(
+                            Job(
+                                id1 + "_" + id2,
+                                "prepass",
+                                partial(
+                                    prepass, imgs, output, pair_params, debug=debug
+                                ),
+                                megapixels=None if size is None else size / factor**2,
+                                after=needs,
+                            )
+                        )
+                    last = Job(
+                        id1 + "_" + id2,
+                        "stereo",
+                        partial(
+                            stereo_pair,
+                            imgs,
+                            output,
+                            pair_params,
+                            scratch=scratch,
+                            debug=debug,
+                        ),
+                        megapixels=size,
+                        after=needs,
+                    )
+                    stereo_jobs.append(last)
+                else:
+                    logger.info(f"Skipping (already exists): {id1}-{id2}")
+
+            if "corr-eval" in params.keys():
+                if not os.path.isfile(output + "-ncc.tif") or params.get(
+                    "force", False
+                ):
+                    last = Job(
+                        id1 + "_" + id2,
+                        "corr-eval",
+                        partial(corr_eval_ncc, output, params, debug=debug),
+                        megapixels=size,
+                        after=[] if last is None else [last],
+                    )
+                    ncc_jobs.append(last)
+                else:
+                    logger.info(f"Skipping NCC (already exists): {id1}-{id2}")
+
+            if "disparity-filter" in params.keys():
+                if not os.path.isfile(output + FILTERED_SUFFIX) or params.get(
+                    "force", False
+                ):
+                    last = Job(
+                        id1 + "_" + id2,
+                        "disparity-filter",
+                        partial(filter_disparity, output, params, debug=debug),
+                        megapixels=size,
+                        after=[] if last is None else [last],
+                    )
+                    filter_jobs.append(last)
+                else:
+                    logger.info(f"Skipping filter (already exists): {id1}-{id2}")
+
+            if "displacement" in params.keys():
+                if not os.path.isfile(output + DISPLACEMENT_SUFFIX) or params.get(
+                    "force", False
+                ):
+                    last = Job(
+                        id1 + "_" + id2,
+                        "displacement",
+                        partial(
+                            displacement,
+                            output,
+                            params,
+                            delays[id1 + "_" + id2],
+                            offset=offset,
+                            debug=debug,
+                        ),
+                        megapixels=size,
+                        after=[] if last is None else [last],
+                    )
+                    disp_jobs.append(last)
+                else:
+                    logger.info(f"Skipping displacement (already exists): {id1}-{id2}")
+
+            if retention is not None:
+                # Intermediate files are released after the last step of the pair
+                if last is None:
+                    # Nothing left to run: released by run, never by the planning
+                    self.released.append(output)
+                elif scratch is not None:
+                    # Once the stereo outputs are back from the scratch
+                    last.then = partial(
+                        scratch.after, output, partial(retention.submit, output)
+                    )
+                else:
+                    last.then = partial(retention.submit, output)
+
+        workers = params["prepass"].get("workers", 4) if "prepass" in params else 1
+        return [
+            ("Preprocessing the SAR images", sar_jobs, 1),
+            (
+                "Normalizing the images",
+                cache_jobs,
+                params.get("image-cache", {}).get("workers", 4),
+            ),
+            ("Launching coarse pre-pass", prepass_jobs, workers),
+            ("Launching stereo", stereo_jobs, 1),
+            ("Launching correlation evaluation (ncc)", ncc_jobs, 1),
+            (
+                "Filtering the disparities",
+                filter_jobs,
+                params.get("disparity-filter", {}).get("workers", 4),
+            ),
+            (
+                "Converting the disparities into displacements",
+                disp_jobs,
+                params.get("displacement", {}).get("workers", 4),
+            ),
+        ]
+
+
+def stereo_pair(
+    imgs: list[str],
+    output: str,
+    params: dict,
+    scratch: Scratch | None = None,
+    debug=False,
+):
+    """Correlate a pair, with the corr-search derived by the pre-pass if any"""
+    use_params = params
+    corr_search = read_corr_search(output)
+    if corr_search is not None:
+        use_params = deepcopy(params)
+        use_params["stereo"]["corr-search"] = corr_search
+    if scratch is None:
+        stereo(imgs, None, output, use_params, debug=debug)
+    else:
+        scratch.run(
+            imgs, output, lambda i, o: stereo(i, None, o, use_params, debug=debug)
+        )
+
+
+def crop_intersection(
+    src1: dict, src2: dict, output: str, debug=False
+) -> list[str] | None:
+    """Virtual crops of the two images of a pair on their intersection, with their
+    origins on the same ground pixel (None if the grids cannot be aligned)"""
+    header1, header2 = src1.get("mp-header", None), src2.get("mp-header", None)
+    if header1 is None or header2 is None:
+        logger.warning("Cannot crop, no georeferencing: {}".format(output))
+        return None
+    aligned = aligned_windows(header1, header2)
+    if aligned is None:
+        logger.warning("Cannot crop, no overlap or distinct grids: {}".format(output))
+        return None
+    windows = aligned[0]
+    folder = os.path.dirname(output)
+    crops = [
+        os.path.join(folder, "crop-{}.vrt".format(src1["id"])),
+        os.path.join(folder, "crop-{}.vrt".format(src2["id"])),
+    ]
+    if not debug:
+        os.makedirs(folder, exist_ok=True)
+        crop_vrt(header1, windows[0], crops[0])
+        crop_vrt(header2, windows[1], crops[1])
+    return crops
+
+
+def grid_offset(src1: dict, src2: dict, aligned=False, cropped=False) -> tuple | None:
+    """Disparity of a motion-free ground between the images of a pair, from the
+    offset between their grids (none for aligned images, the fractional remainder
+    for aligned crops, None if unknown)"""
+    if aligned:
+        return 0.0, 0.0
+    header1, header2 = src1.get("mp-header", None), src2.get("mp-header", None)
+    if (
+        header1 is None
+        or header2 is None
+        or None
+        in [
+            header1["geotransform"],
+            header2["geotransform"],
+        ]
+    ):
+        return None
+    if cropped:
+        windows = aligned_windows(header1, header2)
+        return None if windows is None else windows[1]
+    return pixel_offset(header1, header2)
 
 
-def correct_corr_search(params, src1, src2):
-    res = params["mp-pan"]
-    delta_ulx = (src1["ulx"] - src2["ulx"]) / res
-    delta_uly = (src1["uly"] - src2["uly"]) / res
+def correct_corr_search(params, offset, output):
+    """Shift the corr-search by the disparity expected from the offset between the
+    grids of the two images"""
+    if offset is None:
+        logger.warning(
+            "No georeferencing, corr-search is not corrected: {}".format(output)
+        )
+        return params
+    corr_search = params["stereo"].get("corr-search", None)
+    if corr_search is None:
+        return params
+    delta_x, delta_y = offset
     # corr-search is min_x min_y max_x max_y
-    corr_search = params["stereo"]["corr-search"]
     params["stereo"]["corr-search"] = [
-        corr_search[0] - delta_ulx,
-        corr_search[1] - delta_uly,
-        corr_search[2] - delta_ulx,
-        corr_search[3] - delta_uly,
+        math.floor(corr_search[0] + delta_x),
+        math.floor(corr_search[1] + delta_y),
+        math.ceil(corr_search[2] + delta_x),
+        math.ceil(corr_search[3] + delta_y),
     ]
     return params
 
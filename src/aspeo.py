@@ -11,16 +11,25 @@ parameter file.
 * mp: map-project the source images
 * pt: perform pixel-tracking onto the pairs of images
 * dsm: compute a digital surface model from stereo images
+* batch: run a workflow on many projects sharing the same workers
+* sweep: search the stereo parameters on crops of a few pairs
+* watch: process the new acquisitions of the source folder as they arrive
 
 Usage:
     aspeo.py
     aspeo.py -h | --help
     aspeo.py new [<preset>] [--path <path>] [-v | --verbose]
     aspeo.py (mp | dsm | pt) <toml> [--debug | -d] [-v | --verbose]
+    aspeo.py batch (mp | dsm | pt) <tomls>... [--workers <n>] [--debug | -d] [-v | --verbose]
+    aspeo.py sweep <toml> [--debug | -d] [-v | --verbose]
+    aspeo.py watch <toml> [--once] [--debug | -d] [-v | --verbose]
 
 Options:
     -h --help         Display command details
     <toml>              Path to the parameter file (toml)
+    <tomls>             Parameter files or folders of parameter files
+    --workers <n>     Jobs run simultaneously over all the projects [default: 4]
+    --once            Process the new acquisitions once instead of polling
     -d --debug        Display ASP commands instead of running them
     -v --verbose      Display logger messages to console
 
@@ -31,6 +40,9 @@ from asp_pt import pixel_tracking
 from asp_mp import map_projection
 from asp_new import generate_toml, VERSION
 from asp_dsm import dsm_generation
+from batch import batch
+from sweep import Sweep
+from watch import watch
 import docopt
 import logging
 
@@ -45,6 +57,28 @@ def resolve_cli(arguments):
             preset = "default"
         generate_toml(preset, path=path)
 
+    elif arguments["batch"]:
+        workflow = [w for w in ["mp", "pt", "dsm"] if arguments[w]][0]
+        debug = arguments["--debug"]
+        batch(
+            workflow,
+            arguments["<tomls>"],
+            workers=int(arguments["--workers"]),
+            debug=debug,
+        )
+
+    elif arguments["sweep"]:
+        toml = arguments["<toml>"]
+        debug = arguments["--debug"]
+        params = parse_params(toml)
+        Sweep(params, debug=debug).run()
+
+    elif arguments["watch"]:
+        toml = arguments["<toml>"]
+        debug = arguments["--debug"]
+        params = parse_params(toml)
+        watch(params, once=arguments["--once"], debug=debug)
+
     elif arguments["pt"]:
         toml = arguments["<toml>"]
         debug = arguments["--debug"]
@@ -0,0 +1,92 @@
+"""
+Batch mode: several projects sharing one worker pool
+
+Each project (parameter file) is driven by its own thread running the workflow, with
+its own tracker and status file. Instead of running its jobs itself, every project
+queues them into one shared scheduler, so that the workers stay busy until the last
+project is done. The in-process caches (GeoTIFF headers, retrieved DEMs) are shared
+by all the projects.
+
+Global parameters of the parameter files:
+* batch-priority: projects with a higher priority are served first (default 0)
+* batch-weight: share of the workers relative to the other projects (default 1)
+"""
+
+import glob
+import logging
+import os
+import threading
+
+from asp_dsm import dsm_generation
+from asp_mp import map_projection
+from asp_pt import pixel_tracking
+from params import parse_params
+from runner import TRACKER, Scheduler, Tracker, use_scheduler
+
+logger = logging.getLogger(__name__)
+
+WORKFLOWS = {"mp": map_projection, "pt": pixel_tracking, "dsm": dsm_generation}
+
+
+def expand_tomls(paths: list[str]) -> list[str]:
+    """Parameter files given directly or as folders of toml files"""
+    tomls = []
+    for p in paths:
+        if os.path.isdir(p):
+            tomls += sorted(glob.glob(os.path.join(p, "*.toml")))
+        else:
+            tomls.append(p)
+    return tomls
+
+
+def batch(workflow: str, paths: list[str], workers: int = 4, debug=False) -> dict:
+    """Run a workflow on many projects with a shared scheduler
+
+    :returns failed: dict toml > error of the projects that did not complete
+    """
+    tomls = expand_tomls(paths)
+    logger.info(
+        "Batch {} of {} projects on {} workers".format(workflow, len(tomls), workers)
+    )
+    scheduler = Scheduler(workers)
+    use_scheduler(scheduler)
+    failed = {}
+    threads = []
+    for toml in tomls:
+        params = parse_params(toml)
+        name = params.get("name", os.path.splitext(os.path.basename(toml))[0])
+        tracker = Tracker(name)
+        scheduler.register(
+            tracker,
+            weight=params.get("batch-weight", 1.0),
+            priority=params.get("batch-priority", 0),
+        )
+        thread = threading.Thread(
+            target=run_project,
+            args=(WORKFLOWS[workflow], params, tracker, toml, failed, debug),
+        )
+        thread.start()
+        threads.append(thread)
+    for t in threads:
+        t.join()
+    use_scheduler(None)
+    scheduler.close()
+
+    if len(failed) > 0:
+        for toml, error in failed.items():
+            logger.error("Project failed: {} ({})".format(toml, error))
+    logger.info(
+        "Batch done: {}/{} projects".format(len(tomls) - len(failed), len(tomls))
+    )
+    return failed
+
+
+def run_project(
+    func, params: dict, tracker: Tracker, toml: str, failed: dict, debug=False
+):
+    TRACKER.bind(tracker)
+    try:
+        func(params, debug=debug)
+    except Exception as e:
+        logger.exception("Project {} stopped".format(toml))
+        failed[toml] = e
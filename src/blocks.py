@@ -0,0 +1,199 @@
+"""
+Blockwise processing of rasters with NumPy memory maps
+
+Inputs are read through a memory map: uncompressed GeoTIFF with contiguous strips
+are mapped in place, other rasters (tiled, compressed, COG) are first unpacked by
+`gdal_translate` into a raw file next to the output. Outputs are written into a raw
+memory map, exposed by a VRT with the georeferencing of the input, and packed into a
+tiled and compressed GeoTIFF. Processing goes block by block, each block being read
+with a margin so that window filters see the neighbours of the border pixels.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from asp import sh
+from geotiff import read_header
+from vrt import raw_vrt
+
+logger = logging.getLogger(__name__)
+
+# ENVI "data type" > NumPy dtype
+ENVI_TYPES = {
+    1: "uint8",
+    2: "int16",
+    3: "int32",
+    4: "float32",
+    5: "float64",
+    12: "uint16",
+    13: "uint32",
+    14: "int64",
+    15: "uint64",
+}
+
+
+class Raster:
+    """Memory map of a raster, as an array (bands, height, width)"""
+
+    def __init__(self, path: str, workdir: str, debug=False):
+        self.path = path
+        self.header = read_header(path)
+        self.raw = None
+        self.data = mapped_tiff(self.header)
+        if self.data is None:
+            self.raw = unpack(path, workdir, debug=debug)
+            self.data = mapped_raw(self.raw)
+        self.width, self.height = self.header["width"], self.header["height"]
+
+    def srs(self) -> str | None:
+        epsg = self.header["epsg"]
+        return None if epsg is None else "EPSG:{}".format(epsg)
+
+    def close(self):
+        """Release the map and the unpacked copy"""
+        self.data = None
+        if self.raw is not None:
+            remove_raw(self.raw)
+
+
+def mapped_tiff(header: dict) -> np.ndarray | None:
+    """Map an uncompressed GeoTIFF with contiguous strips (None if not possible)"""
+    offsets, counts = header["offsets"], header["bytecounts"]
+    if (
+        header["compression"] != 1
+        or header["tiled"]
+        or header["dtype"] is None
+        or offsets is None
+        or counts is None
+    ):
+        return None
+    if any([offsets[i + 1] != offsets[i] + counts[i] for i in range(len(counts) - 1)]):
+        return None
+    dtype = np.dtype(header["dtype"]).newbyteorder(header["byteorder"])
+    bands, height, width = header["bands"], header["height"], header["width"]
+    if header["planar"] == 1:
+        shape = (height, width, bands)
+    else:
+        shape = (bands, height, width)
+    if sum(counts) < np.prod(shape) * dtype.itemsize:
+        return None
+    data = np.memmap(
+        header["path"], dtype=dtype, mode="r", offset=offsets[0], shape=shape
+    )
+    return data.transpose(2, 0, 1) if header["planar"] == 1 else data
+
+
+def unpack(path: str, workdir: str, debug=False) -> str:
+    """Unpack a raster into a raw band sequential file (ENVI)"""
+    os.makedirs(workdir, exist_ok=True)
+    raw = os.path.join(workdir, os.path.splitext(os.path.basename(path))[0] + ".raw")
+    cmd = ["gdal_translate", "-of", "ENVI", "-co", "INTERLEAVE=BSQ", path, raw]
+    sh(cmd, debug=debug)
+    return raw
+
+
+def mapped_raw(raw: str) -> np.ndarray:
+    """Map a raw band sequential file described by its ENVI header"""
+    fields = {}
+    with open(os.path.splitext(raw)[0] + ".hdr", "r") as infile:
+        for line in infile:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                fields[key.strip().lower()] = value.strip()
+    dtype = np.dtype(ENVI_TYPES[int(fields["data type"])])
+    dtype = dtype.newbyteorder(">" if fields.get("byte order", "0") == "1" else "<")
+    shape = (int(fields["bands"]), int(fields["lines"]), int(fields["samples"]))
+    offset = int(fields.get("header offset", "0"))
+    return np.memmap(raw, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def remove_raw(raw: str):
+    """Remove a raw file with its ENVI header and GDAL side-car (if any)"""
+    hdr = os.path.splitext(raw)[0] + ".hdr"
+    for path in [raw, hdr, raw + ".aux.xml"]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def create_raw(raw: str, bands: int, height: int, width: int, dtype: str):
+    """Raw band sequential output, little-endian"""
+    os.makedirs(os.path.dirname(os.path.abspath(raw)), exist_ok=True)
+    return np.memmap(
+        raw,
+        dtype=np.dtype(dtype).newbyteorder("<"),
+        mode="w+",
+        shape=(bands, height, width),
+    )
+
+
+def pack(
+    raw: str,
+    output: str,
+    reference: Raster,
+    bands: int,
+    dtype: str,
+    nodata: float | None = None,
+    scale: list[int] | None = None,
+    debug=False,
+):
+    """Write a raw output as a tiled compressed GeoTIFF georeferenced like the
+    reference, and remove the raw file (even if the packing fails)
+
+    :param scale: [x, y] pixels of the reference per output pixel (e.g multilook)
+    """
+    vrt = os.path.splitext(raw)[0] + ".vrt"
+    if not debug:
+        sx, sy = [1, 1] if scale is None else scale
+        gt = reference.header["geotransform"]
+        if gt is not None:
+            gt = [gt[0], gt[1] * sx, gt[2] * sy, gt[3], gt[4] * sx, gt[5] * sy]
+        raw_vrt(
+            vrt,
+            raw,
+            [reference.width // sx, reference.height // sy],
+            bands,
+            dtype,
+            geotransform=gt,
+            srs=reference.srs(),
+            nodata=nodata,
+        )
+    tmp = output + ".part.tif"
+    cmd = ["gdal_translate", "-of", "GTiff", "-co", "TILED=YES"]
+    cmd += ["-co", "COMPRESS=DEFLATE", "-co", "BIGTIFF=IF_SAFER", vrt, tmp]
+    try:
+        sh(cmd, debug=debug)
+        if not debug:
+            os.replace(tmp, output)
+    finally:
+        if not debug:
+            for path in [vrt, tmp]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            remove_raw(raw)
+
+
+def blocks(width: int, height: int, size: int, margin: int = 0):
+    """Blocks covering a raster: (core, padded) windows [xoff, yoff, xsize, ysize],
+    the padded window enlarging the core by the margin inside the raster"""
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            core = [x, y, min(size, width - x), min(size, height - y)]
+            x0, y0 = max(x - margin, 0), max(y - margin, 0)
+            x1 = min(x + core[2] + margin, width)
+            y1 = min(y + core[3] + margin, height)
+            yield core, [x0, y0, x1 - x0, y1 - y0]
+
+
+def read_block(data: np.ndarray, window: list[int]) -> np.ndarray:
+    """Copy of a window of a mapped array (bands, height, width), in native order"""
+    x, y, w, h = window
+    block = data[:, y : y + h, x : x + w]
+    return np.asarray(block, dtype=block.dtype.newbyteorder("="))
+
+
+def inner(block: np.ndarray, core: list[int], padded: list[int]) -> np.ndarray:
+    """Core part of an array computed on a padded window"""
+    dx, dy = core[0] - padded[0], core[1] - padded[1]
+    return block[..., dy : dy + core[3], dx : dx + core[2]]
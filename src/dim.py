@@ -0,0 +1,172 @@
+"""
+Lightweight reader of the Pléiades DIMAP metadata (DIM)
+
+The DIM is streamed with `iterparse`: only the elements used by aspeo are kept, the
+others are freed as soon as they are read, so that the large geometric sections are
+never held in memory. The parsing stops once everything is found, which is rare (the
+acquisition date is in the last section and some fields are optional). Records are
+memoized in the process, keyed by path and modification time, so that no DIM is
+parsed twice.
+"""
+
+import os
+import threading
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+# Path of the element (from the root) > (field, attribute or None for the text)
+FIELDS = {
+    "Metadata_Identification/METADATA_FORMAT": ("dim_version", "version"),
+    "Dataset_Identification/DATASET_NAME": ("dataset_name", None),
+    "Dataset_Identification/Legal_Constraints/COPYRIGHT": ("copyright", None),
+    "Dataset_Content/SURFACE_AREA": ("area", None),
+    "Dataset_Content/CLOUD_COVERAGE": ("cloud", None),
+    "Dataset_Content/SNOW_COVERAGE": ("snow", None),
+    "Product_Information/Delivery_Identification/JOB_ID": ("job_id", None),
+    "Geoposition/Geoposition_Models/Rational_Function_Model/Component/COMPONENT_PATH": (
+        "rpc_path",
+        "href",
+    ),
+    "Raster_Data/Raster_Dimensions/NROWS": ("nrows", None),
+    "Raster_Data/Raster_Dimensions/NCOLS": ("ncols", None),
+    "Raster_Data/Raster_Dimensions/NBANDS": ("nbands", None),
+    "Raster_Data/Raster_Dimensions/Tile_Set/Regular_Tiling/OVERLAP_ROW": (
+        "overlap_row",
+        None,
+    ),
+    "Raster_Data/Raster_Dimensions/Tile_Set/Regular_Tiling/OVERLAP_COL": (
+        "overlap_col",
+        None,
+    ),
+    "Raster_Data/Raster_Encoding/DATA_TYPE": ("data_type", None),
+    "Raster_Data/Raster_Encoding/NBITS": ("nbits", None),
+    "Raster_Data/Raster_Encoding/SIGN": ("sign", None),
+    "Dataset_Sources/Source_Identification/Strip_Source/IMAGING_DATE": (
+        "imaging_date",
+        None,
+    ),
+    "Dataset_Sources/Source_Identification/Strip_Source/IMAGING_TIME": (
+        "imaging_time",
+        None,
+    ),
+}
+TILE_SIZE = "Raster_Data/Raster_Dimensions/Tile_Set/Regular_Tiling/NTILES_SIZE"
+VERTEX = "Dataset_Content/Dataset_Extent/Vertex"
+EXTENT = "Dataset_Content/Dataset_Extent"
+DATA_FILE = "Raster_Data/Data_Access/Data_Files/Data_File"
+DATA_FILES = "Raster_Data/Data_Access/Data_Files"
+# Elements whose subtree is needed when they end
+KEPT = [VERTEX, DATA_FILE]
+INTEGERS = ["nrows", "ncols", "nbands", "nbits", "overlap_row", "overlap_col"]
+
+
+@dataclass(frozen=True, slots=True)
+class DimRecord:
+    """Metadata of a Pléiades delivery
+
+    extent: (lon, lat, col, row) of the vertices of the footprint
+    tiles: (path relative to the DIM, row, col) of each data file (1-based tiles)
+    """
+
+    path: str
+    dim_version: str | None = None
+    dataset_name: str | None = None
+    copyright: str | None = None
+    area: str | None = None
+    cloud: str | None = None
+    snow: str | None = None
+    job_id: str | None = None
+    rpc_path: str | None = None
+    nrows: int | None = None
+    ncols: int | None = None
+    nbands: int | None = None
+    data_type: str | None = None
+    nbits: int | None = None
+    sign: str | None = None
+    imaging_date: str | None = None
+    imaging_time: str | None = None
+    tile_size: tuple[int, int] | None = None
+    overlap_row: int | None = None
+    overlap_col: int | None = None
+    extent: tuple = ()
+    tiles: tuple = ()
+
+    def bbox(self) -> list[float]:
+        """Bounding box of the footprint [lon_min, lon_max, lat_min, lat_max]"""
+        lons = [v[0] for v in self.extent]
+        lats = [v[1] for v in self.extent]
+        return [min(lons), max(lons), min(lats), max(lats)]
+
+
+def read_dim(path: str) -> DimRecord:
+    """Read the metadata of a DIM (memoized until the file is modified)"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        record = _CACHE.get(key, None)
+    if record is None:
+        record = parse_dim(path)
+        with _LOCK:
+            _CACHE[key] = record
+    return record
+
+
+def parse_dim(path: str) -> DimRecord:
+    values = {}
+    extent, tiles = [], []
+    # Lists are complete once their container is closed
+    pending = set(FIELDS.keys()) | {TILE_SIZE, EXTENT, DATA_FILES}
+    stack = []
+    kept = 0
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if event == "start":
+            stack.append(tag)
+            kept += "/".join(stack[1:]) in KEPT
+            continue
+        element = "/".join(stack[1:])
+        stack.pop()
+        if element in FIELDS:
+            if element in pending:
+                name, attrib = FIELDS[element]
+                values[name] = elem.text if attrib is None else elem.get(attrib)
+                pending.discard(element)
+        elif element == TILE_SIZE:
+            values["tile_size"] = (int(elem.get("nrows")), int(elem.get("ncols")))
+            pending.discard(element)
+        elif element == VERTEX:
+            kept -= 1
+            extent.append(
+                (
+                    float(elem.findtext("LON")),
+                    float(elem.findtext("LAT")),
+                    int(float(elem.findtext("COL", "0"))),
+                    int(float(elem.findtext("ROW", "0"))),
+                )
+            )
+        elif element == DATA_FILE:
+            kept -= 1
+            href = elem.find("DATA_FILE_PATH")
+            if href is not None:
+                tiles.append(
+                    (
+                        href.get("href"),
+                        int(elem.get("tile_R", "1")),
+                        int(elem.get("tile_C", "1")),
+                    )
+                )
+        elif element in [EXTENT, DATA_FILES]:
+            pending.discard(element)
+        if kept == 0:
+            elem.clear()
+        if len(pending) == 0:
+            break
+    for name in INTEGERS:
+        if values.get(name, None) is not None:
+            values[name] = int(values[name])
+    return DimRecord(
+        path=os.path.abspath(path), extent=tuple(extent), tiles=tuple(tiles), **values
+    )
@@ -0,0 +1,188 @@
+"""
+In-process post-filtering of the disparities of pixel tracking
+
+The `-F.tif` disparity of each pair is filtered block by block (memory maps, see
+`blocks`) without going back into ASP, into `-F-filtered.tif` (same layout: x and y
+disparities and valid flag, rejected pixels set to 0). Filters, applied in order:
+* NCC threshold: pixels whose `-ncc.tif` value is below `ncc-min` are rejected
+* median/MAD: in a `mad-size` window, a pixel is rejected if one of its disparities
+  deviates from the median by more than `mad-k` MAD (scaled to a standard deviation),
+  and at least `mad-min` pixels
+* small blobs: connected groups of valid pixels smaller than `min-blob` pixels are
+  rejected (blobs reaching the margin of a block are kept)
+
+Parameters from the `[disparity-filter]` section of the parameter file:
+* ncc-min: NCC threshold (default none)
+* mad-size: median window size, odd (default 0: no median/MAD filtering)
+* mad-k: rejection threshold in MAD (default 3)
+* mad-min: minimum rejected deviation in pixels (default 0.5)
+* min-blob: minimum blob size in pixels (default 0: no blob removal)
+* block: block size in pixels (default 512)
+* margin: margin read around each block, at least half the median window (default 16)
+* workers: number of pairs filtered simultaneously (default 4)
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from blocks import Raster, blocks, create_raw, inner, pack, read_block, remove_raw
+
+logger = logging.getLogger(__name__)
+
+FILTERED_SUFFIX = "-F-filtered.tif"
+# MAD to standard deviation for normally distributed values
+MAD_SCALE = 1.4826
+
+
+def filter_disparity(prefix: str, params: dict, debug=False):
+    """Filter the disparity of a stereo output prefix into -F-filtered.tif"""
+    options = params.get("disparity-filter", {})
+    output = prefix + FILTERED_SUFFIX
+    logger.info("Filter disparity: {} > {}".format(prefix + "-F.tif", output))
+    if debug:
+        return
+    workdir = os.path.dirname(os.path.abspath(prefix))
+    disp = Raster(prefix + "-F.tif", workdir, debug=debug)
+    ncc = None
+    raw = os.path.splitext(output)[0] + ".raw"
+    try:
+        if options.get("ncc-min", None) is not None:
+            if os.path.isfile(prefix + "-ncc.tif"):
+                ncc = Raster(prefix + "-ncc.tif", workdir, debug=debug)
+            else:
+                logger.warning("No NCC, threshold not applied: {}".format(prefix))
+        rejected, total = filter_blocks(disp, ncc, raw, options)
+        pack(raw, output, disp, 3, "float32", debug=debug)
+    finally:
+        # No raw file left behind on failure (output or unpacked inputs)
+        remove_raw(raw)
+        disp.close()
+        if ncc is not None:
+            ncc.close()
+    logger.info(
+        "{}: {} of {} valid disparities rejected".format(output, rejected, total)
+    )
+
+
+def filter_blocks(disp: Raster, ncc: Raster | None, raw: str, options: dict):
+    """Filter the disparity block by block into a raw output
+
+    :returns rejected, total: number of rejected and of initially valid pixels
+    """
+    mad_size = options.get("mad-size", 0)
+    margin = max(options.get("margin", 16), mad_size // 2)
+    out = create_raw(raw, 3, disp.height, disp.width, "float32")
+    rejected, total = 0, 0
+    for core, padded in blocks(
+        disp.width, disp.height, options.get("block", 512), margin
+    ):
+        block = read_block(disp.data, padded).astype(np.float32)
+        valid = np.isfinite(block).all(axis=0) & (block[2] > 0)
+        before = np.count_nonzero(inner(valid, core, padded))
+        if ncc is not None:
+            with np.errstate(invalid="ignore"):
+                valid &= read_block(ncc.data, padded)[0] >= options["ncc-min"]
+        if mad_size > 1:
+            valid &= mad_filter(
+                block[:2],
+                valid,
+                mad_size,
+                options.get("mad-k", 3),
+                options.get("mad-min", 0.5),
+            )
+        if options.get("min-blob", 0) > 1:
+            interior = interior_edges(padded, disp.width, disp.height)
+            valid &= ~small_blobs(valid, options["min-blob"], interior)
+        valid = inner(valid, core, padded)
+        block = inner(block, core, padded)
+        x, y, w, h = core
+        out[:2, y : y + h, x : x + w] = np.where(valid, block[:2], 0)
+        out[2, y : y + h, x : x + w] = valid
+        rejected += before - np.count_nonzero(valid)
+        total += before
+    out.flush()
+    return rejected, total
+
+
+def mad_filter(
+    disp: np.ndarray, valid: np.ndarray, size: int, k: float, minimum: float
+) -> np.ndarray:
+    """Pixels whose x and y disparities are within k MAD of the median of their
+    window"""
+    half = size // 2
+    keep = np.ones(valid.shape, dtype=bool)
+    for d in disp:
+        values = np.pad(
+            np.where(valid, d, np.nan), half, mode="constant", constant_values=np.nan
+        )
+        windows = np.lib.stride_tricks.sliding_window_view(values, (size, size))
+        windows = windows.reshape(windows.shape[:2] + (size * size,))
+        median = window_median(windows)
+        mad = window_median(np.abs(windows - median[..., None]))
+        threshold = np.maximum(k * MAD_SCALE * mad, minimum)
+        with np.errstate(invalid="ignore"):
+            keep &= ~(np.abs(d - median) > threshold)
+    return keep
+
+
+def window_median(windows: np.ndarray) -> np.ndarray:
+    """Median of the last axis ignoring NaN (NaN if only NaN), sorting all the
+    windows at once instead of the per-window loop of np.nanmedian"""
+    ordered = np.sort(windows, axis=-1)
+    count = np.count_nonzero(~np.isnan(windows), axis=-1)
+    low = np.take_along_axis(ordered, np.maximum(count - 1, 0)[..., None] // 2, -1)
+    high = np.take_along_axis(ordered, (count // 2)[..., None], -1)
+    median = (low[..., 0] + high[..., 0]) / 2
+    median[count == 0] = np.nan
+    return median
+
+
+def interior_edges(window: list[int], width: int, height: int) -> np.ndarray:
+    """Border pixels of a block that are not on the border of the raster"""
+    x, y, w, h = window
+    edges = np.zeros((h, w), dtype=bool)
+    if y > 0:
+        edges[0, :] = True
+    if y + h < height:
+        edges[-1, :] = True
+    if x > 0:
+        edges[:, 0] = True
+    if x + w < width:
+        edges[:, -1] = True
+    return edges
+
+
+def label(mask: np.ndarray) -> np.ndarray:
+    """Connected components (4-connectivity) of a mask: each pixel of the mask gets
+    the smallest flat index of its component"""
+    h, w = mask.shape
+    background = h * w
+    labels = np.where(mask, np.arange(h * w).reshape(h, w), background)
+    while True:
+        spread = labels.copy()
+        np.minimum(spread[1:, :], labels[:-1, :], out=spread[1:, :])
+        np.minimum(spread[:-1, :], labels[1:, :], out=spread[:-1, :])
+        np.minimum(spread[:, 1:], labels[:, :-1], out=spread[:, 1:])
+        np.minimum(spread[:, :-1], labels[:, 1:], out=spread[:, :-1])
+        spread = np.where(mask, spread, background)
+        # Pointer jumping: follow the label of the label
+        flat = np.append(spread.ravel(), background)
+        spread = np.where(mask, flat[spread], background)
+        if np.array_equal(spread, labels):
+            return labels
+        labels = spread
+
+
+def small_blobs(valid: np.ndarray, size: int, keep: np.ndarray) -> np.ndarray:
+    """Pixels of the components smaller than size, except those touching keep"""
+    labels = label(valid)
+    ids, inverse, counts = np.unique(
+        labels[valid], return_inverse=True, return_counts=True
+    )
+    small = counts < size
+    small[np.isin(ids, labels[keep & valid])] = False
+    blobs = np.zeros(valid.shape, dtype=bool)
+    blobs[valid] = small[inverse]
+    return blobs
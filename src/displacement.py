@@ -0,0 +1,186 @@
+"""
+Ground displacement and velocity from the disparities of pixel tracking
+
+The disparity of each pair (`-F-filtered.tif` if the pair was filtered, else
+`-F.tif`) is converted block by block (memory maps, see `blocks`) into a
+georeferenced `-disp.tif` with 5 bands: East and North displacements (m), magnitude
+(m), direction (degrees clockwise from North) and velocity (m per `velocity-unit`).
+The disparity of a motion-free ground, due to the offset between the grids of the
+two images when the pair was not correlated on aligned crops, is removed first.
+Invalid disparities, and pixels below the NCC threshold, are set to NaN (nodata).
+
+The time between the two images is read from the pair file (column `delay-column`,
+in days, found by name with `pairs-header = true`, else the 4th column as in
+"Master Slave Bperp Delay"), or from the ids when they are dates (YYYYMMDD or
+DDMMYYYY).
+
+Parameters from the `[displacement]` section of the parameter file:
+* resolution: pixel size in metres (default: global `mp-pan`, else the pixel size
+  of the disparity)
+* ncc-min: NCC threshold (default none)
+* delay-column: name of the delay column of the pair file (default "Delay")
+* velocity-unit: "year" (default) or "day"
+* block: block size in pixels (default 1024)
+* workers: number of pairs converted simultaneously (default 4)
+"""
+
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+
+from blocks import Raster, blocks, create_raw, pack, read_block, remove_raw
+from dispfilter import FILTERED_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+DISPLACEMENT_SUFFIX = "-disp.tif"
+BANDS = ["east", "north", "magnitude", "direction", "velocity"]
+DAYS = {"day": 1.0, "year": 365.25}
+DATE_FORMATS = ["%Y%m%d", "%d%m%Y"]
+
+
+def pair_delays(params: dict, pairs: list[list[str]]) -> dict:
+    """Delay in days of each pair ("id1_id2" > days, None if unknown)"""
+    options = params.get("displacement", {})
+    table = {}
+    if params.get("pairs", None) is not None:
+        table = read_delays(
+            params["pairs"],
+            options.get("delay-column", "Delay"),
+            params.get("pairs-header", False),
+        )
+    delays = {}
+    for p in pairs:
+        name = p[0] + "_" + p[1]
+        delay = table.get(name, None)
+        if delay is None:
+            dates = [date_from_id(i) for i in p[:2]]
+            if None not in dates:
+                delay = float((dates[1] - dates[0]).days)
+        if delay is None:
+            logger.warning("Unknown delay, no velocity for {}".format(name))
+        delays[name] = delay
+    return delays
+
+
+def read_delays(file: str, column: str, header: bool) -> dict:
+    """Delays of the pairs from the pair file ("id1_id2" > days)"""
+    with open(file, "r") as infile:
+        rows = [line.replace("\t", " ").split() for line in infile]
+    rows = [r for r in rows if len(r) > 0]
+    index = 3
+    if header:
+        names = [n.lower() for n in rows[0]]
+        rows = rows[1:]
+        index = names.index(column.lower()) if column.lower() in names else None
+    delays = {}
+    for r in rows:
+        if index is None or len(r) <= index:
+            continue
+        try:
+            delays[r[0] + "_" + r[1]] = abs(float(r[index]))
+        except ValueError:
+            continue
+    return delays
+
+
+def date_from_id(id: str) -> datetime | None:
+    for f in DATE_FORMATS:
+        try:
+            return datetime.strptime(id, f)
+        except ValueError:
+            continue
+    return None
+
+
+def disparity_file(prefix: str) -> str:
+    """Filtered disparity of a pair if any"""
+    if os.path.isfile(prefix + FILTERED_SUFFIX):
+        return prefix + FILTERED_SUFFIX
+    return prefix + "-F.tif"
+
+
+def displacement(
+    prefix: str,
+    params: dict,
+    delay: float | None,
+    offset: tuple | None = (0.0, 0.0),
+    debug=False,
+):
+    """Convert the disparity of a stereo output prefix into -disp.tif
+
+    :param offset: disparity of a motion-free ground, from the offset between the
+        grids of the images (see `asp_pt.grid_offset`), removed from the disparity
+    """
+    options = params.get("displacement", {})
+    output = prefix + DISPLACEMENT_SUFFIX
+    logger.info("Displacement: {} > {}".format(prefix, output))
+    if debug:
+        return
+    if offset is None:
+        logger.error(
+            "Unknown offset between the grids of the images, displacement not "
+            "corrected: {}".format(prefix)
+        )
+        offset = (0.0, 0.0)
+    workdir = os.path.dirname(os.path.abspath(prefix))
+    disp = Raster(disparity_file(prefix), workdir, debug=debug)
+    ncc = None
+    raw = os.path.splitext(output)[0] + ".raw"
+    try:
+        if options.get("ncc-min", None) is not None:
+            if os.path.isfile(prefix + "-ncc.tif"):
+                ncc = Raster(prefix + "-ncc.tif", workdir, debug=debug)
+            else:
+                logger.warning("No NCC, threshold not applied: {}".format(prefix))
+        convert_blocks(disp, ncc, raw, params, delay, offset)
+        pack(raw, output, disp, len(BANDS), "float32", nodata=np.nan, debug=debug)
+    finally:
+        # No raw file left behind on failure (output or unpacked inputs)
+        remove_raw(raw)
+        disp.close()
+        if ncc is not None:
+            ncc.close()
+
+
+def convert_blocks(
+    disp: Raster,
+    ncc: Raster | None,
+    raw: str,
+    params: dict,
+    delay: float | None,
+    offset: tuple,
+):
+    """Convert the disparity block by block into the raw displacement bands"""
+    options = params.get("displacement", {})
+    gt = disp.header["geotransform"]
+    res = options.get("resolution", params.get("mp-pan", None))
+    if res is not None:
+        resx, resy = res, -res
+    elif gt is not None:
+        resx, resy = gt[1], gt[5]
+    else:
+        raise ValueError("No resolution for the displacement of {}".format(disp.path))
+    scale = np.nan
+    if delay is not None and delay > 0:
+        scale = DAYS[options.get("velocity-unit", "year")] / delay
+
+    out = create_raw(raw, len(BANDS), disp.height, disp.width, "float32")
+    for core, _ in blocks(disp.width, disp.height, options.get("block", 1024)):
+        block = read_block(disp.data, core).astype(np.float32)
+        valid = np.isfinite(block).all(axis=0) & (block[2] > 0)
+        if ncc is not None:
+            with np.errstate(invalid="ignore"):
+                valid &= read_block(ncc.data, core)[0] >= options["ncc-min"]
+        # Rows go South: the North displacement is along -y
+        east = np.where(valid, (block[0] - offset[0]) * resx, np.nan)
+        north = np.where(valid, -(block[1] - offset[1]) * abs(resy), np.nan)
+        magnitude = np.hypot(east, north)
+        direction = np.degrees(np.arctan2(east, north)) % 360
+        x, y, w, h = core
+        out[:, y : y + h, x : x + w] = np.stack(
+            [east, north, magnitude, direction, magnitude * scale]
+        )
+    out.flush()
@@ -0,0 +1,310 @@
+"""
+Lightweight GeoTIFF header reader (no dependency)
+
+Only the first IFD of the file is parsed (TIFF and BigTIFF), to retrieve the raster
+size, data type, nodata value and georeferencing. Headers are cached in-process and
+invalidated when the file is modified, and can be read in a thread pool so that
+planning thousands of pairs only costs one small read per image.
+"""
+
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# TIFF field types: (struct format, size)
+TYPES = {
+    1: ("B", 1),
+    2: ("s", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+    5: ("II", 8),
+    6: ("b", 1),
+    7: ("B", 1),
+    8: ("h", 2),
+    9: ("i", 4),
+    10: ("ii", 8),
+    11: ("f", 4),
+    12: ("d", 8),
+    16: ("Q", 8),
+    17: ("q", 8),
+    18: ("Q", 8),
+}
+
+TAG_WIDTH = 256
+TAG_HEIGHT = 257
+TAG_BITS = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_COUNTS = 279
+TAG_PLANAR = 284
+TAG_TILE_WIDTH = 322
+TAG_TILE_HEIGHT = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+TAG_PIXEL_SCALE = 33550
+TAG_TIEPOINT = 33922
+TAG_TRANSFORMATION = 34264
+TAG_GEOKEYS = 34735
+TAG_NODATA = 42113
+
+# GeoKeys
+KEY_RASTER_TYPE = 1025
+KEY_GEOGRAPHIC = 2048
+KEY_PROJECTED = 3072
+PIXEL_IS_POINT = 2
+
+DTYPES = {
+    (1, 8): "uint8",
+    (1, 16): "uint16",
+    (1, 32): "uint32",
+    (1, 64): "uint64",
+    (2, 8): "int8",
+    (2, 16): "int16",
+    (2, 32): "int32",
+    (2, 64): "int64",
+    (3, 32): "float32",
+    (3, 64): "float64",
+}
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def read_header(path: str) -> dict:
+    """Read the header of a GeoTIFF (cached until the file is modified)
+
+    :returns header: dict with width, height, bands, dtype, nodata, geotransform
+        (GDAL order: ulx, resx, 0, uly, 0, -resy), epsg, and the raw block layout
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    with _LOCK:
+        cached = _CACHE.get(key, None)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with open(path, "rb") as infile:
+        tags, byteorder, bigtiff = read_ifd(infile)
+    header = parse_tags(tags)
+    header["path"] = key
+    header["byteorder"] = byteorder
+    header["bigtiff"] = bigtiff
+    with _LOCK:
+        _CACHE[key] = ((stat.st_mtime_ns, stat.st_size), header)
+    return header
+
+
+def read_headers(paths: list[str], workers: int = 16) -> dict:
+    """Read many headers in a thread pool, skipping unreadable files
+
+    :returns headers: dict path > header (None if the file is not a readable GeoTIFF)
+    """
+
+    def safe_read(path):
+        try:
+            return read_header(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        headers = list(pool.map(safe_read, paths))
+    return dict(zip(paths, headers))
+
+
+def read_ifd(infile) -> tuple[dict, str, bool]:
+    """Read the raw tags of the first IFD"""
+    head = infile.read(16)
+    if head[:2] == b"II":
+        byteorder = "<"
+    elif head[:2] == b"MM":
+        byteorder = ">"
+    else:
+        raise ValueError("Not a TIFF file: {}".format(infile.name))
+    version = struct.unpack(byteorder + "H", head[2:4])[0]
+    if version == 42:
+        bigtiff = False
+        offset = struct.unpack(byteorder + "I", head[4:8])[0]
+        count_fmt, entry_size, inline = "H", 12, 4
+    elif version == 43:
+        bigtiff = True
+        offset = struct.unpack(byteorder + "Q", head[8:16])[0]
+        count_fmt, entry_size, inline = "Q", 20, 8
+    else:
+        raise ValueError("Not a TIFF file: {}".format(infile.name))
+
+    infile.seek(offset)
+    count_size = struct.calcsize(count_fmt)
+    nb = struct.unpack(byteorder + count_fmt, infile.read(count_size))[0]
+    entries = infile.read(nb * entry_size)
+    tags = {}
+    for i in range(nb):
+        entry = entries[i * entry_size : (i + 1) * entry_size]
+        tag, typ = struct.unpack(byteorder + "HH", entry[:4])
+        if typ not in TYPES:
+            continue
+        if bigtiff:
+            count = struct.unpack(byteorder + "Q", entry[4:12])[0]
+            value = entry[12:20]
+        else:
+            count = struct.unpack(byteorder + "I", entry[4:8])[0]
+            value = entry[8:12]
+        fmt, size = TYPES[typ]
+        if count * size > inline:
+            pointer = struct.unpack(byteorder + ("Q" if bigtiff else "I"), value)[0]
+            infile.seek(pointer)
+            value = infile.read(count * size)
+        tags[tag] = unpack_values(value, typ, count, byteorder)
+    return tags, byteorder, bigtiff
+
+
+def unpack_values(data: bytes, typ: int, count: int, byteorder: str):
+    fmt, size = TYPES[typ]
+    if typ == 2:
+        return data[:count].split(b"\x00")[0].decode(errors="replace")
+    values = struct.unpack(byteorder + fmt * count, data[: count * size])
+    if typ in [5, 10]:
+        values = [values[i] / values[i + 1] for i in range(0, len(values), 2)]
+    return list(values)
+
+
+def parse_tags(tags: dict) -> dict:
+    """Convert the raw tags into a compact header"""
+    bands = tags.get(TAG_SAMPLES, [1])[0]
+    bits = tags.get(TAG_BITS, [1])[0]
+    sample_format = tags.get(TAG_SAMPLE_FORMAT, [1])[0]
+    header = {
+        "width": tags[TAG_WIDTH][0],
+        "height": tags[TAG_HEIGHT][0],
+        "bands": bands,
+        "dtype": DTYPES.get((sample_format, bits), None),
+        "nodata": None,
+        "geotransform": None,
+        "epsg": None,
+        "compression": tags.get(TAG_COMPRESSION, [1])[0],
+        "planar": tags.get(TAG_PLANAR, [1])[0],
+    }
+    if TAG_TILE_OFFSETS in tags:
+        header["block"] = [tags[TAG_TILE_WIDTH][0], tags[TAG_TILE_HEIGHT][0]]
+        header["offsets"] = tags[TAG_TILE_OFFSETS]
+        header["bytecounts"] = tags.get(TAG_TILE_COUNTS, None)
+        header["tiled"] = True
+    else:
+        rows = tags.get(TAG_ROWS_PER_STRIP, [header["height"]])[0]
+        header["block"] = [header["width"], min(rows, header["height"])]
+        header["offsets"] = tags.get(TAG_STRIP_OFFSETS, None)
+        header["bytecounts"] = tags.get(TAG_STRIP_COUNTS, None)
+        header["tiled"] = False
+
+    nodata = tags.get(TAG_NODATA, None)
+    if nodata is not None:
+        try:
+            header["nodata"] = float(nodata.strip())
+        except ValueError:
+            pass
+
+    geokeys = parse_geokeys(tags.get(TAG_GEOKEYS, None))
+    header["epsg"] = geokeys.get(KEY_PROJECTED, geokeys.get(KEY_GEOGRAPHIC, None))
+    if header["epsg"] == 32767:
+        # User-defined CRS, not described by an EPSG code
+        header["epsg"] = None
+
+    if TAG_TRANSFORMATION in tags:
+        m = tags[TAG_TRANSFORMATION]
+        header["geotransform"] = [m[3], m[0], m[1], m[7], m[4], m[5]]
+    elif TAG_PIXEL_SCALE in tags and TAG_TIEPOINT in tags:
+        scale, tie = tags[TAG_PIXEL_SCALE], tags[TAG_TIEPOINT]
+        ulx = tie[3] - tie[0] * scale[0]
+        uly = tie[4] + tie[1] * scale[1]
+        header["geotransform"] = [ulx, scale[0], 0.0, uly, 0.0, -scale[1]]
+    if (
+        header["geotransform"] is not None
+        and geokeys.get(KEY_RASTER_TYPE, None) == PIXEL_IS_POINT
+    ):
+        # Same convention as GDAL: the tie point is the centre of the first pixel
+        gt = header["geotransform"]
+        gt[0] -= gt[1] / 2
+        gt[3] -= gt[5] / 2
+    return header
+
+
+def parse_geokeys(directory: list | None) -> dict:
+    """Read the short values of the GeoKeyDirectory (key > value)"""
+    if directory is None or len(directory) < 4:
+        return {}
+    keys = {}
+    for i in range(directory[3]):
+        key, location, count, value = directory[4 + 4 * i : 8 + 4 * i]
+        if location == 0 and count == 1:
+            keys[key] = value
+    return keys
+
+
+def bounds(header: dict) -> list[float]:
+    """Georeferenced bounds of a raster: [xmin, ymin, xmax, ymax]"""
+    ulx, resx, _, uly, _, resy = header["geotransform"]
+    x2 = ulx + resx * header["width"]
+    y2 = uly + resy * header["height"]
+    return [min(ulx, x2), min(uly, y2), max(ulx, x2), max(uly, y2)]
+
+
+def intersection(headers: list[dict]) -> list[float] | None:
+    """Common georeferenced bounds of rasters (None if they do not overlap)"""
+    all_bounds = [bounds(h) for h in headers]
+    common = [
+        max([b[0] for b in all_bounds]),
+        max([b[1] for b in all_bounds]),
+        min([b[2] for b in all_bounds]),
+        min([b[3] for b in all_bounds]),
+    ]
+    if common[0] >= common[2] or common[1] >= common[3]:
+        return None
+    return common
+
+
+def window(header: dict, area: list[float]) -> list[int]:
+    """Pixel window [xoff, yoff, xsize, ysize] of a raster covering an area"""
+    ulx, resx, _, uly, _, resy = header["geotransform"]
+    xoff = max(int(round((area[0] - ulx) / resx)), 0)
+    yoff = max(int(round((area[3] - uly) / resy)), 0)
+    xend = min(int(round((area[2] - ulx) / resx)), header["width"])
+    yend = min(int(round((area[1] - uly) / resy)), header["height"])
+    return [xoff, yoff, xend - xoff, yend - yoff]
+
+
+def pixel_offset(header1: dict, header2: dict) -> tuple[float, float]:
+    """Expected disparity (in pixels of image 1) of image 2 relative to image 1,
+    given only their grids (i.e. for a motion-free ground)"""
+    gt1, gt2 = header1["geotransform"], header2["geotransform"]
+    return (gt1[0] - gt2[0]) / gt1[1], (gt1[3] - gt2[3]) / gt1[5]
+
+
+def aligned_windows(header1: dict, header2: dict) -> tuple[list, tuple] | None:
+    """Windows of the intersection of two rasters sharing the same resolution,
+    with the same size and origins on the closest pixel (pre-aligned crops)
+
+    :returns windows, remainder: the windows of the two rasters, and the fractional
+        part of the grid offset left between the crops (in pixels)
+    """
+    gt1, gt2 = header1["geotransform"], header2["geotransform"]
+    if abs(gt1[1] - gt2[1]) > 1e-6 * abs(gt1[1]) or abs(gt1[5] - gt2[5]) > 1e-6 * abs(
+        gt1[5]
+    ):
+        return None
+    area = intersection([header1, header2])
+    if area is None:
+        return None
+    win1 = window(header1, area)
+    dx, dy = pixel_offset(header1, header2)
+    xoff2, yoff2 = win1[0] + int(round(dx)), win1[1] + int(round(dy))
+    xsize = min(win1[2], header2["width"] - xoff2)
+    ysize = min(win1[3], header2["height"] - yoff2)
+    if xoff2 < 0 or yoff2 < 0 or xsize <= 0 or ysize <= 0:
+        return None
+    windows = [
+        [win1[0], win1[1], xsize, ysize],
+        [xoff2, yoff2, xsize, ysize],
+    ]
+    return windows, (dx - round(dx), dy - round(dy))
@@ -0,0 +1,206 @@
+"""
+Per-image preprocessing shared by all the pairs of an image
+
+Without it, `parallel_stereo` normalizes both images and masks their nodata again
+for each pair, so an image in k pairs is preprocessed k times. With the cache, each
+source image is normalized once, in-process (block by block on memory maps, see
+`blocks`), into `CACHE/<id>-norm.tif`, and every pair is correlated on the cached
+images with `--skip-image-normalization`.
+
+The normalization is the one of ASP for individually normalized images: values are
+stretched from [mean - 2 std, mean + 2 std] (bounded by the min and max, or the
+whole [min, max] with `force-use-entire-range`) to [0, 1], and nodata pixels are
+set to NaN (nodata). The input is read once: its valid values are copied into the
+output while the statistics are computed, then stretched in place. The statistics
+are saved next to the normalized image
+(`<id>-norm.json`), which is computed again only if its input is newer or if the
+options changed.
+
+Parameters from the `[image-cache]` section of the parameter file:
+* force-use-entire-range: stretch from the min and max (default false)
+* block: block size in pixels (default 1024)
+* workers: number of images normalized simultaneously (default 4)
+"""
+
+import json
+import logging
+import os
+from functools import partial
+
+import numpy as np
+
+from blocks import Raster, blocks, create_raw, pack, read_block
+from runner import Job, megapixels
+
+logger = logging.getLogger(__name__)
+
+DIR_CACHE = "CACHE/"
+NORM_SUFFIX = "-norm.tif"
+OPTIONS = ["force-use-entire-range"]
+
+
+def cache_sources(
+    sources: list[dict], params: dict, folder: str, after: list[Job], debug=False
+) -> list[Job]:
+    """Replace the mp images of the sources by their cached normalized images, and
+    plan the normalization of those not up to date
+
+    :param after: jobs producing the mp images (e.g SAR preprocessing), by source id
+    :returns jobs: one job per image to normalize
+    """
+    if not params.get("stereo", {}).get("individually-normalize", False):
+        logger.warning(
+            "Images of the cache are normalized individually "
+            "(as with individually-normalize)"
+        )
+    jobs = []
+    for s in sources:
+        if s.get("mp", None) is None:
+            continue
+        output = os.path.join(os.path.abspath(folder), DIR_CACHE, s["id"] + NORM_SUFFIX)
+        # The input may be planned too (e.g SAR preprocessing)
+        size = megapixels(s["mp"], debug=debug) or s.get("megapixels", None)
+        if params.get("force", False) or not is_done(s["mp"], output, params):
+            jobs.append(
+                Job(
+                    s["id"],
+                    "image-cache",
+                    partial(normalize, s["mp"], output, params, debug=debug),
+                    megapixels=size,
+                    after=[j for j in after if j.name == s["id"]],
+                )
+            )
+        else:
+            logger.info("Skipping normalization (already cached): {}".format(s["id"]))
+        if s.get("mp-header", None) is not None:
+            s["mp-header"] = dict(
+                s["mp-header"],
+                path=output,
+                bands=1,
+                dtype="float32",
+                nodata=float("nan"),
+            )
+        s["mp"] = output
+        if size is not None:
+            # The jobs of the pairs are sized before the image exists
+            s["megapixels"] = size
+    return jobs
+
+
+def record_file(output: str) -> str:
+    return os.path.splitext(output)[0] + ".json"
+
+
+def fingerprint(input: str, params: dict) -> dict:
+    options = params.get("image-cache", {})
+    return {
+        "input": os.path.abspath(input),
+        "options": {k: options[k] for k in OPTIONS if k in options},
+    }
+
+
+def is_done(input: str, output: str, params: dict) -> bool:
+    """Whether the cached image is newer than its input and was made with the same
+    options"""
+    if not os.path.isfile(output) or not os.path.isfile(record_file(output)):
+        return False
+    if os.path.isfile(input) and os.path.getmtime(output) < os.path.getmtime(input):
+        return False
+    with open(record_file(output), "r") as infile:
+        try:
+            record = json.load(infile)
+        except json.JSONDecodeError:
+            return False
+    return record.get("source", None) == fingerprint(input, params)
+
+
+def normalize(input: str, output: str, params: dict, debug=False):
+    """Normalize an image into the cache"""
+    options = params.get("image-cache", {})
+    logger.info("Normalize: {} > {}".format(input, output))
+    if debug:
+        return
+    image = Raster(input, os.path.dirname(output), debug=debug)
+    nodata = image.header["nodata"]
+    windows = [
+        c for c, _ in blocks(image.width, image.height, options.get("block", 1024))
+    ]
+
+    def valid_values(window):
+        values = read_block(image.data[:1], window)[0].astype(np.float64)
+        valid = np.isfinite(values)
+        if nodata is not None:
+            valid &= values != nodata
+        return values, valid
+
+    raw = os.path.splitext(output)[0] + ".raw"
+    out = create_raw(raw, 1, image.height, image.width, "float32")
+
+    def copied_values(window):
+        # The input is read once: the valid values are kept in the output
+        values, valid = valid_values(window)
+        x, y, width, height = window
+        out[0, y : y + height, x : x + width] = np.where(valid, values, np.nan)
+        return values, valid
+
+    stats = statistics(copied_values(w) for w in windows)
+    if stats is None:
+        del out
+        os.remove(raw)
+        image.close()
+        raise ValueError("No valid pixel: {}".format(input))
+    lo, hi = stretch(stats, options.get("force-use-entire-range", False))
+    # Stretched in place, on the local output (NaN stays NaN)
+    for x, y, width, height in windows:
+        block = out[0, y : y + height, x : x + width]
+        block[:] = np.clip((block - lo) / (hi - lo), 0, 1)
+    out.flush()
+    del out
+    pack(raw, output, image, 1, "float32", nodata=np.nan)
+    image.close()
+    with open(record_file(output), "w") as outfile:
+        json.dump(
+            {
+                "source": fingerprint(input, params),
+                "stats": stats,
+                "stretch": [lo, hi],
+            },
+            outfile,
+        )
+
+
+def statistics(chunks) -> dict | None:
+    """Min, max, mean and standard deviation of the valid values of blocks, read one
+    at a time ((values, valid) pairs)"""
+    count, total, squares = 0, 0.0, 0.0
+    vmin, vmax = np.inf, -np.inf
+    for values, valid in chunks:
+        v = values[valid]
+        if v.size == 0:
+            continue
+        count += v.size
+        total += v.sum()
+        squares += np.square(v).sum()
+        vmin, vmax = min(vmin, v.min()), max(vmax, v.max())
+    if count == 0:
+        return None
+    mean = total / count
+    std = np.sqrt(max(squares / count - mean**2, 0))
+    return {
+        "min": float(vmin),
+        "max": float(vmax),
+        "mean": float(mean),
+        "std": float(std),
+        "count": count,
+    }
+
+
+def stretch(stats: dict, entire_range=False) -> tuple[float, float]:
+    """Values mapped to 0 and 1"""
+    lo, hi = stats["min"], stats["max"]
+    if not entire_range:
+        lo = max(lo, stats["mean"] - 2 * stats["std"])
+        hi = min(hi, stats["mean"] + 2 * stats["std"])
+    if hi <= lo:
+        hi = lo + 1
+    return lo, hi
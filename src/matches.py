@@ -0,0 +1,128 @@
+"""
+Interest point match database of a project
+
+Interest point matches are computed once per image pair and kept in `MATCHES/`, as
+ASP match files named after the raw (not map-projected) images
+(`m-<image1>__<image2>.match`, and `m-<image1>__<image2>-clean.match` without the
+outliers filtered by the bundle adjustment):
+* before a bundle adjustment, the known matches of its images are linked under its
+  output prefix, so that `bundle_adjust` only computes the missing pairs (e.g the
+  pairs of a new date), and the new matches are added to the database after it
+* the stereo of the DSM generation is pointed at the matches of its pair
+  (`clean-match-files-prefix`, else `match-files-prefix`) instead of detecting and
+  matching interest points again
+
+The database is used unless the global parameter `match-database` is false.
+"""
+
+import logging
+import os
+import shutil
+from copy import deepcopy
+
+logger = logging.getLogger(__name__)
+
+DIR_MATCHES = "MATCHES/"
+PREFIX = "m"
+SUFFIX = ".match"
+CLEAN_SUFFIX = "-clean.match"
+STEREO_OPTIONS = ["match-files-prefix", "clean-match-files-prefix"]
+
+
+def database(params: dict) -> str | None:
+    """Prefix of the match files of the project (None if disabled)"""
+    if not params.get("match-database", True):
+        return None
+    output = os.path.abspath(params.get("output", "."))
+    return os.path.join(output, DIR_MATCHES, PREFIX)
+
+
+def match_file(prefix: str, image1: str, image2: str, clean=False) -> str:
+    """Match file of an image pair, as named by ASP"""
+    stems = [os.path.splitext(os.path.basename(i))[0] for i in [image1, image2]]
+    suffix = CLEAN_SUFFIX if clean else SUFFIX
+    return "{}-{}__{}{}".format(prefix, stems[0], stems[1], suffix)
+
+
+def image_pairs(images: list[str], params: dict) -> list[tuple[str, str]]:
+    """Image pairs matched by bundle_adjust: all of them, or each image with the
+    following ones up to `overlap-limit`"""
+    limit = params.get("bundle-adjust", {}).get("overlap-limit", 0)
+    pairs = []
+    for i in range(len(images)):
+        for j in range(i + 1, len(images)):
+            if limit > 0 and j - i > limit:
+                break
+            pairs.append((images[i], images[j]))
+    return pairs
+
+
+def link(source: str, target: str):
+    """Hard link a match file (copy across file systems), replacing the target"""
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = target + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copy2(source, tmp)
+    os.replace(tmp, target)
+
+
+def seed(prefix: str, output: str, images: list[str], params: dict, debug=False):
+    """Link the known matches of the images under the output prefix of a bundle
+    adjustment
+
+    :returns missing: image pairs without matches in the database
+    """
+    pairs = image_pairs(images, params)
+    missing = []
+    for image1, image2 in pairs:
+        known = match_file(prefix, image1, image2)
+        if not os.path.isfile(known):
+            missing.append((image1, image2))
+        elif not debug:
+            link(known, match_file(output, image1, image2))
+    logger.info(
+        "Interest point matches: {} pairs reused, {} to compute".format(
+            len(pairs) - len(missing), len(missing)
+        )
+    )
+    return missing
+
+
+def store(output: str, prefix: str, images: list[str], params: dict, debug=False):
+    """Add the matches found by a bundle adjustment to the database"""
+    if debug:
+        return
+    for image1, image2 in image_pairs(images, params):
+        for clean in [False, True]:
+            found = match_file(output, image1, image2, clean)
+            if os.path.isfile(found):
+                link(found, match_file(prefix, image1, image2, clean))
+
+
+def stereo_params(params: dict, raws: list[str | None], output: str) -> dict:
+    """Parameters of a parallel_stereo reading the matches of its raw images from the
+    database, if all of them are known
+
+    The matches are in raw image coordinates: for map-projected stereo, ASP looks
+    them up by the names of the raw images of the inputs, as kept in the database.
+    """
+    prefix = database(params)
+    if prefix is None or len(raws) == 0 or None in raws:
+        return params
+    if any([k in params.get("stereo", {}) for k in STEREO_OPTIONS]):
+        return params
+    # Multiview stereo matches the first image with each other
+    pairs = [(raws[0], r) for r in raws[1:]]
+    for clean, option in [(True, STEREO_OPTIONS[1]), (False, STEREO_OPTIONS[0])]:
+        if all([os.path.isfile(match_file(prefix, a, b, clean)) for a, b in pairs]):
+            logger.info("Reusing interest point matches: {}".format(output))
+            run_params = deepcopy(params)
+            run_params["stereo"][option] = prefix
+            return run_params
+    return params
@@ -0,0 +1,199 @@
+"""
+Tiled mosaicking of many DEM fragments
+
+The extent of all the fragments is split into square tiles on a fixed grid (multiples
+of the tile size, so that tiles are stable between runs). Each tile is built with its
+own dem_mosaic call on the fragments overlapping it, in parallel, and the tiles are
+then joined into a VRT and a final COG. A manifest keeps the fragments (and their
+modification time, kept by the COG conversion of the retention) used by each tile,
+so that only the tiles touched by new or updated fragments are rebuilt.
+
+Global parameters of the parameter file:
+* mosaic-tile-size: size of the tiles in georeferenced units (enables the tiled mode)
+* mosaic-workers: number of tiles built simultaneously (default 4)
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+from copy import deepcopy
+from functools import partial
+
+from asp import dem_mosaic, sh
+from geotiff import bounds, read_headers
+from retention import cog_translate
+from runner import Job
+
+logger = logging.getLogger(__name__)
+
+DIR_MOSAIC = "MOSAIC/"
+MANIFEST = "manifest.json"
+_MANIFEST_LOCK = threading.Lock()
+
+
+def fragment_footprints(dems: list[str]) -> dict:
+    """Georeferenced bounds and resolution of each readable fragment"""
+    footprints = {}
+    epsg = set()
+    for path, header in read_headers(dems).items():
+        if header is None or header["geotransform"] is None:
+            logger.warning("Fragment skipped from mosaic (unreadable): {}".format(path))
+            continue
+        st = os.stat(path)
+        footprints[path] = {
+            "bounds": bounds(header),
+            "res": abs(header["geotransform"][1]),
+            # Not the size, changed by the COG conversion of the fragments
+            "stamp": [st.st_mtime_ns],
+        }
+        epsg.add(header["epsg"])
+    if len(epsg) > 1:
+        raise ValueError("DEM fragments do not share the same CRS: {}".format(epsg))
+    return footprints
+
+
+def plan_tiles(footprints: dict, tile_size: float) -> dict:
+    """Fragments overlapping each tile of the fixed grid: (col, row) > [paths]"""
+    tiles = {}
+    for path, f in footprints.items():
+        b = f["bounds"]
+        for col in range(math.floor(b[0] / tile_size), math.ceil(b[2] / tile_size)):
+            for row in range(math.floor(b[1] / tile_size), math.ceil(b[3] / tile_size)):
+                tiles.setdefault((col, row), []).append(path)
+    return tiles
+
+
+def tile_name(tile: tuple[int, int]) -> str:
+    return "tile_{}_{}".format(tile[0], tile[1])
+
+
+def read_manifest(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, MANIFEST), "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(folder: str, manifest: dict):
+    tmp = os.path.join(folder, MANIFEST + ".tmp")
+    with open(tmp, "w") as outfile:
+        json.dump(manifest, outfile, indent=1)
+    os.replace(tmp, os.path.join(folder, MANIFEST))
+
+
+def mosaic_folder(output: str) -> str:
+    return os.path.join(os.path.dirname(output), DIR_MOSAIC)
+
+
+def tile_jobs(dems: list[str], output: str, params: dict, debug=False) -> list[Job]:
+    """Jobs building the tiles touched by new or modified fragments"""
+    folder = mosaic_folder(output)
+    footprints = fragment_footprints(dems)
+    if len(footprints) == 0:
+        if debug:
+            logger.info("Tiles are planned from existing fragments only")
+            return []
+        raise ValueError("No readable DEM fragment to mosaic")
+
+    mosaic_params = deepcopy(params)
+    tr = mosaic_params["dem-mosaic"].get("tr", None)
+    if tr is None:
+        # All tiles on the same grid, that of the finest fragment
+        tr = min([f["res"] for f in footprints.values()])
+        mosaic_params["dem-mosaic"]["tr"] = tr
+    # Tile borders on pixel borders
+    tile_size = max(round(params["mosaic-tile-size"] / tr), 1) * tr
+    tiles = plan_tiles(footprints, tile_size)
+    logger.info(
+        "Mosaic of {} fragments on {} tiles".format(len(footprints), len(tiles))
+    )
+
+    manifest = read_manifest(folder)
+    names = [tile_name(t) for t in tiles.keys()]
+    stale = [name for name in manifest.keys() if name not in names]
+    if not debug:
+        os.makedirs(folder, exist_ok=True)
+        for name in stale:
+            # Tile not covered anymore (fragment removed or tiling changed)
+            del manifest[name]
+            if os.path.isfile(os.path.join(folder, name + ".tif")):
+                os.remove(os.path.join(folder, name + ".tif"))
+        write_manifest(folder, manifest)
+
+    signature = json.dumps(mosaic_params["dem-mosaic"], sort_keys=True)
+    jobs = []
+    for tile, paths in sorted(tiles.items()):
+        name = tile_name(tile)
+        tile_file = os.path.join(folder, name + ".tif")
+        entry = {
+            "params": signature,
+            "fragments": sorted([[p] + footprints[p]["stamp"] for p in paths]),
+        }
+        if (
+            manifest.get(name, None) == entry
+            and os.path.isfile(tile_file)
+            and not params.get("force", False)
+        ):
+            continue
+        projwin = [
+            tile[0] * tile_size,
+            tile[1] * tile_size,
+            (tile[0] + 1) * tile_size,
+            (tile[1] + 1) * tile_size,
+        ]
+        jobs.append(
+            Job(
+                name,
+                "dem-mosaic",
+                partial(
+                    build_tile,
+                    sorted(paths),
+                    tile_file,
+                    projwin,
+                    mosaic_params,
+                    name,
+                    entry,
+                    debug=debug,
+                ),
+            )
+        )
+    logger.info("{} tiles to (re)build".format(len(jobs)))
+    return jobs
+
+
+def build_tile(
+    dems: list[str],
+    tile_file: str,
+    projwin: list[float],
+    params: dict,
+    name: str,
+    entry: dict,
+    debug=False,
+):
+    """Mosaic the fragments of one tile and record them in the manifest"""
+    folder = os.path.dirname(tile_file)
+    tile_params = deepcopy(params)
+    tile_params["dem-mosaic"]["t_projwin"] = projwin
+    dem_mosaic(dems, tile_file, tile_params, debug=debug)
+    if debug:
+        return
+    with _MANIFEST_LOCK:
+        manifest = read_manifest(folder)
+        manifest[name] = entry
+        write_manifest(folder, manifest)
+
+
+def join_tiles(output: str, debug=False):
+    """Join all the tiles of the manifest into a VRT and a final COG"""
+    folder = mosaic_folder(output)
+    vrt = os.path.join(folder, "dem.vrt")
+    tile_list = os.path.join(folder, "tiles.txt")
+    if not debug:
+        tiles = [os.path.join(folder, name + ".tif") for name in read_manifest(folder)]
+        with open(tile_list, "w") as outfile:
+            outfile.write("\n".join(sorted(tiles)) + "\n")
+    sh(["gdalbuildvrt", "-input_file_list", tile_list, vrt], debug=debug)
+    cog_translate(vrt, output, debug=debug)
@@ -1,16 +1,23 @@
 import glob
+import json
 import logging
 import os
-import subprocess
-import sys
-import xml.etree.ElementTree as ET
+import re
+import shlex
+import threading
 
 import numpy as np
 import tomli
 
+from asp import sh
+from dim import read_dim
+from geotiff import read_headers
+from safe import TILE_FILE, find_product, read_safe, read_tile
+from vrt import mosaic_vrt, write_vrt
+
 logger = logging.getLogger(__name__)
 
-KEYS = ["id", "pan", "ms", "cam", "mp", "cam-ms", "pleiades"]
+KEYS = ["id", "pan", "ms", "cam", "mp", "cam-ms", "pleiades", "sentinel2"]
 
 DIR_BA = "BA/ba"
 DIR_MP_PAN = "MP/PAN/mp-pan-"
@@ -18,32 +25,12 @@ DIR_MP_MS = "MP/MS/mp-ms-"
 DIR_PANSHARP = "MP/PANSHARP/pansharp-"
 DIR_ALIGNED = "MP/ALIGNED/align-"
 DIR_STEREO = "STEREO/"
+DIR_S2 = "S2/s2-"
 PREF_STEREO = "stereo"
 
-
-def sh(cmd: str, shell: bool = True, debug: bool = False):
-    """
-    Launch a shell command
-
-    As shell=True, all single call is made in a separate shell
-
-    # Example
-
-    ````
-    sh("ls -l | wc -l")
-    ````
-
-    """
-    logger.info(">> " + cmd)
-
-    if not debug:
-        return subprocess.run(
-            cmd,
-            shell=shell,
-            stdout=sys.stdout,
-            stderr=subprocess.STDOUT,
-            env=os.environ,
-        )
+# DEMs retrieved in this process, shared by the projects of a batch
+_DEM_CACHE = {}
+_DEM_LOCK = threading.Lock()
 
 
 def parse_params(file: str) -> dict:
@@ -57,7 +44,48 @@ def parse_params(file: str) -> dict:
     return params
 
 
-def get_sources(params: dict, first=None) -> list[dict]:
+def write_toml(params: dict, file: str):
+    """Write parameters as a toml file (sections after the global parameters)"""
+    params = {k: v for k, v in params.items() if k != "root"}
+    with open(file, "w") as outfile:
+        outfile.write("\n".join(toml_lines(params, [])) + "\n")
+
+
+def toml_lines(table: dict, path: list[str]) -> list[str]:
+    """Lines of a table: its values, then its sub-tables (recursively)"""
+    lines = []
+    tables = []
+    for key, value in table.items():
+        if type(value) is dict:
+            tables.append(("[{}]", key, value))
+        elif type(value) is list and len(value) > 0 and type(value[0]) is dict:
+            tables += [("[[{}]]", key, v) for v in value]
+        else:
+            lines.append("{} = {}".format(toml_key(key), toml_value(value)))
+    for header, key, sub in tables:
+        name = ".".join([toml_key(k) for k in path + [key]])
+        lines += ["", header.format(name)]
+        lines += toml_lines(sub, path + [key])
+    return lines
+
+
+def toml_key(key: str) -> str:
+    if re.fullmatch(r"[A-Za-z0-9_-]+", key):
+        return key
+    return json.dumps(key, ensure_ascii=False)
+
+
+def toml_value(value) -> str:
+    if type(value) is bool:
+        return "true" if value else "false"
+    if type(value) is list:
+        return "[" + ", ".join([toml_value(v) for v in value]) + "]"
+    if type(value) is str:
+        return json.dumps(value, ensure_ascii=False)
+    return repr(value)
+
+
+def get_sources(params: dict, first=None, debug=False) -> list[dict]:
     """Create the source dict from a file or raw definition
 
     Must be used only once"""
@@ -80,8 +108,10 @@ def get_sources(params: dict, first=None) -> list[dict]:
 
     if type(source) is list:
         logger.info("Source is described directly in toml")
-        source_pleiades_autofill(params)
-        return extend_paths(source, params)
+        source_pleiades_autofill(params, debug=debug)
+        return source_sentinel2_autofill(
+            extend_paths(source, params), params, debug=debug
+        )
 
     logger.info("Reading source from file: {}".format(source))
     with open(source, "r") as infile:
@@ -122,7 +152,7 @@ def get_sources(params: dict, first=None) -> list[dict]:
             s[k] = c[key_index[k]]
         source.append(s)
 
-    return extend_paths(source, params)
+    return source_sentinel2_autofill(extend_paths(source, params), params, debug=debug)
 
 
 def extend_paths(sources: list[dict], params: dict) -> list[dict]:
@@ -228,19 +258,40 @@ def check_for_mp(sources: list[dict], working_dir: str) -> list[dict] | None:
     return sources
 
 
+def read_mp_headers(sources: list[dict], workers: int = 16) -> list[dict]:
+    """Fill the georeferencing fields of the sources from the mp GeoTIFF headers
+
+    ulx, uly, resx, resy, width, height, epsg and nodata are added to each source
+    with a readable mp image, and the full header is kept under "mp-header"."""
+    paths = [s["mp"] for s in sources if s.get("mp", None) is not None]
+    headers = read_headers(paths, workers=workers)
+    for s in sources:
+        header = headers.get(s.get("mp", None), None)
+        if header is None or header["geotransform"] is None:
+            logger.debug("No georeferenced header for {}".format(s.get("mp", None)))
+            continue
+        set_mp_header(s, header)
+    return sources
+
+
+def set_mp_header(source: dict, header: dict):
+    """Fill the georeferencing fields of a source from the header of its mp image"""
+    gt = header["geotransform"]
+    source["ulx"], source["resx"], source["uly"], source["resy"] = (
+        gt[0],
+        gt[1],
+        gt[3],
+        gt[5],
+    )
+    source["width"], source["height"] = header["width"], header["height"]
+    source["epsg"], source["nodata"] = header["epsg"], header["nodata"]
+    source["mp-header"] = header
+
+
 def get_dim_bbox(dim: str, debug=False) -> list[float]:
     if debug:
         return [0, 1, 0, 1]
-    logger.info("Parse XML: {}".format(dim))
-    root = ET.parse(dim).getroot()
-    bbox_polygon = root.findall("./Dataset_Content/Dataset_Extent/Vertex")
-    bbox_points = []
-    for b in bbox_polygon:
-        lon, lat = b.find("./LON"), b.find("./LAT")
-        if lon is not None and lat is not None:
-            lon, lat = lon.text, lat.text
-            if lon is not None and lat is not None:
-                bbox_points.append([float(lon), float(lat)])
+    bbox_points = [[v[0], v[1]] for v in read_dim(dim).extent]
     return points_to_bbox(bbox_points)
 
 
@@ -306,26 +357,204 @@ def source_pleiades_autofill(params: dict, debug=False):
             s["dim"] = os.path.join(prepend, maybe_dim[0])
             s["cam"] = os.path.join(prepend, "RPC_" + heart + ".XML")
             s["pan"] = os.path.join(prepend, "IMG_" + heart + ".TIF")
-            if not os.path.isfile(s["pan"]):
-                pleiades_source_virtual(os.path.join(src, pld), s["pan"])
+            if is_stale(s["pan"], s["dim"]):
+                pleiades_source_virtual(
+                    os.path.join(src, pld), s["pan"], dim=s["dim"], debug=debug
+                )
     if not auto_fill:
         logger.info("No autofill from pleiades folder")
 
 
-def pleiades_source_virtual(folder, target, debug=False):
-    """Generate a virtual raster upon pleiades tiles in the distributed folder"""
+def is_stale(target: str, dim: str) -> bool:
+    """Whether a file derived from a delivery is missing or older than the delivery"""
+    if not os.path.isfile(target):
+        return True
+    folder = os.path.dirname(dim) or "."
+    changed = max(os.path.getmtime(dim), os.path.getmtime(folder))
+    return os.path.getmtime(target) < changed
+
+
+def dim_tiles(dim: str) -> dict | None:
+    """Raster layout of a delivery described by its DIM (None if not tiled)"""
+    record = read_dim(dim)
+    if record.tile_size is None or len(record.tiles) == 0 or record.ncols is None:
+        return None
+    width, height = record.ncols, record.nrows
+    tile_h, tile_w = record.tile_size
+    overlap_c, overlap_r = record.overlap_col or 0, record.overlap_row or 0
+    tiles = []
+    for path, row, col in record.tiles:
+        xoff, yoff = (col - 1) * (tile_w - overlap_c), (row - 1) * (tile_h - overlap_r)
+        window = [xoff, yoff, min(tile_w, width - xoff), min(tile_h, height - yoff)]
+        tiles.append((os.path.join(os.path.dirname(dim), path), window))
+    if record.data_type == "FLOAT":
+        dtype = "float32"
+    else:
+        dtype = "uint8" if (record.nbits or 16) <= 8 else "uint16"
+    return {
+        "size": [width, height],
+        "bands": record.nbands or 1,
+        "dtype": dtype,
+        "tiles": tiles,
+    }
+
+
+def pleiades_source_virtual(folder, target, dim=None, debug=False):
+    """Generate a virtual raster upon pleiades tiles in the distributed folder
+
+    The mosaic is written directly from the tiling described in the DIM, without
+    opening the tiles (gdalbuildvrt is only used if the DIM has no tiling)"""
+    layout = None if dim is None else dim_tiles(dim)
+    if layout is not None:
+        logger.info("Virtual raster from DIM: {}".format(target))
+        if not debug:
+            mosaic_vrt(
+                target,
+                layout["size"],
+                layout["bands"],
+                layout["dtype"],
+                layout["tiles"],
+            )
+        return
+
     search_pattern_tif = os.path.join(folder, "IMG*_R*C*.TIF")
     search_pattern_jp2 = os.path.join(folder, "IMG*_R*C*.JP2")
     img_files = glob.glob(search_pattern_tif) + glob.glob(search_pattern_jp2)
 
-    cmd = "gdalbuildvrt {} {}".format(target, " ".join(img_files))
+    cmd = ["gdalbuildvrt", target] + img_files
 
     sh(cmd, debug=debug)
 
 
+def source_sentinel2_autofill(sources: list[dict], params: dict, debug=False):
+    """Expose the band of the Sentinel-2 products of the sources as mp images
+
+    The band image is found from the SAFE metadata and exposed by a VRT (no pixel is
+    copied), on the common grid of all the products if `sentinel2-align` is set"""
+    products = [s for s in sources if s.get("sentinel2", None) is not None]
+    if len(products) == 0:
+        return sources
+    band = params.get("sentinel2-band", "B08")
+    logger.info("Autofill {} from Sentinel-2 products".format(band))
+    grids = {}
+    for s in products:
+        grids[s["id"]] = sentinel2_band(
+            s["sentinel2"], band, params.get("sentinel2-tile", None)
+        )
+    common = None
+    if params.get("sentinel2-align", False):
+        common = common_grid(list(grids.values()))
+        logger.info(
+            "Sentinel-2 images aligned on a {}x{} grid".format(common[0], common[1])
+        )
+    folder = os.path.abspath(params.get("output", "."))
+    for s in products:
+        s["mp"] = os.path.join(folder, DIR_S2 + s["id"] + ".vrt")
+        if not debug:
+            os.makedirs(os.path.dirname(s["mp"]), exist_ok=True)
+            sentinel2_vrt(grids[s["id"]], s["mp"], common)
+    return sources
+
+
+def sentinel2_band(product: str, band: str, tile: str | None = None) -> dict:
+    """Image file and grid of a band of a Sentinel-2 product (SAFE folder)"""
+    mtd = find_product(product)
+    if mtd is None:
+        raise ValueError("No Sentinel-2 metadata in: {}".format(product))
+    granule = read_safe(mtd).granule(tile)
+    if granule is None:
+        raise ValueError("No granule {} in: {}".format(tile, mtd))
+    image = granule.image(band)
+    if image is None:
+        raise ValueError("No band {} in: {}".format(band, mtd))
+    path, resolution = image
+    folder = os.path.dirname(mtd)
+    geocoding = read_tile(os.path.join(folder, "GRANULE", granule.folder, TILE_FILE))
+    grid = geocoding.grid(resolution)
+    if grid is None:
+        raise ValueError("No {}m grid for granule {}".format(resolution, granule.tile))
+    return {
+        "path": os.path.join(folder, path),
+        "epsg": geocoding.epsg,
+        "size": list(grid[:2]),
+        "geotransform": grid[2],
+    }
+
+
+def common_grid(grids: list[dict]) -> tuple:
+    """(width, height, geotransform) of the intersection of grids sharing the same
+    projection and resolution"""
+    gt = grids[0]["geotransform"]
+    for g in grids:
+        if g["epsg"] != grids[0]["epsg"] or g["geotransform"][1] != gt[1]:
+            raise ValueError(
+                "Sentinel-2 images not aligned, different projection or resolution: "
+                "{}".format(g["path"])
+            )
+    xmin = max([g["geotransform"][0] for g in grids])
+    ymax = min([g["geotransform"][3] for g in grids])
+    xmax = min([g["geotransform"][0] + g["size"][0] * gt[1] for g in grids])
+    ymin = max([g["geotransform"][3] + g["size"][1] * gt[5] for g in grids])
+    width = int(round((xmax - xmin) / gt[1]))
+    height = int(round((ymin - ymax) / gt[5]))
+    if width <= 0 or height <= 0:
+        raise ValueError("Sentinel-2 images do not intersect")
+    return width, height, [xmin, gt[1], 0.0, ymax, 0.0, gt[5]]
+
+
+def sentinel2_vrt(grid: dict, target: str, common: tuple | None = None):
+    """Write the VRT of a band, cropped to the common grid if any"""
+    width, height = grid["size"]
+    gt = grid["geotransform"]
+    window = [0, 0, width, height]
+    if common is not None:
+        width, height, gt = common
+        window = [
+            int(round((gt[0] - grid["geotransform"][0]) / gt[1])),
+            int(round((gt[3] - grid["geotransform"][3]) / gt[5])),
+            width,
+            height,
+        ]
+    write_vrt(
+        target,
+        [width, height],
+        [
+            {
+                "dtype": "uint16",
+                "nodata": 0,
+                "sources": [
+                    {
+                        "path": grid["path"],
+                        "band": 1,
+                        "src": window,
+                        "dst": [0, 0, width, height],
+                    }
+                ],
+            }
+        ],
+        geotransform=gt,
+        srs=None if grid["epsg"] is None else "EPSG:{}".format(grid["epsg"]),
+    )
+
+
 def retrieve_dem(params: dict, debug=False) -> str:
     """Retrieve a DEM on the image region using NSBAS command `my_getDemFile.py`"""
-    bbox = retrieve_max2p_bbox(params)
+    bbox = [float(b) for b in retrieve_max2p_bbox(params)]
+    # One retrieval at a time, so that projects on the same area share their DEM
+    with _DEM_LOCK:
+        for extent, cached in _DEM_CACHE.items():
+            # Only a DEM covering the whole bbox [long1, long2, lat1, lat2] is reused
+            covers = extent[0] <= bbox[0] and extent[1] >= bbox[1]
+            covers = covers and extent[2] <= bbox[2] and extent[3] >= bbox[3]
+            if covers and (debug or os.path.isfile(cached)):
+                logger.info("Reusing the retrieved DEM: {}".format(cached))
+                return cached
+        key = tuple(bbox)
+        _DEM_CACHE[key] = _retrieve_dem(params, bbox, debug=debug)
+        return _DEM_CACHE[key]
+
+
+def _retrieve_dem(params: dict, bbox: list[float], debug=False) -> str:
     long1, long2, lat1, lat2 = bbox[0], bbox[1], bbox[2], bbox[3]
     output = params.get("output", ".")
     dst = os.path.join(
@@ -333,10 +562,15 @@ def retrieve_dem(params: dict, debug=False) -> str:
         "cop_dem30_{}_{}_{}_{}".format(int(long1), int(long2), int(lat1), int(lat2)),
     )
 
-    cmd1 = "my_getDemFile.py -s COP_DEM --bbox={},{},{},{} -c /data/ARCHIVES/DEM/COP-DEM_GLO-30-DTED/DEM".format(
-        long1, long2, lat1, lat2
-    )
-    cmd2 = "gdal_translate -of Gtiff {} {}".format(dst + ".dem", dst + ".tif")
+    cmd1 = [
+        "my_getDemFile.py",
+        "-s",
+        "COP_DEM",
+        "--bbox={},{},{},{}".format(long1, long2, lat1, lat2),
+        "-c",
+        "/data/ARCHIVES/DEM/COP-DEM_GLO-30-DTED/DEM",
+    ]
+    cmd2 = ["gdal_translate", "-of", "Gtiff", dst + ".dem", dst + ".tif"]
     if not debug:
         sh(cmd1)
         sh(cmd2)
@@ -345,6 +579,6 @@ def retrieve_dem(params: dict, debug=False) -> str:
         os.remove(dst + ".dem.aux.xml")
         os.remove(dst + ".dem.rsc")
     else:
-        print(cmd1)
-        print(cmd2)
+        print(shlex.join(cmd1))
+        print(shlex.join(cmd2))
     return dst + ".tif"
@@ -0,0 +1,131 @@
+"""
+Coarse-to-fine pre-pass deriving a tight corr-search for each pair
+
+Each pair is correlated on heavily downsampled versions of its images (VRT reading
+the internal overviews when available). The disparity envelope measured on the
+coarse result is scaled back to full resolution, padded and saved next to the pair
+outputs, so that the full resolution stereo only searches around the real motion.
+
+Parameters from the `[prepass]` section of the parameter file:
+* factor: downsampling factor of the coarse images (default 8)
+* padding: padding of the measured envelope, in full resolution pixels (default 5)
+* workers: number of coarse pairs correlated simultaneously (default 4)
+* percentile: fraction of outlier disparities ignored on each side, among the valid
+  pixels of the coarse disparity (default 0.005)
+* stereo: parallel_stereo options overriding `[stereo]` for the coarse run
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+from copy import deepcopy
+
+import numpy as np
+
+from asp import sh, stereo
+from blocks import Raster, blocks, read_block
+
+logger = logging.getLogger(__name__)
+
+CORR_SEARCH_FILE = "corr-search.json"
+PREPASS_DIR = "prepass"
+
+
+def corr_search_file(output: str) -> str:
+    """Path of the corr-search derived for a stereo output prefix"""
+    return os.path.join(os.path.dirname(output), CORR_SEARCH_FILE)
+
+
+def read_corr_search(output: str) -> list[int] | None:
+    """Fetch the corr-search derived by the pre-pass for a stereo output prefix"""
+    try:
+        with open(corr_search_file(output), "r") as infile:
+            return json.load(infile)["corr-search"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def downsample(image: str, output: str, factor: float, debug=False):
+    """Virtual downsampled image (no pixel is copied, overviews are used if any)"""
+    percent = "{}%".format(100 / factor)
+    cmd = ["gdal_translate", "-of", "VRT", "-r", "average"]
+    cmd += ["-outsize", percent, percent, image, output]
+    sh(cmd, debug=debug)
+
+
+def coarse_params(params: dict) -> dict:
+    """Stereo parameters for the coarse run, with the worst-case window downscaled
+    (corr-search already shifted by the grid offset of the pair, if corrected)"""
+    options = params.get("prepass", {})
+    factor = options.get("factor", 8)
+    coarse = deepcopy(params)
+    coarse["stereo"].update(options.get("stereo", {}))
+    corr_search = coarse["stereo"].get("corr-search", None)
+    if corr_search is not None:
+        # One more coarse pixel on each side to measure motion near the window edge
+        coarse["stereo"]["corr-search"] = [
+            math.floor(corr_search[0] / factor) - 1,
+            math.floor(corr_search[1] / factor) - 1,
+            math.ceil(corr_search[2] / factor) + 1,
+            math.ceil(corr_search[3] / factor) + 1,
+        ]
+    return coarse
+
+
+def envelope(disparity: str, percentile: float, block=1024) -> list[float] | None:
+    """Robust [min_x, min_y, max_x, max_y] of the valid pixels of a disparity map
+    (None if none is valid)"""
+    raster = Raster(disparity, os.path.dirname(os.path.abspath(disparity)))
+    values = []
+    try:
+        for core, _ in blocks(raster.width, raster.height, block):
+            data = read_block(raster.data, core).astype(np.float32)
+            # Invalid pixels have a null disparity, only flagged by the third band
+            valid = np.isfinite(data[:2]).all(axis=0) & (data[2] > 0)
+            values.append(data[:2, valid])
+    finally:
+        raster.close()
+    values = np.concatenate(values, axis=1)
+    if values.shape[1] == 0:
+        return None
+    low = np.quantile(values, percentile, axis=1)
+    high = np.quantile(values, 1 - percentile, axis=1)
+    return [float(low[0]), float(low[1]), float(high[0]), float(high[1])]
+
+
+def prepass(imgs: list[str], output: str, params: dict, debug=False):
+    """Correlate a pair at coarse resolution and save its padded corr-search"""
+    options = params.get("prepass", {})
+    factor = options.get("factor", 8)
+    padding = options.get("padding", 5)
+    folder = os.path.join(os.path.dirname(output), PREPASS_DIR)
+    if not debug:
+        os.makedirs(folder, exist_ok=True)
+
+    coarse = []
+    for i, img in enumerate(imgs):
+        coarse.append(os.path.join(folder, "coarse-{}.vrt".format(i + 1)))
+        downsample(img, coarse[-1], factor, debug=debug)
+    prefix = os.path.join(folder, "stereo")
+    stereo(coarse, None, prefix, coarse_params(params), debug=debug)
+    if debug:
+        return
+
+    bounds = envelope(prefix + "-F.tif", options.get("percentile", 0.005))
+    if bounds is None:
+        logger.warning(
+            "Pre-pass failed, keeping the default corr-search: {}".format(output)
+        )
+        return
+    corr_search = [
+        math.floor(bounds[0] * factor) - padding,
+        math.floor(bounds[1] * factor) - padding,
+        math.ceil(bounds[2] * factor) + padding,
+        math.ceil(bounds[3] * factor) + padding,
+    ]
+    logger.info("Derived corr-search {}: {}".format(corr_search, output))
+    with open(corr_search_file(output), "w") as outfile:
+        json.dump({"corr-search": corr_search, "factor": factor}, outfile)
+    shutil.rmtree(folder)
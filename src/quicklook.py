@@ -0,0 +1,212 @@
+"""
+Overviews and quick-looks of the products, for review without reading full rasters
+
+After each stage of a workflow, the products found in the output folder (stereo
+disparities, NCC, filtered disparities, displacements, DEM, map-projected and SAR
+images, mosaic) that are new or modified are handed to a pool of processes running
+in the background while the next stages go on:
+* a small colourised quick-look is written in `QUICKLOOK/` (PNG colour relief of the
+  relevant band for the products, JPEG for the images)
+* once the workflow is done (the products are not read by later steps anymore),
+  internal overviews are added (`gdaladdo`), unless the products are converted into
+  COG (with overviews) by the retention
+
+Finally, an index of all the quick-looks of the project
+(`QUICKLOOK/index.html`) gives the thumbnails grouped by product, linked to the
+quick-looks and listing the paths of the products.
+
+Parameters from the `[quicklook]` section of the parameter file:
+* size: width of the quick-looks in pixels (default 1024)
+* overviews: add internal overviews (default true)
+* workers: number of processes (default 4)
+"""
+
+import glob
+import html
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from asp import sh
+from params import DIR_MP_MS, DIR_MP_PAN, DIR_PANSHARP, DIR_STEREO
+
+logger = logging.getLogger(__name__)
+
+DIR_QUICKLOOK = "QUICKLOOK/"
+INDEX = "index.html"
+# Product kind > (glob from the output folder, band, colour ramp or None for JPEG)
+PRODUCTS = {
+    "disparity": (DIR_STEREO + "*/*-F.tif", 1, "diverging"),
+    "filtered": (DIR_STEREO + "*/*-F-filtered.tif", 1, "diverging"),
+    "ncc": (DIR_STEREO + "*/*-ncc.tif", 1, "ncc"),
+    "displacement": (DIR_STEREO + "*/*-disp.tif", 3, "magnitude"),
+    "fragment": (DIR_STEREO + "*/*-DEM.tif", 1, "terrain"),
+    "dem": ("dem.tif", 1, "terrain"),
+    "mp-pan": (DIR_MP_PAN + "*.tif", 1, None),
+    "mp-ms": (DIR_MP_MS + "*.tif", 1, None),
+    "pansharp": (DIR_PANSHARP + "*.tif", 1, None),
+    "sar": ("SAR/*.tif", 1, None),
+}
+# Colour ramps of gdaldem color-relief, stretched on the percentiles of the band
+RAMPS = {
+    "diverging": [("0%", 33, 102, 172), ("50%", 247, 247, 247), ("100%", 178, 24, 43)],
+    "ncc": [("0%", 68, 1, 84), ("50%", 33, 145, 140), ("100%", 253, 231, 37)],
+    "magnitude": [("0%", 255, 255, 204), ("50%", 253, 141, 60), ("100%", 128, 0, 38)],
+    "terrain": [
+        ("0%", 0, 97, 71),
+        ("33%", 232, 215, 125),
+        ("66%", 161, 67, 0),
+        ("100%", 255, 255, 255),
+    ],
+}
+
+
+class QuickLooks:
+    """Build the overviews and quick-looks of the products in a background process
+    pool"""
+
+    def __init__(self, params: dict, debug=False):
+        options = params.get("quicklook", {})
+        self.output = params.get("output", ".")
+        self.folder = os.path.join(self.output, DIR_QUICKLOOK)
+        self.size = options.get("size", 1024)
+        # COG products already have overviews
+        self.overviews = options.get("overviews", True) and not (
+            "retention" in params and params["retention"].get("cog", True)
+        )
+        self.debug = debug
+        self.pool = ProcessPoolExecutor(max_workers=options.get("workers", 4))
+        self.futures = {}
+        # Products waiting for their overviews
+        self.pending = set()
+
+    def scan(self, final=False):
+        """Submit the products without an up to date quick-look (and the overviews
+        once final)"""
+        if not self.debug:
+            os.makedirs(self.folder, exist_ok=True)
+            write_ramps(self.folder)
+        for kind, (pattern, band, ramp) in PRODUCTS.items():
+            for product in sorted(glob.glob(os.path.join(self.output, pattern))):
+                target = self.quicklook(product, ramp)
+                if product in self.futures and not self.futures[product].done():
+                    if not final:
+                        continue
+                    self.result(product)
+                stale = not os.path.isfile(target) or os.path.getmtime(
+                    target
+                ) < os.path.getmtime(product)
+                overviews = final and self.overviews
+                if not stale and not (overviews and product in self.pending):
+                    continue
+                if self.overviews and not final:
+                    self.pending.add(product)
+                else:
+                    self.pending.discard(product)
+                self.futures[product] = self.pool.submit(
+                    build,
+                    product,
+                    target,
+                    band,
+                    ramp,
+                    self.folder,
+                    self.size,
+                    overviews,
+                    debug=self.debug,
+                )
+
+    def result(self, product: str):
+        try:
+            self.futures[product].result()
+        except Exception as e:
+            logger.error("Quick-look failed: {} ({})".format(product, e))
+
+    def quicklook(self, product: str, ramp: str | None) -> str:
+        """Quick-look of a product, named after its path in the output folder"""
+        name = os.path.relpath(product, self.output).replace(os.sep, "_")
+        extension = ".jpg" if ramp is None else ".png"
+        return os.path.join(self.folder, os.path.splitext(name)[0] + extension)
+
+    def wait(self):
+        """Add the overviews, wait for the quick-looks and write the index"""
+        self.scan(final=True)
+        for product in self.futures:
+            self.result(product)
+        self.pool.shutdown()
+        self.futures = {}
+        if not self.debug:
+            self.write_index()
+
+    def write_index(self):
+        """HTML index of the quick-looks of the project, grouped by product"""
+        sections = []
+        for kind, (pattern, _, ramp) in PRODUCTS.items():
+            cells = []
+            for product in sorted(glob.glob(os.path.join(self.output, pattern))):
+                target = self.quicklook(product, ramp)
+                if not os.path.isfile(target):
+                    continue
+                name = html.escape(os.path.basename(target))
+                path = html.escape(os.path.relpath(product, self.output))
+                cells.append(
+                    '<figure><a href="{0}"><img src="{0}" loading="lazy"></a>'
+                    "<figcaption>{1}</figcaption></figure>".format(name, path)
+                )
+            if len(cells) > 0:
+                sections.append(
+                    "<h2>{} ({})</h2>\n<div>{}</div>".format(
+                        kind, len(cells), "\n".join(cells)
+                    )
+                )
+        with open(os.path.join(self.folder, INDEX), "w") as outfile:
+            outfile.write(
+                "<!DOCTYPE html>\n<html><head><meta charset='utf-8'>"
+                "<title>Quick-looks</title><style>"
+                "div {{display: flex; flex-wrap: wrap}} "
+                "img {{width: 256px}} figcaption {{font-size: small; width: 256px}}"
+                "</style></head><body>\n"
+                "{}\n</body></html>\n".format("\n".join(sections))
+            )
+        logger.info("Quick-look index: {}".format(os.path.join(self.folder, INDEX)))
+
+
+def write_ramps(folder: str):
+    for name, ramp in RAMPS.items():
+        with open(os.path.join(folder, name + ".txt"), "w") as outfile:
+            for value, r, g, b in ramp:
+                outfile.write("{} {} {} {} 255\n".format(value, r, g, b))
+            outfile.write("nv 0 0 0 0\n")
+
+
+def build(
+    product: str,
+    target: str,
+    band: int,
+    ramp: str | None,
+    folder: str,
+    size: int,
+    overviews=True,
+    debug=False,
+):
+    """Add the overviews of a product and write its quick-look (in a worker process)"""
+    if overviews:
+        cmd = ["gdaladdo", "-r", "average", "--config", "COMPRESS_OVERVIEW", "DEFLATE"]
+        sh(cmd + [product, 2, 4, 8, 16, 32], debug=debug)
+    tmp = os.path.splitext(target)[0] + ".part"
+    if ramp is None:
+        cmd = ["gdal_translate", "-of", "JPEG", "-b", band, "-outsize", size, 0]
+        sh(
+            cmd + ["-r", "average", "-ot", "Byte", "-scale", product, tmp + ".jpg"],
+            debug=debug,
+        )
+    else:
+        # Downsampled band (read from the overviews), then colourised
+        cmd = ["gdal_translate", "-of", "GTiff", "-b", band, "-outsize", size, 0]
+        sh(cmd + ["-r", "average", product, tmp + ".tif"], debug=debug)
+        cmd = ["gdaldem", "color-relief", "-of", "PNG", "-alpha", tmp + ".tif"]
+        sh(cmd + [os.path.join(folder, ramp + ".txt"), tmp + ".png"], debug=debug)
+    if not debug:
+        os.replace(tmp + os.path.splitext(target)[1], target)
+        for path in [tmp + ".tif", tmp + ".png.aux.xml", tmp + ".jpg.aux.xml"]:
+            if os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,143 @@
+"""
+Retention policy of the stereo intermediate files and finalisation of the products
+
+Once every step consuming a stereo output is done for a pair, the intermediate files
+written by parallel_stereo (-L, -R, -D, -RD, masks, sub-sampled images and tile
+folders) are deleted or moved to an archive folder, and the final products (-F,
+-ncc, -DEM) are converted in the background into tiled and compressed Cloud
+Optimized GeoTIFFs with overviews.
+
+Parameters from the `[retention]` section of the parameter file:
+* mode: "delete" (default), "archive" or "keep" the intermediate files
+* archive: archive folder, relative to the output folder (default "ARCHIVE")
+* keep: additional file suffixes to keep (default ["-PC.tif"])
+* cog: convert the final products into COG (default true)
+* compress: COG compression (default "DEFLATE")
+* workers: number of simultaneous COG conversions (default 2)
+"""
+
+import glob
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from asp import gdal_info, sh
+
+logger = logging.getLogger(__name__)
+
+PRODUCTS = ["-F.tif", "-ncc.tif", "-F-filtered.tif", "-disp.tif", "-DEM.tif"]
+KEEP = ["-PC.tif"]
+# Tile folders of parallel_stereo: prefix-0_0_2048_2048
+RE_TILE_DIR = re.compile(r"-\d+_\d+_\d+_\d+$")
+
+
+class Retention:
+    """Apply the retention policy to stereo outputs, in a background thread pool"""
+
+    def __init__(self, params: dict, debug=False):
+        options = params.get("retention", {})
+        self.mode = options.get("mode", "delete")
+        if self.mode not in ["delete", "archive", "keep"]:
+            raise ValueError("Unknown retention mode: {}".format(self.mode))
+        self.output = params.get("output", ".")
+        self.archive = os.path.join(self.output, options.get("archive", "ARCHIVE"))
+        self.keep = PRODUCTS + options.get("keep", KEEP)
+        self.cog = options.get("cog", True)
+        self.compress = options.get("compress", "DEFLATE")
+        self.debug = debug
+        self.pool = ThreadPoolExecutor(max_workers=options.get("workers", 2))
+        self.futures = []
+
+    def submit(self, prefix: str, products: list[str] | None = None):
+        """Finalise a stereo output prefix once all its consumers are done"""
+        self.futures.append(self.pool.submit(self.finalise, prefix, products))
+
+    def submit_product(self, raster: str):
+        """Convert a single final raster (outside of the stereo folders) into COG"""
+        if self.cog:
+            self.futures.append(
+                self.pool.submit(to_cog, raster, self.compress, debug=self.debug)
+            )
+
+    def wait(self):
+        """Wait for all the background finalisations"""
+        for f in self.futures:
+            f.result()
+        self.pool.shutdown()
+        self.futures = []
+
+    def finalise(self, prefix: str, products: list[str] | None = None):
+        if self.mode != "keep":
+            self.clean(prefix)
+        if self.cog:
+            if products is None:
+                products = [prefix + p for p in PRODUCTS]
+            for p in products:
+                if os.path.isfile(p) or self.debug:
+                    to_cog(p, self.compress, debug=self.debug)
+
+    def clean(self, prefix: str):
+        """Delete or archive the intermediate files of a stereo prefix"""
+        for path in intermediates(prefix, self.keep):
+            if self.debug:
+                logger.info("{} {}".format(self.mode, path))
+            elif self.mode == "archive":
+                pair = os.path.basename(os.path.dirname(prefix))
+                target = os.path.join(self.archive, pair)
+                os.makedirs(target, exist_ok=True)
+                shutil.move(path, os.path.join(target, os.path.basename(path)))
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def intermediates(prefix: str, keep: list[str]) -> list[str]:
+    """List the intermediate rasters and tile folders of a stereo prefix"""
+    found = []
+    for path in glob.glob(glob.escape(prefix) + "-*"):
+        suffix = path[len(prefix) :]
+        if any([suffix == k for k in keep]):
+            continue
+        if os.path.isdir(path):
+            if RE_TILE_DIR.search(path) is not None:
+                found.append(path)
+        elif suffix.lower().endswith((".tif", ".tiff")):
+            found.append(path)
+    return found
+
+
+def is_cog(raster: str) -> bool:
+    try:
+        structure = gdal_info(raster)["metadata"]["IMAGE_STRUCTURE"]
+    except (TypeError, KeyError):
+        return False
+    return structure.get("LAYOUT", None) == "COG"
+
+
+def cog_translate(
+    raster: str, output: str, compress: str = "DEFLATE", debug=False, check=True
+):
+    """Write a raster (or VRT) as a Cloud Optimized GeoTIFF (with overviews)"""
+    cmd = ["gdal_translate", "-of", "COG", "-co", "COMPRESS={}".format(compress)]
+    cmd += ["-co", "BIGTIFF=IF_SAFER", "-co", "NUM_THREADS=ALL_CPUS", raster, output]
+    return sh(cmd, debug=debug, check=check)
+
+
+def to_cog(raster: str, compress: str = "DEFLATE", debug=False):
+    """Convert a raster in place into a Cloud Optimized GeoTIFF, keeping its
+    modification time (the data is unchanged, e.g for the mosaic manifest)"""
+    if not debug and is_cog(raster):
+        return
+    tmp = raster + ".cog.tif"
+    result = cog_translate(raster, tmp, compress, debug=debug, check=False)
+    if result is not None and result.returncode == 0:
+        st = os.stat(raster)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, raster)
+    elif result is not None:
+        logger.error("COG conversion failed: {}".format(raster))
+        if os.path.isfile(tmp):
+            os.remove(tmp)
@@ -0,0 +1,717 @@
+"""
+Structured execution of the workflow commands
+
+Every command launched by a workflow belongs to a `Job`. Commands are run through
+`run`, which streams the child output to the console while parsing the stage and
+progress messages printed by ASP. The `Tracker` aggregates the state of all the
+jobs of the project into a progress view (logger) and a status file written in
+the output folder, with an ETA based on the throughput measured on previous runs
+of the same preset.
+
+In batch mode, several projects run in the same process: each project thread has
+its own tracker, and the jobs of all the projects are served by one shared
+`Scheduler` by priority and weighted fair share.
+
+A failing job does not stop the workflow: commands failing for a transient reason
+(killed by a signal, I/O error) are retried with an exponential backoff, the jobs
+depending on a failed job are skipped, and the failures are listed in a report at
+the end of the workflow.
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from geotiff import read_header
+from timeline import (
+    TRACE_FILE,
+    critical_path,
+    first_start,
+    idle_times,
+    timed,
+    write_trace,
+)
+
+logger = logging.getLogger(__name__)
+
+STATUS_FILE = "aspeo-status.json"
+FAILURE_FILE = "aspeo-failures.json"
+HISTORY_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "aspeo", "throughput.json"
+)
+# Minimum delay between two status file writes during a job (s)
+STATUS_INTERVAL = 5
+# Weight of the newest measure in the historical throughput
+HISTORY_WEIGHT = 0.3
+
+# Stages printed by the ASP stereo tools: "[ time ] : Stage 1 --> CORRELATION"
+ASP_STAGES = [
+    "PREPROCESSING",
+    "CORRELATION",
+    "REFINEMENT",
+    "FILTERING",
+    "TRIANGULATION",
+]
+RE_ASP_STAGE = re.compile(r"Stage\s+(\d)\s+-->\s+(\w+)")
+# Progress bars of ASP tools: "Correlation: [*****........] 45%"
+RE_PERCENT = re.compile(r"\]\s*(\d{1,3}(?:\.\d+)?)\s*%")
+# parallel_stereo tiling: "Number of tiles: 4 x 3 = 12" then one folder per tile
+RE_TILES = re.compile(r"Number of tiles:.*=\s*(\d+)")
+RE_TILE = re.compile(r"-(\d+_\d+_\d+_\d+)\b")
+
+
+class CommandError(RuntimeError):
+    """A command exited with a non-zero code"""
+
+    def __init__(self, cmd: str, returncode: int):
+        super().__init__("exit code {}: {}".format(returncode, cmd))
+        self.cmd = cmd
+        self.returncode = returncode
+
+
+# Exit codes of commands killed by a signal (SIGKILL of the OOM killer, SIGTERM,
+# SIGBUS on a network file system hiccup), negative when killed directly, 128 + n
+# through a wrapper script
+SIGNALS = [9, 15, 7]
+TRANSIENT_CODES = [-s for s in SIGNALS] + [128 + s for s in SIGNALS]
+# Errors of missing or unreadable inputs, which fail again at each attempt
+PERMANENT_OSERRORS = (FileNotFoundError, PermissionError, IsADirectoryError)
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failure is worth retrying (killed for memory, network file system
+    hiccups, ...), unlike bad arguments, missing inputs or ASP assertions"""
+    if isinstance(error, CommandError):
+        return error.returncode in TRANSIENT_CODES
+    return isinstance(error, OSError) and not isinstance(error, PERMANENT_OSERRORS)
+
+
+class Job:
+    """A unit of work of a workflow (usually one ASP command on one source or pair)
+
+    :param name: identifier of the job inside its stage (source id, pair, ...)
+    :param stage: workflow step the job belongs to (stereo, corr-eval, ...)
+    :param func: callable doing the work, taking no argument
+    :param megapixels: size of the processed image, used for throughput and ETA
+    :param then: optional callable launched once the job is done
+    :param after: jobs that must be done for this one to run (skipped otherwise)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        stage: str,
+        func,
+        megapixels: float | None = None,
+        then=None,
+        after: list | None = None,
+    ):
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.megapixels = megapixels
+        self.then = then
+        self.after = [] if after is None else after
+        self.error = None
+        self.tracker = None
+        # Worker slot that ran the job (lane of the timeline)
+        self.slot = None
+        self.state = "queued"
+        self.start = None
+        self.end = None
+        # (start, end, slot, error) of the failed attempts before the last one
+        self.attempts = []
+        self.progress = 0.0
+        self.asp_stage = None
+        self.tiles = None
+        self.tiles_seen = set()
+
+    def __repr__(self):
+        return "Job({}:{}, {})".format(self.stage, self.name, self.state)
+
+    def duration(self) -> float:
+        if self.start is None:
+            return 0.0
+        end = self.end if self.end is not None else time.time()
+        return end - self.start
+
+    def parse(self, line: str):
+        """Update the job progress from a line of the command output"""
+        stage = RE_ASP_STAGE.search(line)
+        if stage is not None:
+            self.asp_stage = stage.group(2)
+            self.tiles_seen = set()
+            self.progress = max(self.progress, int(stage.group(1)) / len(ASP_STAGES))
+            return True
+        tiles = RE_TILES.search(line)
+        if tiles is not None:
+            self.tiles = int(tiles.group(1))
+            return True
+        if self.tiles is not None:
+            tile = RE_TILE.search(line)
+            if tile is not None and tile.group(1) not in self.tiles_seen:
+                self.tiles_seen.add(tile.group(1))
+                return self.set_fraction(len(self.tiles_seen) / self.tiles)
+        percent = RE_PERCENT.search(line)
+        if percent is not None:
+            return self.set_fraction(float(percent.group(1)) / 100)
+        return False
+
+    def set_fraction(self, fraction: float) -> bool:
+        """Set the progress inside the current ASP stage (or the whole command)"""
+        fraction = min(max(fraction, 0.0), 1.0)
+        if self.asp_stage in ASP_STAGES:
+            index = ASP_STAGES.index(self.asp_stage)
+            fraction = (index + fraction) / len(ASP_STAGES)
+        self.progress = max(self.progress, fraction)
+        return True
+
+
+class Tracker:
+    """Aggregate the progress of all the jobs of a project"""
+
+    def __init__(self, name: str | None = None):
+        # Project name, displayed when several projects share the console
+        self.name = name
+        self.jobs = []
+        # Job running in each thread, to attribute the command outputs
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.preset = "default"
+        self.status_file = None
+        self.retries = 0
+        self.backoff = 60
+        self.stop_on_error = False
+        # Callables taking the job, called before it runs and once it is over
+        self.before = []
+        self.after = []
+        self.last_write = 0.0
+        self.history = shared_history()
+
+    def configure(self, params: dict, debug=False):
+        """Attach the tracker to a project (status file and preset history)"""
+        self.preset = params.get("name", "default")
+        self.retries = params.get("retries", 0)
+        self.backoff = params.get("retry-backoff", 60)
+        self.stop_on_error = params.get("stop-on-error", False)
+        if not debug:
+            output = params.get("output", ".")
+            os.makedirs(output, exist_ok=True)
+            self.status_file = os.path.join(output, STATUS_FILE)
+
+    def plan(self, jobs: list[Job]):
+        """Register jobs as queued so they appear in the progress view"""
+        for j in jobs:
+            j.tracker = self
+            if j not in self.jobs:
+                self.jobs.append(j)
+
+    def start(self, job: Job):
+        with self.lock:
+            if job.start is not None and job.end is not None:
+                job.attempts.append((job.start, job.end, job.slot, str(job.error)))
+            job.error = None
+            job.state = "running"
+            job.start = time.time()
+            # Lowest slot not taken by another running job
+            busy = [j.slot for j in self.jobs if j.state == "running" and j is not job]
+            job.slot = min(set(range(len(busy) + 1)) - set(busy))
+            self.local.job = job
+            self.report(job)
+
+    def finish(self, job: Job, debug=False):
+        with self.lock:
+            job.state = "done"
+            job.end = time.time()
+            job.progress = 1.0
+            self.local.job = None
+            if not debug:
+                self.record(job)
+            self.report()
+
+    def fail(self, job: Job, error: Exception):
+        with self.lock:
+            job.state = "failed"
+            job.end = time.time()
+            job.error = error
+            self.local.job = None
+            self.report()
+
+    def skip(self, job: Job, cause: Job):
+        with self.lock:
+            job.state = "skipped"
+            job.error = "{} {}: {}".format(cause.stage, cause.state, cause.name)
+            logger.warning(
+                "Skipping {}: {} ({})".format(job.stage, job.name, job.error)
+            )
+            self.write_status()
+
+    def failures(self) -> list[dict]:
+        return [
+            {"stage": j.stage, "name": j.name, "state": j.state, "error": str(j.error)}
+            for j in self.jobs
+            if j.state in ["failed", "skipped"]
+        ]
+
+    def report_failures(self) -> int:
+        """List the failed and skipped jobs to re-run (logger and failure file)"""
+        failures = self.failures()
+        for f in failures:
+            logger.error(
+                "{} {}: {} ({})".format(f["state"], f["stage"], f["name"], f["error"])
+            )
+        if self.status_file is not None:
+            report = os.path.join(os.path.dirname(self.status_file), FAILURE_FILE)
+            if len(failures) > 0:
+                with open(report, "w") as outfile:
+                    json.dump(failures, outfile, indent=2)
+            elif os.path.isfile(report):
+                os.remove(report)
+        if len(failures) > 0:
+            logger.error("{} jobs to re-run".format(len(failures)))
+        return len(failures)
+
+    def report_trace(self):
+        """Write the timeline of the run and log its critical path and idle slots"""
+        jobs = timed(self.jobs)
+        if len(jobs) == 0:
+            return
+        if self.status_file is not None:
+            output = os.path.join(os.path.dirname(self.status_file), TRACE_FILE)
+            write_trace(jobs, output, name=self.name or self.preset)
+        wall = max([j.end for j in jobs]) - first_start(jobs[0])
+        path = critical_path(jobs)
+        logger.info(
+            "Critical path: {} jobs, {} busy over {}".format(
+                len(path),
+                format_duration(sum([j.duration() for j in path])),
+                format_duration(wall),
+            )
+        )
+        for j in path:
+            logger.info(
+                "  {}: {} ({}, slot {})".format(
+                    j.stage, j.name, format_duration(j.duration()), j.slot
+                )
+            )
+        for slot, idle in idle_times(jobs).items():
+            logger.info(
+                "Slot {} idle {} ({:.0f}%)".format(
+                    slot, format_duration(idle), 100 * idle / wall if wall > 0 else 0
+                )
+            )
+
+    def update(self, line: str):
+        """Forward a line of output to the job running in this thread"""
+        job = getattr(self.local, "job", None)
+        if job is None:
+            return
+        if job.parse(line) and time.time() - self.last_write > STATUS_INTERVAL:
+            with self.lock:
+                self.write_status()
+
+    def throughput(self, stage: str) -> float | None:
+        """Throughput of a stage in megapixels/s, measured in this run or historical"""
+        done = [
+            j
+            for j in self.jobs
+            if j.stage == stage and j.state == "done" and j.megapixels is not None
+        ]
+        seconds = sum([j.duration() for j in done])
+        if seconds > 0:
+            return sum([j.megapixels for j in done]) / seconds
+        return self.history.get(self.preset, {}).get(stage, None)
+
+    def eta(self) -> float | None:
+        """Remaining time (s) for the running and queued jobs, if it can be estimated"""
+        remaining = 0.0
+        for j in self.jobs:
+            if j.state not in ["queued", "running"]:
+                continue
+            rate = self.throughput(j.stage)
+            if j.megapixels is None or rate is None:
+                return None
+            remaining += j.megapixels * (1 - j.progress) / rate
+        return remaining
+
+    def counts(self) -> dict:
+        counts = {"done": 0, "running": 0, "queued": 0, "failed": 0, "skipped": 0}
+        for j in self.jobs:
+            counts[j.state] = counts.get(j.state, 0) + 1
+        return counts
+
+    def stages(self) -> dict:
+        stages = {}
+        for j in self.jobs:
+            s = stages.setdefault(
+                j.stage, {"total": 0, "done": 0, "megapixels": 0.0, "seconds": 0.0}
+            )
+            s["total"] += 1
+            if j.state == "done":
+                s["done"] += 1
+                s["seconds"] += j.duration()
+                if j.megapixels is not None:
+                    s["megapixels"] += j.megapixels
+        for name, s in stages.items():
+            s["throughput"] = self.throughput(name)
+        return stages
+
+    def report(self, job: Job | None = None):
+        """Display the progress view and refresh the status file"""
+        counts = self.counts()
+        message = "" if self.name is None else "[{}] ".format(self.name)
+        message += "Progress: {} done, {} running, {} queued".format(
+            counts["done"], counts["running"], counts["queued"]
+        )
+        if counts["failed"] + counts["skipped"] > 0:
+            message += ", {} failed, {} skipped".format(
+                counts["failed"], counts["skipped"]
+            )
+        if job is not None:
+            rate = self.throughput(job.stage)
+            message += " | {}: {}".format(job.stage, job.name)
+            if rate is not None:
+                message += " ({:.2f} MP/s)".format(rate)
+        eta = self.eta()
+        if eta is not None:
+            message += " | ETA {}".format(format_duration(eta))
+        logger.info(message)
+        self.write_status()
+
+    def write_status(self):
+        self.last_write = time.time()
+        if self.status_file is None:
+            return
+        eta = self.eta()
+        status = {
+            "preset": self.preset,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "jobs": self.counts(),
+            "stages": self.stages(),
+            "running": [
+                {
+                    "stage": j.stage,
+                    "name": j.name,
+                    "progress": round(j.progress, 3),
+                    "asp-stage": j.asp_stage,
+                    "elapsed": round(j.duration()),
+                }
+                for j in self.jobs
+                if j.state == "running"
+            ],
+            "failures": self.failures(),
+            "eta": None if eta is None else round(eta),
+            "eta-time": (
+                None
+                if eta is None
+                else time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.localtime(time.time() + eta)
+                )
+            ),
+        }
+        tmp = self.status_file + ".tmp"
+        with open(tmp, "w") as outfile:
+            json.dump(status, outfile, indent=2)
+        os.replace(tmp, self.status_file)
+
+    def record(self, job: Job):
+        """Blend the throughput of a finished job into the preset history"""
+        if job.megapixels is None or job.duration() <= 0:
+            return
+        rate = job.megapixels / job.duration()
+        with _HISTORY_LOCK:
+            stages = self.history.setdefault(self.preset, {})
+            previous = stages.get(job.stage, None)
+            if previous is not None:
+                rate = HISTORY_WEIGHT * rate + (1 - HISTORY_WEIGHT) * previous
+            stages[job.stage] = rate
+            save_history(self.history)
+
+
+class TrackerProxy:
+    """Tracker of the project driven by the current thread"""
+
+    def __init__(self):
+        self.default = Tracker()
+        self.local = threading.local()
+
+    def bind(self, tracker: Tracker):
+        self.local.tracker = tracker
+
+    def current(self) -> Tracker:
+        return getattr(self.local, "tracker", None) or self.default
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class Scheduler:
+    """Worker pool shared by the projects of a batch
+
+    Projects are served by decreasing priority, then by least consumed time relative
+    to their weight. The jobs submitted together by a project (one stage) keep their
+    own limit of simultaneous jobs.
+    """
+
+    def __init__(self, workers: int):
+        self.cond = threading.Condition()
+        self.projects = {}
+        self.closed = False
+        self.threads = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def register(self, tracker: Tracker, weight: float = 1.0, priority: int = 0):
+        with self.cond:
+            self.projects[tracker] = {
+                "weight": weight,
+                "priority": priority,
+                "served": 0.0,
+                "queue": [],
+            }
+
+    def submit(self, jobs: list[Job], limit: int = 1, debug=False) -> list[Future]:
+        """Queue the jobs of a stage of the project driven by the current thread"""
+        tracker = TRACKER.current()
+        group = {"limit": max(limit, 1), "running": 0}
+        futures = []
+        with self.cond:
+            if tracker not in self.projects:
+                self.register(tracker)
+            for j in jobs:
+                futures.append(Future())
+                self.projects[tracker]["queue"].append((j, group, futures[-1], debug))
+            self.cond.notify_all()
+        return futures
+
+    def pick(self):
+        """Next job to run (lock held), None if all are waiting on their limit"""
+        projects = sorted(
+            self.projects.values(),
+            key=lambda p: (-p["priority"], p["served"] / p["weight"]),
+        )
+        for p in projects:
+            for i, task in enumerate(p["queue"]):
+                group = task[1]
+                if group["running"] < group["limit"]:
+                    group["running"] += 1
+                    del p["queue"][i]
+                    return p, task
+        return None
+
+    def work(self):
+        while True:
+            with self.cond:
+                picked = self.pick()
+                while picked is None:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    picked = self.pick()
+            project, (job, group, future, debug) = picked
+            start = time.time()
+            try:
+                run_job(job, debug=debug)
+                future.set_result(None)
+            except BaseException as e:
+                future.set_exception(e)
+            with self.cond:
+                group["running"] -= 1
+                project["served"] += time.time() - start
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
+
+_HISTORY = None
+_HISTORY_LOCK = threading.Lock()
+
+
+def shared_history() -> dict:
+    """History loaded once and shared by all the trackers of the process"""
+    global _HISTORY
+    with _HISTORY_LOCK:
+        if _HISTORY is None:
+            _HISTORY = load_history()
+        return _HISTORY
+
+
+def load_history() -> dict:
+    """Throughput (MP/s) per preset and stage measured on previous runs"""
+    try:
+        with open(HISTORY_FILE, "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_history(history: dict):
+    try:
+        os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
+        with open(HISTORY_FILE, "w") as outfile:
+            json.dump(history, outfile, indent=2)
+    except OSError as e:
+        logger.warning("Cannot save throughput history: {}".format(e))
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return "{}d{:02d}h".format(seconds // 86400, (seconds % 86400) // 3600)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, (seconds % 3600) // 60)
+    return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+
+
+TRACKER = TrackerProxy()
+# Shared scheduler of the batch mode (jobs are run by each project otherwise)
+SCHEDULER = None
+
+
+def use_scheduler(scheduler: Scheduler | None):
+    global SCHEDULER
+    SCHEDULER = scheduler
+
+
+def run(cmd: list[str]) -> subprocess.CompletedProcess:
+    """Run a command (argument list, no shell), echoing its output and forwarding it
+    to the tracker"""
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=os.environ,
+    )
+    fd = proc.stdout.fileno()
+    pending = b""
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.flush()
+        # Progress bars are refreshed with carriage returns
+        lines = re.split(rb"[\r\n]", pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            TRACKER.update(line.decode(errors="replace"))
+    if pending:
+        TRACKER.update(pending.decode(errors="replace"))
+    proc.stdout.close()
+    return subprocess.CompletedProcess(cmd, proc.wait())
+
+
+def run_job(job: Job, debug=False):
+    tracker = job.tracker if job.tracker is not None else TRACKER.current()
+    # Outputs of the commands are attributed through the tracker of the thread
+    TRACKER.bind(tracker)
+    blocked = [j for j in job.after if j.state != "done"]
+    if len(blocked) > 0:
+        tracker.skip(job, blocked[0])
+        for hook in tracker.after:
+            hook(job)
+        return
+    for hook in tracker.before:
+        hook(job)
+    try:
+        attempt_job(job, tracker, debug=debug)
+    finally:
+        for hook in tracker.after:
+            hook(job)
+
+
+def attempt_job(job: Job, tracker: Tracker, debug=False):
+    for attempt in range(tracker.retries + 1):
+        if attempt > 0:
+            delay = tracker.backoff * 2 ** (attempt - 1)
+            logger.warning(
+                "{}: {} failed ({}), retry {}/{} in {}s".format(
+                    job.stage, job.name, job.error, attempt, tracker.retries, delay
+                )
+            )
+            time.sleep(delay)
+        tracker.start(job)
+        try:
+            job.func()
+        except Exception as e:
+            tracker.fail(job, e)
+            if is_transient(e):
+                continue
+            break
+        tracker.finish(job, debug=debug)
+        if job.then is not None:
+            job.then()
+        return
+    logger.error("{}: {} failed ({})".format(job.stage, job.name, job.error))
+    if tracker.stop_on_error:
+        raise job.error
+
+
+def run_jobs(jobs: list[Job], workers: int = 1, executor=None, debug=False):
+    """Run the jobs of a stage, one after the other or in a pool of threads
+
+    :param executor: concurrent.futures like executor to submit the jobs to instead
+    """
+    TRACKER.plan(jobs)
+    if executor is not None:
+        futures = [executor.submit(run_job, j, debug=debug) for j in jobs]
+        for f in futures:
+            f.result()
+        return
+    if SCHEDULER is not None:
+        for f in SCHEDULER.submit(jobs, limit=workers, debug=debug):
+            f.result()
+        return
+    if workers <= 1:
+        for j in jobs:
+            run_job(j, debug=debug)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, j, debug=debug) for j in jobs]
+        for f in futures:
+            f.result()
+
+
+def core_budget(params: dict) -> int:
+    """Number of cores the run may keep busy (global option `cores`)"""
+    return max(int(params.get("cores", os.cpu_count() or 1)), 1)
+
+
+def split_budget(params: dict, workers: int, jobs: int) -> tuple[int, int]:
+    """Simultaneous jobs and threads per job sharing the core budget"""
+    cores = core_budget(params)
+    workers = max(min(workers, jobs, cores), 1)
+    return workers, max(cores // workers, 1)
+
+
+def megapixels(image: str, debug=False) -> float | None:
+    """Size of an image in megapixels (None if it cannot be read)"""
+    if debug or not os.path.isfile(image):
+        return None
+    try:
+        header = read_header(image)
+        return header["width"] * header["height"] / 1e6
+    except (OSError, ValueError, struct.error):
+        pass
+    try:
+        info = subprocess.run(
+            ["gdalinfo", "-json", image], capture_output=True, text=True
+        )
+        width, height = json.loads(info.stdout)["size"]
+    except (OSError, ValueError, KeyError):
+        return None
+    return width * height / 1e6
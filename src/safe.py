@@ -0,0 +1,199 @@
+"""
+Lightweight reader of the Sentinel-2 SAFE metadata
+
+The product metadata (`MTD_MSIL1C.xml` or `MTD_MSIL2A.xml`) lists the image files
+of each granule (one per MGRS tile), and the metadata of each granule
+(`GRANULE/*/MTD_TL.xml`) gives its projection and its grid at each resolution. Only
+the XML files are read: the band images are never opened. Records are memoized in
+the process, keyed by path and modification time.
+"""
+
+import glob
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+PRODUCT_PATTERN = "MTD_MSIL*.xml"
+TILE_FILE = "MTD_TL.xml"
+# Native resolution of the bands (m)
+RESOLUTIONS = {
+    "B01": 60,
+    "B02": 10,
+    "B03": 10,
+    "B04": 10,
+    "B05": 20,
+    "B06": 20,
+    "B07": 20,
+    "B08": 10,
+    "B8A": 20,
+    "B09": 60,
+    "B10": 60,
+    "B11": 20,
+    "B12": 20,
+}
+
+
+@dataclass(frozen=True, slots=True)
+class Granule:
+    """Image files of a granule
+
+    images: (band, resolution, path relative to the product folder, without
+    extension) of each image file
+    """
+
+    tile: str
+    folder: str
+    images: tuple = ()
+
+    def image(self, band: str, resolution: int | None = None) -> tuple | None:
+        """(path relative to the product folder, resolution) of a band, at its
+        native resolution by default"""
+        resolution = resolution or RESOLUTIONS.get(band, None)
+        found = [i for i in self.images if i[0] == band]
+        for b, res, path in found:
+            if res is None or res == resolution:
+                return path + ".jp2", res or resolution
+        if len(found) > 0:
+            return found[0][2] + ".jp2", found[0][1]
+        return None
+
+
+@dataclass(frozen=True, slots=True)
+class TileGeocoding:
+    """Grid of a granule: epsg, and (ncols, nrows) and (ulx, uly, xdim, ydim) by
+    resolution"""
+
+    epsg: int | None = None
+    sizes: tuple = ()
+    positions: tuple = ()
+
+    def grid(self, resolution: int) -> tuple | None:
+        """(ncols, nrows, geotransform) at a resolution"""
+        size = dict(self.sizes).get(resolution, None)
+        position = dict(self.positions).get(resolution, None)
+        if size is None or position is None:
+            return None
+        ulx, uly, xdim, ydim = position
+        return size[0], size[1], [ulx, xdim, 0.0, uly, 0.0, ydim]
+
+
+@dataclass(frozen=True, slots=True)
+class SafeRecord:
+    """Metadata of a Sentinel-2 product"""
+
+    path: str
+    product_type: str | None = None
+    sensing_time: str | None = None
+    granules: tuple = ()
+
+    def granule(self, tile: str | None = None) -> Granule | None:
+        """Granule of a MGRS tile (e.g "31TCJ"), the first one by default"""
+        for g in self.granules:
+            if tile is None or g.tile == tile.lstrip("T"):
+                return g
+        return None
+
+
+def find_product(folder: str) -> str | None:
+    """Product metadata of a SAFE folder (or of the only SAFE inside a folder)"""
+    found = glob.glob(os.path.join(folder, PRODUCT_PATTERN))
+    found += glob.glob(os.path.join(folder, "*.SAFE", PRODUCT_PATTERN))
+    return found[0] if len(found) > 0 else None
+
+
+def memoized(parse, path: str):
+    stat = os.stat(path)
+    key = (parse.__name__, os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        record = _CACHE.get(key, None)
+    if record is None:
+        record = parse(path)
+        with _LOCK:
+            _CACHE[key] = record
+    return record
+
+
+def read_safe(path: str) -> SafeRecord:
+    """Read the product metadata (memoized until the file is modified)"""
+    return memoized(parse_safe, path)
+
+
+def read_tile(path: str) -> TileGeocoding:
+    """Read the geocoding of a granule metadata (memoized until modified)"""
+    return memoized(parse_tile, path)
+
+
+def local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_safe(path: str) -> SafeRecord:
+    root = ET.parse(path).getroot()
+    values = {}
+    granules = []
+    for elem in root.iter():
+        tag = local(elem.tag)
+        if tag == "PRODUCT_TYPE":
+            values["product_type"] = elem.text
+        elif tag == "PRODUCT_START_TIME":
+            values["sensing_time"] = elem.text
+        elif tag == "Granule":
+            images = []
+            for f in elem:
+                if local(f.tag) in ["IMAGE_FILE", "IMAGE_ID"] and f.text:
+                    images.append(image_entry(f.text.strip()))
+            images = [i for i in images if i is not None]
+            if len(images) == 0:
+                continue
+            # GRANULE/<granule>/IMG_DATA/...
+            folder = images[0][2].split("/")[1]
+            tile = re.search(r"_T(\d{2}[A-Z]{3})_", images[0][2])
+            granules.append(
+                Granule(
+                    tile=tile.group(1) if tile is not None else folder,
+                    folder=folder,
+                    images=tuple(images),
+                )
+            )
+    return SafeRecord(path=os.path.abspath(path), granules=tuple(granules), **values)
+
+
+def image_entry(path: str) -> tuple | None:
+    """(band, resolution or None, path) of an image file of the product metadata"""
+    match = re.search(r"_(B\d[\dA])(?:_(\d+)m)?$", path)
+    if match is None:
+        return None
+    resolution = int(match.group(2)) if match.group(2) is not None else None
+    return match.group(1), resolution, path
+
+
+def parse_tile(path: str) -> TileGeocoding:
+    root = ET.parse(path).getroot()
+    epsg, sizes, positions = None, [], []
+    for elem in root.iter():
+        tag = local(elem.tag)
+        if tag == "HORIZONTAL_CS_CODE" and elem.text:
+            epsg = int(elem.text.split(":")[-1])
+        elif tag == "Size":
+            sizes.append(
+                (
+                    int(elem.get("resolution")),
+                    (int(elem.findtext("{*}NCOLS")), int(elem.findtext("{*}NROWS"))),
+                )
+            )
+        elif tag == "Geoposition":
+            positions.append(
+                (
+                    int(elem.get("resolution")),
+                    tuple(
+                        float(elem.findtext("{*}" + k))
+                        for k in ["ULX", "ULY", "XDIM", "YDIM"]
+                    ),
+                )
+            )
+    return TileGeocoding(epsg=epsg, sizes=tuple(sizes), positions=tuple(positions))
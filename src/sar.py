@@ -0,0 +1,238 @@
+"""
+Log-amplitude preprocessing of SAR images for pixel tracking
+
+The map-projected images derived for each source (`mp-prefix` + id + `mp-suffix`,
+e.g `.VV.mod.tif`) are taken as SAR amplitude (or intensity) images, and turned into
+the log-amplitude images correlated by pixel tracking (`SAR/*_log.tif`, e.g
+`.VV.mod_log.tif`), which replace them as the `mp` images of the sources. Each image
+is processed block by block (memory maps, see `blocks`), the blocks being spread
+over a pool of processes:
+* multilook: mean intensity of `multilook` [x, y] pixels (reduces the resolution)
+* speckle filter: Lee filter of the intensity in a `speckle` window
+* log: natural logarithm of the amplitude ("ln"), or decibels ("db")
+
+Invalid pixels (nodata, zero or negative) are set to NaN. An image is processed
+again only if its input is newer or if the options changed.
+
+Parameters from the `[sar]` section of the parameter file:
+* input: "amplitude" (default) or "intensity"
+* band: band of the input (default 1)
+* multilook: [x, y] number of looks (default [1, 1])
+* speckle: Lee filter window size, odd (default 0: no filtering)
+* looks: equivalent number of looks of the filtered intensity (default the
+  number of multilook pixels)
+* log: "ln" (default) or "db"
+* block: block size in output pixels (default 1024)
+* workers: number of processes (default 4)
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from blocks import (
+    Raster,
+    blocks,
+    create_raw,
+    inner,
+    mapped_raw,
+    mapped_tiff,
+    pack,
+    read_block,
+)
+from geotiff import read_header
+from params import set_mp_header
+from runner import Job, megapixels
+
+logger = logging.getLogger(__name__)
+
+DIR_SAR = "SAR/"
+SAR_SUFFIX = "_log.tif"
+OPTIONS = ["input", "band", "multilook", "speckle", "looks", "log"]
+
+
+def sar_sources(sources: list[dict], params: dict, folder: str, debug=False):
+    """Replace the mp images of the sources by their log-amplitude, and plan the
+    preprocessing of those not up to date
+
+    The georeferencing of the images to process is derived from their input, so that
+    the pairs can be planned (e.g cropped) and sized before the images exist.
+
+    :returns jobs: one job per image to process
+    """
+    multilook = params.get("sar", {}).get("multilook", [1, 1])
+    jobs = []
+    for s in sources:
+        if s.get("mp", None) is None:
+            continue
+        name = os.path.splitext(os.path.basename(s["mp"]))[0] + SAR_SUFFIX
+        output = os.path.join(os.path.abspath(folder), DIR_SAR, name)
+        size = megapixels(s["mp"], debug=debug)
+        if params.get("force", False) or not is_done(s["mp"], output, params):
+            jobs.append(
+                Job(
+                    s["id"],
+                    "sar",
+                    partial(log_amplitude, s["mp"], output, params, debug=debug),
+                    megapixels=size,
+                )
+            )
+            if not debug and os.path.isfile(s["mp"]):
+                header = planned_header(read_header(s["mp"]), output, multilook)
+                if header["geotransform"] is not None:
+                    set_mp_header(s, header)
+        else:
+            logger.info("Skipping SAR preprocessing (already done): {}".format(s["id"]))
+        s["sar"], s["mp"] = s["mp"], output
+        if size is not None:
+            # The jobs of the pairs are sized before the image exists
+            s["megapixels"] = size / (multilook[0] * multilook[1])
+    return jobs
+
+
+def planned_header(header: dict, output: str, multilook: list[int]) -> dict:
+    """Header of the log-amplitude of an image, before it is written"""
+    lx, ly = multilook
+    gt = header["geotransform"]
+    if gt is not None:
+        gt = [gt[0], gt[1] * lx, gt[2] * ly, gt[3], gt[4] * lx, gt[5] * ly]
+    return dict(
+        header,
+        path=os.path.abspath(output),
+        width=header["width"] // lx,
+        height=header["height"] // ly,
+        bands=1,
+        dtype="float32",
+        nodata=float("nan"),
+        geotransform=gt,
+    )
+
+
+def fingerprint(input: str, params: dict) -> dict:
+    options = params.get("sar", {})
+    return {
+        "input": os.path.abspath(input),
+        "options": {k: options[k] for k in OPTIONS if k in options},
+    }
+
+
+def is_done(input: str, output: str, params: dict) -> bool:
+    """Whether the output is newer than the input and was made with the same options"""
+    record = os.path.splitext(output)[0] + ".json"
+    if not os.path.isfile(output) or not os.path.isfile(record):
+        return False
+    if os.path.isfile(input) and os.path.getmtime(output) < os.path.getmtime(input):
+        return False
+    with open(record, "r") as infile:
+        try:
+            return json.load(infile) == fingerprint(input, params)
+        except json.JSONDecodeError:
+            return False
+
+
+def log_amplitude(input: str, output: str, params: dict, debug=False):
+    """Preprocess a SAR amplitude image into its log-amplitude"""
+    options = params.get("sar", {})
+    logger.info("SAR preprocessing: {} > {}".format(input, output))
+    if debug:
+        return
+    lx, ly = options.get("multilook", [1, 1])
+    speckle = options.get("speckle", 0)
+    workdir = os.path.dirname(output)
+    image = Raster(input, workdir, debug=debug)
+    width, height = image.width // lx, image.height // ly
+    raw = os.path.splitext(output)[0] + ".raw"
+    create_raw(raw, 1, height, width, "float32").flush()
+    work = partial(
+        process_block,
+        (image.header, image.raw),
+        raw,
+        (1, height, width),
+        options,
+    )
+    windows = list(blocks(width, height, options.get("block", 1024), speckle // 2))
+    with ProcessPoolExecutor(max_workers=options.get("workers", 4)) as pool:
+        for f in [pool.submit(work, core, padded) for core, padded in windows]:
+            f.result()
+    pack(raw, output, image, 1, "float32", nodata=np.nan, scale=[lx, ly])
+    image.close()
+    with open(os.path.splitext(output)[0] + ".json", "w") as outfile:
+        json.dump(fingerprint(input, params), outfile)
+
+
+def process_block(
+    source: tuple, raw: str, shape: tuple, options: dict, core: list, padded: list
+):
+    """Process a block (run in a worker process, which maps the input and output)"""
+    header, unpacked = source
+    data = mapped_tiff(header) if unpacked is None else mapped_raw(unpacked)
+    lx, ly = options.get("multilook", [1, 1])
+    x, y, w, h = padded
+    window = [x * lx, y * ly, w * lx, h * ly]
+    band = options.get("band", 1)
+    values = read_block(data[band - 1 : band], window)[0].astype(np.float32)
+    with np.errstate(invalid="ignore"):
+        valid = np.isfinite(values) & (values > 0)
+    if header["nodata"] is not None:
+        valid &= values != header["nodata"]
+    intensity = np.where(valid, values, 0)
+    if options.get("input", "amplitude") == "amplitude":
+        intensity = intensity**2
+    intensity = multilook(intensity, valid, lx, ly)
+    speckle = options.get("speckle", 0)
+    if speckle > 1:
+        intensity = lee_filter(intensity, speckle, options.get("looks", lx * ly))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if options.get("log", "ln") == "db":
+            result = 10 * np.log10(intensity)
+        else:
+            # log of the amplitude
+            result = 0.5 * np.log(intensity)
+    result[~(intensity > 0)] = np.nan
+    out = np.memmap(
+        raw, dtype=np.dtype("float32").newbyteorder("<"), mode="r+", shape=shape
+    )
+    x, y, w, h = core
+    out[0, y : y + h, x : x + w] = inner(result, core, padded)
+    out.flush()
+
+
+def multilook(intensity: np.ndarray, valid: np.ndarray, lx: int, ly: int) -> np.ndarray:
+    """Mean of the valid intensities of each lx * ly cell (NaN if none)"""
+    h, w = intensity.shape[0] // ly, intensity.shape[1] // lx
+    if lx == 1 and ly == 1:
+        return np.where(valid, intensity, np.nan)
+    sums = intensity[: h * ly, : w * lx].reshape(h, ly, w, lx).sum(axis=(1, 3))
+    counts = valid[: h * ly, : w * lx].reshape(h, ly, w, lx).sum(axis=(1, 3))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def box_mean(values: np.ndarray, size: int) -> np.ndarray:
+    """Mean of the finite values in a size * size window (summed-area table)"""
+    half = size // 2
+    valid = np.isfinite(values)
+    table = []
+    for a in [np.where(valid, values, 0).astype(np.float64), valid.astype(np.float64)]:
+        a = np.pad(a, ((half + 1, half), (half + 1, half)))
+        a = a.cumsum(axis=0).cumsum(axis=1)
+        table.append(
+            a[size:, size:] - a[:-size, size:] - a[size:, :-size] + a[:-size, :-size]
+        )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(table[1] > 0, table[0] / table[1], np.nan)
+
+
+def lee_filter(intensity: np.ndarray, size: int, looks: float) -> np.ndarray:
+    """Lee filter of an intensity image for a speckle of `looks` equivalent looks"""
+    mean = box_mean(intensity, size)
+    variance = np.maximum(box_mean(intensity**2, size) - mean**2, 0)
+    noise = 1 / looks
+    signal = np.maximum((variance - mean**2 * noise) / (1 + noise), 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(variance > 0, signal / variance, 0)
+    return (mean + weight * (intensity - mean)).astype(np.float32)
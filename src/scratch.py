@@ -0,0 +1,234 @@
+"""
+Local scratch staging of the inputs and asynchronous write-back of the outputs
+
+Random access heavy commands (parallel_stereo, mapproject) are run on local copies of
+their inputs (images, cameras, DEM), writing into a local folder. Once the command is
+done, its outputs are copied back to the output folder in the background while the
+next job runs. Staged inputs are shared between jobs (an image is used by several
+pairs) and evicted in least recently used order when the scratch cap is reached. A
+VRT input is staged as a local VRT pointing at the staged copies of its sources.
+
+Parameters from the `[scratch]` section of the parameter file:
+* dir: local scratch folder (SSD or tmpfs), required
+* cap: maximum size of the staged inputs, in GB (default 100)
+* workers: number of simultaneous write-backs (default 2)
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Cameras (which may refer to their neighbouring files) are read where they are
+NOT_STAGED = (".xml",)
+
+
+class Scratch:
+    """Stage inputs on a local disk, with LRU eviction and background write-back"""
+
+    def __init__(self, params: dict, debug=False):
+        options = params["scratch"]
+        if options.get("dir", None) is None:
+            raise ValueError("[scratch] needs a local dir")
+        self.folder = options["dir"]
+        self.inputs = os.path.join(self.folder, "inputs")
+        self.outputs = os.path.join(self.folder, "outputs")
+        self.cap = options.get("cap", 100) * 1e9
+        self.debug = debug
+        # key > {"local", "size", "pins", "ready", "ok"}, least recently used first
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=options.get("workers", 2))
+        self.pending = {}
+        # Inputs shared by all the jobs (e.g the DEM), staged once for the whole run
+        self.kept = set()
+        self.kept_keys = set()
+        if not debug:
+            os.makedirs(self.inputs, exist_ok=True)
+            os.makedirs(self.outputs, exist_ok=True)
+
+    def run(self, inputs: list[str], output: str, func):
+        """Run func(local_inputs, local_output) on staged inputs, then write the
+        outputs back in the background"""
+        staged = [self.stage(p) for p in inputs]
+        local_inputs = [local for local, _ in staged]
+        local_output = self.local_output(output)
+        try:
+            func(local_inputs, local_output)
+        finally:
+            self.unpin([k for _, keys in staged for k in keys])
+        future = self.pool.submit(self.write_back, local_output, output)
+        with self.lock:
+            self.pending[output] = future
+
+    def after(self, output: str, callback):
+        """Call back once the outputs of a prefix are written back"""
+        with self.lock:
+            future = self.pending.get(output, None)
+        if future is None:
+            callback()
+        else:
+            future.add_done_callback(lambda f: callback())
+
+    def wait(self):
+        """Wait for all the write-backs (stage barrier)"""
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending = {}
+        for f in futures:
+            f.result()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
+        self.unpin(list(self.kept_keys))
+        self.kept_keys = set()
+
+    def keep(self, path: str):
+        """Keep an input staged from its first use until the end of the run, instead
+        of letting it be evicted between the jobs using it"""
+        self.kept.add(os.path.abspath(path))
+
+    def key(self, path: str) -> str | None:
+        if not os.path.isfile(path) or path.lower().endswith(NOT_STAGED):
+            return None
+        st = os.stat(path)
+        return "{}:{}:{}".format(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def stage(self, path: str) -> tuple[str, list[str]]:
+        """Local copy of an input (the input itself if it cannot be staged), and the
+        keys it pins, to be released by unpin"""
+        if self.debug:
+            logger.info("stage {}".format(path))
+            return path, []
+        if path.lower().endswith(".vrt") and os.path.isfile(path):
+            return self.stage_vrt(path)
+        key = self.key(path)
+        if key is None:
+            return path, []
+        size = os.path.getsize(path)
+        copy = False
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                if not self.make_room(size):
+                    logger.warning("Scratch is full, reading in place: {}".format(path))
+                    return path, []
+                digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+                local = os.path.join(self.inputs, digest + "-" + os.path.basename(path))
+                entry = {
+                    "local": local,
+                    "size": size,
+                    "pins": 0,
+                    "ready": threading.Event(),
+                    "ok": False,
+                }
+                self.entries[key] = entry
+                self.used += size
+                copy = True
+            entry["pins"] += 1
+            if os.path.abspath(path) in self.kept and key not in self.kept_keys:
+                # Pinned until close
+                entry["pins"] += 1
+                self.kept_keys.add(key)
+            self.entries.move_to_end(key)
+        if copy:
+            try:
+                shutil.copyfile(path, entry["local"])
+                entry["ok"] = True
+            except OSError as e:
+                logger.warning("Staging failed, reading in place: {}".format(e))
+            entry["ready"].set()
+        else:
+            entry["ready"].wait()
+        return (entry["local"] if entry["ok"] else path), [key]
+
+    def stage_vrt(self, path: str) -> tuple[str, list[str]]:
+        """Local VRT reading the staged copies of the sources of a VRT"""
+        tree = ET.parse(path)
+        folder = os.path.dirname(os.path.abspath(path))
+        keys = []
+        for elem in tree.iter("SourceFilename"):
+            if not elem.text:
+                continue
+            source = elem.text.strip()
+            # The attribute is spelt both ways by GDAL
+            relative = elem.attrib.pop("relativetoVRT", "0")
+            relative = elem.attrib.pop("relativeToVRT", relative)
+            if relative == "1":
+                source = os.path.join(folder, source)
+            if os.path.abspath(path) in self.kept:
+                self.kept.add(os.path.abspath(source))
+            local, pinned = self.stage(source)
+            keys += pinned
+            elem.text = os.path.abspath(local)
+            elem.set("relativeToVRT", "0")
+        st = os.stat(path)
+        key = "{}:{}:{}".format(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        local = os.path.join(self.inputs, digest + "-" + os.path.basename(path))
+        tmp = "{}.{}.tmp".format(local, threading.get_ident())
+        tree.write(tmp)
+        os.replace(tmp, local)
+        return local, keys
+
+    def unpin(self, keys: list[str]):
+        """Release the keys pinned by stage (even if the input changed since)"""
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key, None)
+                if entry is not None:
+                    entry["pins"] = max(entry["pins"] - 1, 0)
+
+    def make_room(self, size: int) -> bool:
+        """Evict unused staged inputs, least recently used first (lock held)"""
+        for key in list(self.entries.keys()):
+            if self.used + size <= self.cap:
+                break
+            entry = self.entries[key]
+            if entry["pins"] > 0:
+                continue
+            logger.debug("Evict from scratch: {}".format(key))
+            if os.path.isfile(entry["local"]):
+                os.remove(entry["local"])
+            self.used -= entry["size"]
+            del self.entries[key]
+        return self.used + size <= self.cap
+
+    def local_output(self, output: str) -> str:
+        """Local counterpart of an output prefix (or file)"""
+        folder = os.path.dirname(os.path.abspath(output))
+        digest = hashlib.sha1(folder.encode()).hexdigest()[:12]
+        local = os.path.join(self.outputs, digest)
+        if not self.debug:
+            os.makedirs(local, exist_ok=True)
+        return os.path.join(local, os.path.basename(output))
+
+    def write_back(self, local_output: str, output: str):
+        """Copy the files of a local output prefix back, then free them"""
+        local_dir, name = os.path.split(local_output)
+        target = os.path.dirname(output) or "."
+        if self.debug:
+            logger.info("write back {}* > {}".format(local_output, target))
+            return
+        os.makedirs(target, exist_ok=True)
+        for entry in os.scandir(local_dir):
+            if not entry.name.startswith(name):
+                continue
+            if entry.is_file():
+                # Never leave a partial product that could be taken as done
+                tmp = os.path.join(target, "." + entry.name + ".part")
+                shutil.copyfile(entry.path, tmp)
+                os.replace(tmp, os.path.join(target, entry.name))
+                os.remove(entry.path)
+            else:
+                # Tile folders of parallel_stereo stay on the scratch
+                shutil.rmtree(entry.path)
+        logger.debug("Written back: {}".format(output))
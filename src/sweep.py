@@ -0,0 +1,316 @@
+"""
+Search of the stereo parameters on crops of a few pairs
+
+A few regions of interest (ROI) are cropped (VRT, no copy) on the intersection of
+some pairs of the project, and every variant of the `[stereo]` options is correlated
+on each ROI as a short job, several at a time. Each variant is scored on its runtime,
+its ratio of valid disparities and its mean NCC, and the Pareto-optimal variants
+(no other variant is faster, denser and better correlated at once) are written as
+presets, next to a summary of all the variants.
+
+Parameters from the `[sweep]` section of the parameter file:
+* stereo: candidate values of each stereo option, e.g `cost-mode = [2, 3]` or
+  `corr-kernel = [[7, 7], [9, 9], [15, 15]]`
+* samples: number of variants drawn at random from the grid (default 0: whole grid)
+* seed: seed of the random draw (default 0)
+* pairs: number of pairs used, spread over the pair list (default 2)
+* rois: number of ROI per pair, spread along the diagonal of the intersection
+  (default 3)
+* roi-size: width and height of the ROI, in pixels (default 1024)
+* workers: number of variants correlated simultaneously (default 4)
+"""
+
+import csv
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import time
+from copy import deepcopy
+from functools import partial
+
+from asp import corr_eval, gdal_info, stereo
+from geotiff import aligned_windows, pixel_offset
+from params import (
+    DIR_STEREO,
+    PREF_STEREO,
+    check_for_mp,
+    get_pairs,
+    get_sources,
+    ids_from_source,
+    make_full_pairs,
+    read_mp_headers,
+    source_from_id,
+    write_toml,
+)
+from prepass import read_corr_search
+from runner import Job
+from vrt import crop_vrt
+from workflow import Workflow
+
+logger = logging.getLogger(__name__)
+
+DIR_SWEEP = "SWEEP"
+SUMMARY_FILE = "sweep.csv"
+PRESET_PREFIX = "pareto-"
+
+
+def variants(options: dict, samples: int = 0, seed: int = 0) -> list[dict]:
+    """Combinations of the candidate values of each option (or a random draw)"""
+    keys = sorted(options.keys())
+    grid = [
+        dict(zip(keys, values))
+        for values in itertools.product(*[options[k] for k in keys])
+    ]
+    if 0 < samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+
+def spread(items: list, n: int) -> list:
+    """n items evenly spread over a list"""
+    if n >= len(items):
+        return items
+    return [items[round(i * (len(items) - 1) / max(n - 1, 1))] for i in range(n)]
+
+
+def roi_windows(windows: list[list[int]], n: int, size: int) -> list[list[list[int]]]:
+    """Windows of n ROI of each image of a pair, spread along the diagonal of their
+    intersection"""
+    xsize, ysize = min(size, windows[0][2]), min(size, windows[0][3])
+    rois = []
+    for k in range(n):
+        t = (k + 1) / (n + 1)
+        dx = int(round(t * (windows[0][2] - xsize)))
+        dy = int(round(t * (windows[0][3] - ysize)))
+        rois.append([[w[0] + dx, w[1] + dy, xsize, ysize] for w in windows])
+    return rois
+
+
+def run_variant(
+    variant: int,
+    imgs: list[str],
+    output: str,
+    params: dict,
+    results: list,
+    debug=False,
+):
+    """Correlate a ROI with a variant and score it"""
+    start = time.time()
+    stereo(imgs, None, output, params, debug=debug)
+    runtime = time.time() - start
+    corr_eval(
+        output + "-L.tif",
+        output + "-R.tif",
+        output + "-F.tif",
+        output,
+        params,
+        debug=debug,
+    )
+    if debug:
+        return
+    results.append(
+        {
+            "variant": variant,
+            "runtime": runtime,
+            "valid": band_mean(output + "-F.tif", 3),
+            "ncc": band_mean(output + "-ncc.tif", 1),
+        }
+    )
+
+
+def band_mean(raster: str, band: int) -> float | None:
+    """Mean of a band (the valid flag band of a disparity gives the valid ratio)"""
+    info = gdal_info(raster, ["-stats"])
+    try:
+        return float(info["bands"][band - 1]["mean"])
+    except (TypeError, KeyError, IndexError, ValueError):
+        return None
+
+
+def scores(candidates: list[dict], results: list[dict], rois: int) -> list[dict]:
+    """Total runtime, mean valid ratio and NCC of the variants fully scored"""
+    table = []
+    for i, v in enumerate(candidates):
+        done = [r for r in results if r["variant"] == i]
+        if len(done) < rois or any([r[k] is None for r in done for k in r]):
+            logger.warning("Variant {} is not fully scored: {}".format(i, v))
+            continue
+        table.append(
+            {
+                "variant": i,
+                "options": v,
+                "runtime": sum([r["runtime"] for r in done]),
+                "valid": sum([r["valid"] for r in done]) / len(done),
+                "ncc": sum([r["ncc"] for r in done]) / len(done),
+            }
+        )
+    return table
+
+
+def dominates(a: dict, b: dict) -> bool:
+    better = [
+        a["runtime"] <= b["runtime"],
+        a["valid"] >= b["valid"],
+        a["ncc"] >= b["ncc"],
+    ]
+    strictly = [
+        a["runtime"] < b["runtime"],
+        a["valid"] > b["valid"],
+        a["ncc"] > b["ncc"],
+    ]
+    return all(better) and any(strictly)
+
+
+def pareto(table: list[dict]) -> list[dict]:
+    """Variants dominated by no other one, by decreasing NCC"""
+    front = [s for s in table if not any([dominates(o, s) for o in table])]
+    return sorted(front, key=lambda s: -s["ncc"])
+
+
+def write_results(
+    candidates: list[dict], results: list, rois: int, params: dict, folder: str
+):
+    """Summary of the variants and presets of the Pareto-optimal ones (based on the
+    project parameters)"""
+    table = scores(candidates, results, rois)
+    front = pareto(table)
+    with open(os.path.join(folder, SUMMARY_FILE), "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(["variant", "runtime", "valid", "ncc", "pareto", "options"])
+        for s in table:
+            writer.writerow(
+                [
+                    s["variant"],
+                    round(s["runtime"], 1),
+                    round(s["valid"], 4),
+                    round(s["ncc"], 4),
+                    s in front,
+                    json.dumps(s["options"]),
+                ]
+            )
+    for i, s in enumerate(front):
+        preset = deepcopy(params)
+        preset.pop("sweep", None)
+        preset["stereo"].update(s["options"])
+        preset["description"] = (
+            "Sweep variant {}: {:.1f}s, {:.1%} valid, NCC {:.3f}".format(
+                s["variant"], s["runtime"], s["valid"], s["ncc"]
+            )
+        )
+        path = os.path.join(folder, "{}{}.toml".format(PRESET_PREFIX, i + 1))
+        write_toml(preset, path)
+        logger.info(
+            "Pareto variant {}: {} > {}".format(s["variant"], s["options"], path)
+        )
+
+
+def aligned_search(corr_search: list, header1: dict, header2: dict) -> list[int]:
+    """corr-search of the full images of a pair, on aligned crops of the pair (the
+    crops only remove the whole pixels of the offset between the grids)"""
+    delta_x, delta_y = [round(d) for d in pixel_offset(header1, header2)]
+    return [
+        math.floor(corr_search[0] - delta_x),
+        math.floor(corr_search[1] - delta_y),
+        math.ceil(corr_search[2] - delta_x),
+        math.ceil(corr_search[3] - delta_y),
+    ]
+
+
+class Sweep(Workflow):
+    """Stereo parameter sweep on ROI of a few pairs"""
+
+    def __init__(self, params: dict, debug=False, tracker=None):
+        super().__init__(params, debug=debug, tracker=tracker)
+        self.project = deepcopy(params)
+        # Status, timeline and results of the sweep are kept apart from the project
+        self.project_dir = self.params.get("output", ".")
+        self.params["output"] = os.path.join(self.project_dir, DIR_SWEEP)
+
+    def setup(self) -> list[tuple]:
+        logger.info("Initializing stereo parameter sweep")
+        params, debug = self.params, self.debug
+        options = params.get("sweep", {})
+        folder = params["output"]
+        sources = get_sources(params, first=2, debug=debug)
+        ids = ids_from_source(sources)
+        if params.get("pairs", None) is not None:
+            pairs = get_pairs(params, ids, first=2)
+        else:
+            pairs = make_full_pairs(ids)
+        sources = check_for_mp(sources, self.project_dir)
+        if sources is None:
+            raise ValueError(
+                "No map projected images defined or no previous mp run found"
+            )
+        sources = read_mp_headers(sources)
+
+        candidates = variants(
+            options.get("stereo", {}), options.get("samples", 0), options.get("seed", 0)
+        )
+        logger.info("Sweeping {} stereo variants".format(len(candidates)))
+        n_rois = options.get("rois", 3)
+        results = []
+        jobs = []
+        rois = 0
+        for p in spread(pairs, options.get("pairs", 2)):
+            src1, src2 = source_from_id(p[0], sources), source_from_id(p[1], sources)
+            header1, header2 = src1.get("mp-header", None), src2.get("mp-header", None)
+            aligned = None
+            if header1 is not None and header2 is not None:
+                aligned = aligned_windows(header1, header2)
+            if aligned is None:
+                logger.warning("Pair left out, no aligned intersection: {}".format(p))
+                continue
+            windows = aligned[0]
+            pair_dir = os.path.join(self.project_dir, DIR_STEREO, "_".join(p))
+            corr_search = read_corr_search(os.path.join(pair_dir, PREF_STEREO))
+            cropped = os.path.isfile(os.path.join(pair_dir, "crop-{}.vrt".format(p[0])))
+            if corr_search is not None and not cropped:
+                # The pre-pass of the full images includes the offset of their grids,
+                # the ROI are aligned crops
+                corr_search = aligned_search(corr_search, header1, header2)
+            for r, roi in enumerate(
+                roi_windows(windows, n_rois, options.get("roi-size", 1024))
+            ):
+                name = "{}_{}-roi{}".format(p[0], p[1], r)
+                crops = [os.path.join(folder, name, "crop-{}.vrt".format(i)) for i in p]
+                if not debug:
+                    os.makedirs(os.path.join(folder, name), exist_ok=True)
+                    crop_vrt(header1, roi[0], crops[0])
+                    crop_vrt(header2, roi[1], crops[1])
+                rois += 1
+                for i, v in enumerate(candidates):
+                    variant_params = deepcopy(params)
+                    variant_params.setdefault("corr-eval", {})
+                    if corr_search is not None:
+                        variant_params["stereo"]["corr-search"] = corr_search
+                    variant_params["stereo"].update(v)
+                    output = os.path.join(folder, name, "v{}".format(i), PREF_STEREO)
+                    jobs.append(
+                        Job(
+                            "v{}/{}".format(i, name),
+                            "sweep",
+                            partial(
+                                run_variant,
+                                i,
+                                crops,
+                                output,
+                                variant_params,
+                                results,
+                                debug=debug,
+                            ),
+                            megapixels=roi[0][2] * roi[0][3] / 1e6,
+                        )
+                    )
+        stages = [("Correlate the variants", jobs, options.get("workers", 4))]
+        if not debug:
+            score = Job(
+                "results",
+                "sweep-score",
+                partial(write_results, candidates, results, rois, self.project, folder),
+            )
+            stages.append(("Score the variants", [score], 1))
+        return stages
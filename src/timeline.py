@@ -0,0 +1,149 @@
+"""
+Timeline of a workflow run and critical path analysis
+
+At the end of a run, the jobs of the project are written as a trace-event file
+(`aspeo-trace.json` in the output folder) that can be opened in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing: one lane per worker slot with a span
+per job attempt (the failed attempts of retried jobs included), and one lane with a
+span per stage.
+
+The critical path is the chain of jobs that decided the total duration: going back
+from the last job to end, each job is attributed to its dependency that ended last,
+else (no dependency run) to the job that ended last before its first attempt (the
+end of the previous stage, or the job that freed its worker slot). The idle time of each slot shows how long the workers waited on the
+stragglers of each stage.
+"""
+
+import json
+
+TRACE_FILE = "aspeo-trace.json"
+# Tolerance between the end of a job and the start of the next one (s)
+EPSILON = 0.05
+
+
+def timed(jobs: list) -> list:
+    """Jobs that were actually run, by start time"""
+    jobs = [j for j in jobs if j.start is not None and j.end is not None]
+    return sorted(jobs, key=first_start)
+
+
+def first_start(job) -> float:
+    """Start of the first attempt of a job"""
+    return job.attempts[0][0] if len(job.attempts) > 0 else job.start
+
+
+def attempts(job) -> list[tuple]:
+    """(start, end, slot, error) of each attempt of a job, the last one included"""
+    error = None if job.error is None else str(job.error)
+    return job.attempts + [(job.start, job.end, job.slot, error)]
+
+
+def trace_events(jobs: list, name: str | None = None) -> list[dict]:
+    """Trace events (complete events, in µs from the start of the run)"""
+    jobs = timed(jobs)
+    if len(jobs) == 0:
+        return []
+    origin = first_start(jobs[0])
+    events = [
+        {
+            "ph": "M",
+            "name": "process_name",
+            "pid": 1,
+            "args": {"name": name or "aspeo"},
+        },
+        {
+            "ph": "M",
+            "name": "thread_name",
+            "pid": 1,
+            "tid": 0,
+            "args": {"name": "stages"},
+        },
+    ]
+    slots = set([a[2] for j in jobs for a in attempts(j)])
+    for slot in sorted(slots):
+        events.append(
+            {
+                "ph": "M",
+                "name": "thread_name",
+                "pid": 1,
+                "tid": slot + 1,
+                "args": {"name": "slot {}".format(slot)},
+            }
+        )
+    for stage, (start, end) in stage_spans(jobs).items():
+        events.append(span(stage, "stage", 0, start - origin, end - start, {}))
+    for j in jobs:
+        tries = attempts(j)
+        for i, (start, end, slot, error) in enumerate(tries):
+            args = {"state": j.state if i == len(tries) - 1 else "failed"}
+            if j.megapixels is not None:
+                args["megapixels"] = round(j.megapixels, 2)
+            if error is not None:
+                args["error"] = error
+            name = "{}: {}".format(j.stage, j.name)
+            if len(tries) > 1:
+                name += " (attempt {})".format(i + 1)
+            events.append(
+                span(name, j.stage, slot + 1, start - origin, end - start, args)
+            )
+    return events
+
+
+def span(name: str, cat: str, tid: int, start: float, duration: float, args: dict):
+    return {
+        "ph": "X",
+        "name": name,
+        "cat": cat,
+        "pid": 1,
+        "tid": tid,
+        "ts": round(start * 1e6),
+        "dur": round(duration * 1e6),
+        "args": args,
+    }
+
+
+def stage_spans(jobs: list) -> dict:
+    """stage > (first start, last end)"""
+    spans = {}
+    for j in jobs:
+        start, end = spans.get(j.stage, (first_start(j), j.end))
+        spans[j.stage] = (min(start, first_start(j)), max(end, j.end))
+    return spans
+
+
+def critical_path(jobs: list) -> list:
+    """Chain of jobs ending with the last one, each preceded by its dependency that
+    ended last, else by the job that ended last before its first attempt"""
+    jobs = timed(jobs)
+    if len(jobs) == 0:
+        return []
+    job = max(jobs, key=lambda j: j.end)
+    path = [job]
+    while True:
+        before = [j for j in job.after if j in jobs]
+        if len(before) == 0:
+            start = first_start(job)
+            before = [j for j in jobs if j.end <= start + EPSILON and j.end < job.end]
+        if len(before) == 0:
+            break
+        job = max(before, key=lambda j: j.end)
+        path.append(job)
+    return path[::-1]
+
+
+def idle_times(jobs: list) -> dict:
+    """slot > time without job between the start and the end of the run (s)"""
+    jobs = timed(jobs)
+    if len(jobs) == 0:
+        return {}
+    wall = max([j.end for j in jobs]) - first_start(jobs[0])
+    busy = {}
+    for j in jobs:
+        for start, end, slot, _ in attempts(j):
+            busy[slot] = busy.get(slot, 0.0) + end - start
+    return {s: max(wall - b, 0.0) for s, b in sorted(busy.items())}
+
+
+def write_trace(jobs: list, output: str, name: str | None = None):
+    with open(output, "w") as outfile:
+        json.dump({"traceEvents": trace_events(jobs, name=name)}, outfile)
@@ -0,0 +1,163 @@
+"""
+Virtual rasters (GDAL VRT) written directly in Python
+
+Used to expose crops or mosaics of existing rasters without copying any pixel and
+without launching a GDAL command for each of them.
+"""
+
+import os
+import xml.etree.ElementTree as ET
+
+VRT_TYPES = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "uint64": "UInt64",
+    "int64": "Int64",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def write_vrt(
+    output: str,
+    size: list[int],
+    bands: list[dict],
+    geotransform: list[float] | None = None,
+    srs: str | None = None,
+):
+    """Write a VRT file
+
+    :param size: [width, height] of the virtual raster
+    :param bands: one dict per band with "dtype", optional "nodata" and "sources", a
+        list of dict with "path", "band", "src" and "dst" windows [xoff, yoff, xsize, ysize]
+    :param geotransform: GDAL geotransform of the virtual raster
+    :param srs: spatial reference understood by GDAL (e.g "EPSG:32631")
+    """
+    root = ET.Element("VRTDataset", rasterXSize=str(size[0]), rasterYSize=str(size[1]))
+    if srs is not None:
+        ET.SubElement(root, "SRS").text = srs
+    if geotransform is not None:
+        ET.SubElement(root, "GeoTransform").text = ", ".join(
+            [repr(float(g)) for g in geotransform]
+        )
+    for i, b in enumerate(bands):
+        band = ET.SubElement(
+            root, "VRTRasterBand", dataType=VRT_TYPES[b["dtype"]], band=str(i + 1)
+        )
+        if b.get("nodata", None) is not None:
+            ET.SubElement(band, "NoDataValue").text = repr(b["nodata"])
+        for s in b["sources"]:
+            source = ET.SubElement(band, "SimpleSource")
+            ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = (
+                os.path.abspath(s["path"])
+            )
+            ET.SubElement(source, "SourceBand").text = str(s["band"])
+            ET.SubElement(source, "SrcRect", **window_attrib(s["src"]))
+            ET.SubElement(source, "DstRect", **window_attrib(s["dst"]))
+    ET.indent(root)
+    ET.ElementTree(root).write(output)
+
+
+def window_attrib(window: list[int]) -> dict:
+    return {
+        "xOff": str(window[0]),
+        "yOff": str(window[1]),
+        "xSize": str(window[2]),
+        "ySize": str(window[3]),
+    }
+
+
+def mosaic_vrt(
+    output: str, size: list[int], nbands: int, dtype: str, tiles: list[tuple]
+):
+    """Write a VRT assembling non-overlapping tiles sharing the same bands
+
+    :param tiles: (path, [xoff, yoff, xsize, ysize]) of each tile in the mosaic
+    """
+    bands = [
+        {
+            "dtype": dtype,
+            "sources": [
+                {"path": p, "band": b + 1, "src": [0, 0] + w[2:], "dst": w}
+                for p, w in tiles
+            ],
+        }
+        for b in range(nbands)
+    ]
+    write_vrt(output, size, bands)
+
+
+def crop_vrt(header: dict, window: list[int], output: str):
+    """Write a VRT cropping a raster (header from `geotiff.read_header`) to a window"""
+    ulx, resx, rx, uly, ry, resy = header["geotransform"]
+    geotransform = [
+        ulx + window[0] * resx + window[1] * rx,
+        resx,
+        rx,
+        uly + window[0] * ry + window[1] * resy,
+        ry,
+        resy,
+    ]
+    srs = None if header["epsg"] is None else "EPSG:{}".format(header["epsg"])
+    bands = [
+        {
+            "dtype": header["dtype"],
+            "nodata": header["nodata"],
+            "sources": [
+                {
+                    "path": header["path"],
+                    "band": b + 1,
+                    "src": window,
+                    "dst": [0, 0, window[2], window[3]],
+                }
+            ],
+        }
+        for b in range(header["bands"])
+    ]
+    write_vrt(output, window[2:], bands, geotransform=geotransform, srs=srs)
+
+
+def raw_vrt(
+    output: str,
+    raw: str,
+    size: list[int],
+    nbands: int,
+    dtype: str,
+    geotransform: list[float] | None = None,
+    srs: str | None = None,
+    nodata: float | None = None,
+):
+    """Write a VRT exposing a raw band sequential little-endian file (e.g a NumPy
+    memmap)"""
+    root = ET.Element("VRTDataset", rasterXSize=str(size[0]), rasterYSize=str(size[1]))
+    if srs is not None:
+        ET.SubElement(root, "SRS").text = srs
+    if geotransform is not None:
+        ET.SubElement(root, "GeoTransform").text = ", ".join(
+            [repr(float(g)) for g in geotransform]
+        )
+    # Bits in the type name: "float32" > 4 bytes
+    itemsize = int("".join([c for c in dtype if c.isdigit()])) // 8
+    for b in range(nbands):
+        band = ET.SubElement(
+            root,
+            "VRTRasterBand",
+            dataType=VRT_TYPES[dtype],
+            band=str(b + 1),
+            subClass="VRTRawRasterBand",
+        )
+        if nodata is not None:
+            ET.SubElement(band, "NoDataValue").text = repr(nodata)
+        ET.SubElement(band, "SourceFilename", relativetoVRT="0").text = os.path.abspath(
+            raw
+        )
+        ET.SubElement(band, "ImageOffset").text = str(b * size[0] * size[1] * itemsize)
+        ET.SubElement(band, "PixelOffset").text = str(itemsize)
+        ET.SubElement(band, "LineOffset").text = str(size[0] * itemsize)
+        ET.SubElement(band, "ByteOrder").text = "LSB"
+    ET.indent(root)
+    ET.ElementTree(root).write(output)
@@ -0,0 +1,269 @@
+"""
+Watch mode: incremental processing of newly arriving acquisitions
+
+The source folder (`src-folder`) is polled for new acquisitions, which are added to
+a catalog kept in the output folder (`WATCH/catalog.json`, seeded with the sources
+of the parameter file). At each cycle, only the pairs that were not processed yet
+are planned (from the pair file if any, else from the rules below), and the
+workflows are run for them only: map projection of the new sources, pixel tracking
+of the new pairs, DSM fragments of the new pairs. Aggregate products are updated
+incrementally (e.g the tiled DSM mosaic only rebuilds the tiles touched by the new
+fragments). Pairs are recorded as processed once all their jobs succeeded, failed
+ones are retried at the next cycle.
+
+New acquisitions are found according to `kind`:
+* pleiades: delivery folders holding a DIM (`pleiades` attribute, id from the
+  acquisition date of the DIM)
+* sentinel2: SAFE products (`sentinel2` attribute, id from the sensing date)
+* mp / pan: image files `mp-prefix` + id + `mp-suffix` (or `pan-*`)
+
+Parameters from the `[watch]` section of the parameter file:
+* kind: "pleiades", "sentinel2", "pan" or "mp" (default inferred from the sources
+  and global parameters)
+* pattern: glob of the new acquisitions in the source folder (default from kind)
+* workflows: workflows run at each cycle (default ["mp", "pt"], without "mp" if
+  there is no `[map-project]` section)
+* neighbours: number of following acquisitions (by date) each one is paired with
+  (default 0: all)
+* max-delay: maximum delay between the images of a pair, in days (default none)
+* interval: time between two polls, in seconds (default 3600)
+* settle: minimum age of a file before it is taken, in seconds, so that deliveries
+  being copied are left for the next cycle (default 60)
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import time
+from copy import deepcopy
+from datetime import datetime
+
+from asp_dsm import DsmGeneration
+from asp_mp import MapProjection
+from asp_pt import PixelTracking
+from dim import read_dim
+from displacement import date_from_id
+from params import get_pairs
+
+logger = logging.getLogger(__name__)
+
+DIR_WATCH = "WATCH/"
+CATALOG = "catalog.json"
+WORKFLOWS = {"mp": MapProjection, "pt": PixelTracking, "dsm": DsmGeneration}
+PATTERNS = {
+    "pleiades": "**/DIM_*.XML",
+    "sentinel2": "*.SAFE",
+}
+
+
+def watch(params: dict, once=False, debug=False):
+    """Poll the source folder and process the new acquisitions, until interrupted"""
+    options = params.get("watch", {})
+    interval = options.get("interval", 3600)
+    logger.info("Watching {}".format(params["src-folder"]))
+    while True:
+        cycle(params, debug=debug)
+        if once:
+            return
+        logger.info("Next poll in {}s".format(interval))
+        time.sleep(interval)
+
+
+def cycle(params: dict, debug=False) -> list[dict]:
+    """Add the new acquisitions to the catalog and process the pending pairs
+
+    :returns failures: failed and skipped jobs of the cycle
+    """
+    folder = os.path.abspath(os.path.join(params.get("output", "."), DIR_WATCH))
+    catalog = read_catalog(folder)
+    if len(catalog["sources"]) == 0 and type(params.get("source", None)) is list:
+        catalog["sources"] = deepcopy(params["source"])
+    new = discover(params, catalog["sources"])
+    for s in new:
+        logger.info("New acquisition: {}".format(s["id"]))
+    catalog["sources"] += new
+    ids = [s["id"] for s in catalog["sources"]]
+    done = ["_".join(p) for p in catalog["pairs"]]
+    pairs = plan_pairs(ids, params, done)
+    if len(new) == 0 and len(pairs) == 0:
+        logger.info("Nothing new to process")
+        return []
+    logger.info("{} new acquisitions, {} pairs to process".format(len(new), len(pairs)))
+    if not debug:
+        os.makedirs(folder, exist_ok=True)
+        # New sources are kept even if their processing fails
+        write_catalog(folder, catalog)
+
+    new_ids = [s["id"] for s in new]
+    names = ["_".join(p) for p in pairs]
+    known = set(ids) | set(names) | set(done)
+    all_file = os.path.join(folder, "pairs-all.txt")
+    new_file = os.path.join(folder, "pairs-new.txt")
+    if not debug:
+        write_pairs(all_file, catalog["pairs"] + pairs)
+        write_pairs(new_file, pairs)
+    failures = []
+    for name in options_workflows(params):
+        run_params = deepcopy(params)
+        run_params["source"] = deepcopy(catalog["sources"])
+        run_params["pairs-header"] = False
+        run_params["pairs"] = all_file
+        if name == "pt":
+            # Only the pairs to process and their images are planned
+            run_params["pairs"] = new_file
+            used = set([i for p in pairs for i in p])
+            run_params["source"] = [s for s in run_params["source"] if s["id"] in used]
+            if len(pairs) == 0:
+                continue
+        if name == "mp" and len(new_ids) == 0:
+            continue
+        workflow = WORKFLOWS[name](run_params, debug=debug)
+        if name != "pt":
+            # Per source or per pair jobs are only kept for the new ones, the others
+            # (bundle adjustment, mosaic, ...) are aggregates
+            keep = set(new_ids) | set(names)
+            workflow.select(lambda job: job.name in keep or job.name not in known)
+        try:
+            failures += workflow.run()
+        except (ValueError, OSError) as e:
+            logger.error("Watch {} failed: {}".format(name, e))
+            failures.append({"stage": name, "name": name, "state": "failed"})
+    failed = set([f["name"] for f in failures])
+    if len(failed & set([name for name in WORKFLOWS])) > 0:
+        # A whole workflow failed: nothing is recorded
+        return failures
+    for p, name in zip(pairs, names):
+        if name not in failed and not any([i in failed for i in p]):
+            catalog["pairs"].append(p)
+    logger.info(
+        "{} pairs processed, {} already done before".format(
+            len(catalog["pairs"]) - len(done), len(done)
+        )
+    )
+    if not debug:
+        write_catalog(folder, catalog)
+    return failures
+
+
+def options_workflows(params: dict) -> list[str]:
+    default = ["mp", "pt"] if "map-project" in params else ["pt"]
+    return params.get("watch", {}).get("workflows", default)
+
+
+def read_catalog(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, CATALOG), "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {"sources": [], "pairs": []}
+
+
+def write_catalog(folder: str, catalog: dict):
+    tmp = os.path.join(folder, CATALOG + ".tmp")
+    with open(tmp, "w") as outfile:
+        json.dump(catalog, outfile, indent=1)
+    os.replace(tmp, os.path.join(folder, CATALOG))
+
+
+def write_pairs(file: str, pairs: list[list[str]]):
+    with open(file, "w") as outfile:
+        outfile.write("".join([" ".join(p) + "\n" for p in pairs]))
+
+
+def watch_kind(params: dict) -> str:
+    """Kind of acquisitions to watch, from the sources and global parameters"""
+    kind = params.get("watch", {}).get("kind", None)
+    if kind is not None:
+        return kind
+    sources = params.get("source", None)
+    sources = sources if type(sources) is list else []
+    for k in ["pleiades", "sentinel2"]:
+        if any([s.get(k, None) is not None for s in sources]) or any(
+            [p.startswith(k + "-") for p in params]
+        ):
+            return k
+    return "pan" if params.get("derive-pan", False) else "mp"
+
+
+def discover(params: dict, sources: list[dict]) -> list[dict]:
+    """Sources of the acquisitions of the source folder not in the catalog"""
+    kind = watch_kind(params)
+    src = params["src-folder"]
+    key = kind if kind in ["pleiades", "sentinel2"] else None
+    pref = params.get(kind + "-prefix", "")
+    suff = params.get(kind + "-suffix", "")
+    pattern = params.get("watch", {}).get(
+        "pattern", PATTERNS.get(kind, pref + "*" + suff)
+    )
+    settle = params.get("watch", {}).get("settle", 60)
+    known_ids = set([s["id"] for s in sources])
+    known = set([s.get(key, None) for s in sources]) if key else known_ids
+    new = []
+    for path in sorted(glob.glob(os.path.join(src, pattern), recursive=True)):
+        if time.time() - os.path.getmtime(path) < settle:
+            logger.info("Left for the next cycle (being copied?): {}".format(path))
+            continue
+        if kind == "pleiades":
+            # The delivery folder holds the DIM
+            path = os.path.dirname(path)
+        name = os.path.relpath(path, src)
+        if not (name.startswith(pref) and name.endswith(suff)):
+            continue
+        value = name[len(pref) : len(name) - len(suff)]
+        if value in known:
+            continue
+        id = acquisition_id(kind, path, value)
+        while id in known_ids:
+            id += "b"
+        source = {"id": id}
+        if key is not None:
+            source[key] = value
+        new.append(source)
+        known.add(value)
+        known_ids.add(id)
+    return new
+
+
+def acquisition_id(kind: str, path: str, value: str) -> str:
+    """Date of the acquisition (YYYYMMDD) if found, else its name"""
+    if kind == "pleiades":
+        dims = glob.glob(os.path.join(path, "DIM_*.XML"))
+        date = read_dim(dims[0]).imaging_date if len(dims) > 0 else None
+        if date is not None:
+            return date.replace("-", "")[:8]
+    elif kind == "sentinel2":
+        match = re.search(r"_(\d{8})T\d{6}_", os.path.basename(path))
+        if match is not None:
+            return match.group(1)
+    return value.strip("/").replace("/", "_")
+
+
+def plan_pairs(ids: list[str], params: dict, done: list[str]) -> list[list[str]]:
+    """Pairs of known ids not processed yet, from the pair file or the rules"""
+    if params.get("pairs", None) is not None:
+        pairs_params = dict(
+            params, pairs=os.path.join(params.get("root", ""), params["pairs"])
+        )
+        # Triplets are kept for DSM generation
+        first = None if "dsm" in options_workflows(params) else 2
+        pairs = get_pairs(pairs_params, first=first)
+        pairs = [p for p in pairs if all([i in ids for i in p])]
+    else:
+        options = params.get("watch", {})
+        neighbours = options.get("neighbours", 0)
+        max_delay = options.get("max-delay", None)
+        dates = {i: date_from_id(i) for i in ids}
+        order = sorted(ids, key=lambda i: (dates[i] or datetime.max, ids.index(i)))
+        pairs = []
+        for a in range(len(order)):
+            for b in range(a + 1, len(order)):
+                if neighbours > 0 and b - a > neighbours:
+                    break
+                d1, d2 = dates[order[a]], dates[order[b]]
+                if max_delay is not None and d1 is not None and d2 is not None:
+                    if (d2 - d1).days > max_delay:
+                        continue
+                pairs.append([order[a], order[b]])
+    return [p for p in pairs if "_".join(p) not in done]
@@ -0,0 +1,147 @@
+"""
+Workflow objects: plan the jobs of a project, then run them
+
+A workflow is planned from the parameters into stages of jobs before anything is run,
+so that a caller can inspect the jobs, drop some of them, attach hooks and run the
+rest in-process or on its own executor. The parameters are copied: several workflows
+can be planned from the same project.
+"""
+
+import logging
+from contextlib import contextmanager
+from copy import deepcopy
+
+from quicklook import QuickLooks
+from runner import TRACKER, Job, Tracker, run_jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Workflow:
+    """Base of the workflows (map projection, pixel tracking, DSM generation)
+
+    Stages are (message, jobs or callable planning the jobs when reached, workers).
+
+    :param params: parameters of the project (copied)
+    :param tracker: tracker of the project (a new one by default)
+    """
+
+    def __init__(self, params: dict, debug=False, tracker: Tracker | None = None):
+        self.params = deepcopy(params)
+        self.debug = debug
+        self.tracker = Tracker(params.get("name", None)) if tracker is None else tracker
+        self.stages = None
+        self.scratch = None
+        self.retention = None
+        self.quicklooks = None
+        # Outputs with no job left, given to the retention once the workflow is run
+        self.released = []
+
+    def setup(self) -> list[tuple]:
+        """Plan the stages of the workflow"""
+        raise NotImplementedError
+
+    def finish(self):
+        """Wait for the background work once all the stages are done"""
+        if self.scratch is not None:
+            self.scratch.close()
+        if self.retention is not None:
+            logger.info("Waiting for the finalisation of the products")
+            self.retention.wait()
+        if self.quicklooks is not None:
+            logger.info("Waiting for the quick-looks of the products")
+            self.quicklooks.wait()
+
+    @contextmanager
+    def bound(self):
+        """Attribute the work of the current thread to the tracker of the workflow"""
+        previous = TRACKER.current()
+        TRACKER.bind(self.tracker)
+        try:
+            yield self.tracker
+        finally:
+            TRACKER.bind(previous)
+
+    def plan(self) -> list[tuple]:
+        """Stages of the workflow (planned once)"""
+        if self.stages is None:
+            with self.bound():
+                self.tracker.configure(self.params, debug=self.debug)
+                self.stages = self.setup()
+            if "quicklook" in self.params and self.quicklooks is None:
+                self.quicklooks = QuickLooks(self.params, debug=self.debug)
+        return self.stages
+
+    def jobs(self, stage: str | None = None) -> list[Job]:
+        """Planned jobs, optionally of one stage (stages planned when reached, like
+        the mosaic tiles, are not listed)"""
+        return [
+            j
+            for _, jobs, _ in self.plan()
+            if not callable(jobs)
+            for j in jobs
+            if stage is None or j.stage == stage
+        ]
+
+    def select(self, keep) -> "Workflow":
+        """Only keep the jobs for which keep(job) is true, with the jobs depending on
+        them"""
+        dropped = set()
+        stages = []
+        for message, jobs, workers in self.plan():
+            if not callable(jobs):
+                kept = []
+                for j in jobs:
+                    if keep(j) and not any([a in dropped for a in j.after]):
+                        kept.append(j)
+                    else:
+                        dropped.add(j)
+                jobs = kept
+            stages.append((message, jobs, workers))
+        self.stages = stages
+        return self
+
+    def before(self, hook):
+        """Call hook(job) before each job is run"""
+        self.tracker.before.append(hook)
+        return hook
+
+    def after(self, hook):
+        """Call hook(job) once each job is over (done, failed or skipped)"""
+        self.tracker.after.append(hook)
+        return hook
+
+    def run(self, executor=None) -> list[dict]:
+        """Run the stages one after the other
+
+        :param executor: concurrent.futures like executor running the jobs of each
+            stage (the stage workers apply otherwise)
+        :returns failures: failed and skipped jobs
+        """
+        stages = self.plan()
+        with self.bound():
+            self.tracker.plan(self.jobs())
+            if self.retention is not None:
+                # In the background of the stages
+                for output in self.released:
+                    self.retention.submit(output)
+            try:
+                for message, jobs, workers in stages:
+                    if callable(jobs):
+                        jobs = jobs()
+                    if len(jobs) == 0:
+                        continue
+                    logger.info(message)
+                    run_jobs(jobs, workers=workers, executor=executor, debug=self.debug)
+                    if self.scratch is not None:
+                        # Next stages read the outputs written back
+                        self.scratch.wait()
+                    if self.quicklooks is not None:
+                        # In the background of the next stages
+                        self.quicklooks.scan()
+            finally:
+                # Also on stop-on-error: write-backs, retention and quick-looks
+                self.finish()
+            self.tracker.report_failures()
+            self.tracker.report_trace()
+            return self.tracker.failures()